@@ -1,14 +1,20 @@
 import sys
 import os
 import logging
-import io
+import asyncio
+import contextlib
+import hashlib
+import math
 import tempfile
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, Response
 import uvicorn
+import torch
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -25,8 +31,13 @@ sys.path.append(str(POCKET_TTS_PATH))
 
 try:
     from pocket_tts.models.tts_model import TTSModel
+    from pocket_tts.models.batch_scheduler import BatchScheduler, QueueFullError
     from pocket_tts.default_parameters import DEFAULT_VARIANT
     from pocket_tts.utils.utils import PREDEFINED_VOICES
+    from pocket_tts.utils.audio_cache import AudioCache
+    from pocket_tts.utils.voice_cache import VoiceCache
+    from pocket_tts.utils.supervisor import Supervisor, close_after_each_response, listen_locally, pin_to_cores
+    from pocket_tts.data.audio import stream_wav_bytes
     import pocket_tts
     logger.info(f"Loaded pocket_tts from: {pocket_tts.__file__}")
     logger.info(f"Available predefined voices: {list(PREDEFINED_VOICES.keys())}")
@@ -72,24 +83,77 @@ async def serve_index():
 # Global variables for model
 tts_model = None
 global_model_state = None
+batch_scheduler = None
+
+# Concurrent requests are generated together, up to this many per batch
+MAX_BATCH_SIZE = int(os.environ.get("POCKET_TTS_MAX_BATCH_SIZE", "8"))
+# Requests waiting for a place in the batch beyond this many get a 429 with a Retry-After header
+MAX_QUEUE_DEPTH = int(os.environ.get("POCKET_TTS_MAX_QUEUE_DEPTH", "32"))
+# Set to 1 to quantize the model to int8, which is faster on CPU
+QUANTIZE = os.environ.get("POCKET_TTS_QUANTIZE", "0") == "1"
+# Set to bfloat16 to run the model in bfloat16, which is faster on recent CPUs
+DTYPE = os.environ.get("POCKET_TTS_DTYPE", "float32")
+# Size in MB of the disk cache of rendered audio, identical requests are served from it. 0 disables it
+AUDIO_CACHE_MB = float(os.environ.get("POCKET_TTS_AUDIO_CACHE_MB", "0"))
+# Directory of the audio cache, defaults to the pocket_tts cache directory
+AUDIO_CACHE_DIR = os.environ.get("POCKET_TTS_AUDIO_CACHE_DIR")
+# Directory where the encodings of uploaded voices are kept across restarts, by default they are only kept in memory
+VOICE_CACHE_DIR = os.environ.get("POCKET_TTS_VOICE_CACHE_DIR")
+# Number of server processes when started with `python main.py`, each with its own model pinned to its own CPU cores
+WORKERS = int(os.environ.get("POCKET_TTS_WORKERS", "1"))
 
 def get_model():
     global tts_model
     if tts_model is None:
         logger.info("Loading TTS Model...")
         # Load default variant
-        tts_model = TTSModel.load_model(DEFAULT_VARIANT)
+        tts_model = TTSModel.load_model(DEFAULT_VARIANT, quantize=QUANTIZE, dtype=DTYPE)
+        if VOICE_CACHE_DIR is not None:
+            tts_model.voice_cache = VoiceCache(VOICE_CACHE_DIR)
         logger.info("TTS Model loaded.")
     return tts_model
 
+audio_cache = None
+
+# Loading voices and reading/writing the audio cache block, so they run in this pool instead of the event loop.
+# The generation itself runs in the thread of the batch scheduler.
+blocking_executor = ThreadPoolExecutor(max_workers=4)
+
+async def run_blocking(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, function, *args)
+
+def get_audio_cache():
+    global audio_cache
+    if audio_cache is None and AUDIO_CACHE_MB > 0:
+        audio_cache = AudioCache(cache_dir=AUDIO_CACHE_DIR, max_size_mb=AUDIO_CACHE_MB)
+    return audio_cache
+
+def get_scheduler():
+    global batch_scheduler
+    if batch_scheduler is None:
+        batch_scheduler = BatchScheduler(get_model(), max_batch_size=MAX_BATCH_SIZE, max_queue_depth=MAX_QUEUE_DEPTH)
+    return batch_scheduler
+
+def check_queue(scheduler):
+    # Short texts are served first, so a full queue means the server is overloaded: tell the client when to retry
+    try:
+        scheduler.check_queue()
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+
 @app.on_event("startup")
 async def startup_event():
-    get_model()
+    get_scheduler()
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "model_loaded": tts_model is not None}
 
+@app.get("/stats")
+async def get_stats():
+    """Requests in flight and waiting, and the queue wait and service time percentiles"""
+    return get_scheduler().stats()
+
 @app.get("/voices")
 async def get_voices():
     """Return list of predefined voices + generic ones if any"""
@@ -111,13 +175,45 @@ async def get_voices():
 async def generate_audio(
     text: str = Form(...),
     voice_url: str = Form(None),
-    voice_file: UploadFile = File(None)
+    voice_file: UploadFile = File(None),
+    seed: int = Form(None)
 ):
     if not text:
         raise HTTPException(status_code=400, detail="Text is required")
     
     current_model = get_model()
+    scheduler = get_scheduler()
     
+    # Serve identical requests from the audio cache
+    content = await voice_file.read() if voice_file else None
+    cache = get_audio_cache()
+    cache_key = None
+    if cache is not None:
+        if voice_file:
+            voice_id = f"sha256:{hashlib.sha256(content).hexdigest()}"
+        elif voice_url:
+            voice_id = f"url:{voice_url}"
+        else:
+            voice_id = "url:alba"
+        cache_key = AudioCache.key(
+            text,
+            voice_id,
+            current_model.temp,
+            current_model.lsd_decode_steps,
+            current_model.eos_threshold,
+            seed,
+            current_model._config_signature,
+        )
+        cached_audio = await run_blocking(cache.get, cache_key)
+        if cached_audio is not None:
+            return Response(
+                cached_audio,
+                media_type="audio/wav",
+                headers={
+                    "Content-Disposition": "attachment; filename=generated_speech.wav",
+                }
+            )
+
     # Determine which voice to use
     model_state = None
     
@@ -126,11 +222,10 @@ async def generate_audio(
         try:
             # Save properly to temp file to ensure libsndfile can read it
             with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-                content = await voice_file.read()
                 tmp.write(content)
                 tmp_path = tmp.name
             
-            model_state = current_model.get_state_for_audio_prompt(tmp_path, truncate=True)
+            model_state = await run_blocking(current_model.get_state_for_audio_prompt, tmp_path, True)
             os.unlink(tmp_path) # Cleanup
         except Exception as e:
             logger.error(f"Error processing voice file: {e}")
@@ -141,7 +236,7 @@ async def generate_audio(
         if voice_url in PREDEFINED_VOICES:
              # It's a key
              try:
-                 model_state = current_model._cached_get_state_for_audio_prompt(voice_url, truncate=True)
+                 model_state = await run_blocking(current_model._cached_get_state_for_audio_prompt, voice_url, True)
              except Exception as e:
                  logger.error(f"Error loading preset voice: {e}")
                  raise HTTPException(status_code=500, detail=f"Failed to load preset voice: {str(e)}")
@@ -149,7 +244,7 @@ async def generate_audio(
              # It's a URL
             try:
                 logger.info(f"Fetching voice from URL: {voice_url}")
-                model_state = current_model.get_state_for_audio_prompt(voice_url, truncate=True)
+                model_state = await run_blocking(current_model.get_state_for_audio_prompt, voice_url, True)
             except Exception as e:
                 logger.error(f"Error fetching voice URL: {e}")
                 raise HTTPException(status_code=500, detail=f"Failed to fetch voice: {str(e)}")
@@ -158,7 +253,7 @@ async def generate_audio(
         # Use 'alba' which is a predefined voice key that works without voice cloning weights
         try:
             default_voice = "alba"
-            model_state = current_model._cached_get_state_for_audio_prompt(default_voice, truncate=True)
+            model_state = await run_blocking(current_model._cached_get_state_for_audio_prompt, default_voice, True)
         except Exception as e:
              logger.error(f"Error loading default voice: {e}")
              raise HTTPException(status_code=500, detail=f"Failed to load default voice: {str(e)}")
@@ -167,77 +262,48 @@ async def generate_audio(
          raise HTTPException(status_code=500, detail="Could not initialize voice state")
 
     # Generate Audio Stream
-    def iterpath():
-        try:
-            # generate_audio_stream yields chunks of numpy arrays (or tensors)
-            audio_chunks = model.generate_audio_stream(
-                model_state=model_state,
-                text_to_generate=text
-            )
-            
-            # We need to convert these raw chunks to a streamable wave format or just raw PCM.
-            # However, browsers handle WAV streams better if headers are correct, which is hard for streaming.
-            # An alternative is to just yield raw bytes if the client can handle it, 
-            # BUT: pocket-tts `stream_audio_chunks` is a helper that writes to a file.
-            # Let's look at how their `serve` command does it.
-            # It uses a "FileLikeToQueue" and `yield queue.get()`.
-            # And it sets media_type="audio/wav" with Transfer-Encoding: chunked.
-            
-            # Re-implementing the queue logic from their main.py might be safest.
-            pass
-        except Exception as e:
-            logger.error(f"Generation error: {e}")
-            yield b""
-
-    # Using the exact same logic as their implementation for robustness because Streaming WAV is tricky
-    from queue import Queue
-    import threading
-    from pocket_tts.data.audio import stream_audio_chunks as write_audio_chunks
-    
-    queue = Queue()
-
-    def write_to_queue_wrapper():
-        class FileLikeToQueue(io.IOBase):
-            def __init__(self, q):
-                self.q = q
-            def write(self, data):
-                self.q.put(data)
-            def flush(self):
-                pass
-            def close(self):
-                self.q.put(None)
+    # The scheduler gives the chunks to an async iterator, so waiting for them does not block the
+    # event loop or a thread. If the client reads slowly the stream is paused instead of buffering
+    # the audio, and if it disconnects the generation stops.
+    async def record_in_cache(gen):
+        # Keep the chunks, and store the whole audio once the generation is complete
+        chunks = []
+        async with contextlib.aclosing(gen):
+            async for chunk in gen:
+                chunks.append(chunk)
+                yield chunk
+        if chunks:
+            await run_blocking(cache.put, cache_key, torch.cat(chunks), current_model.config.mimi.sample_rate)
 
+    async def yield_chunks():
+        # Set when the response ends: if the client hung up (or clicked "generate" again) before the end,
+        # the scheduler stops generating this stream at the next step
+        cancel_event = threading.Event()
+        # The scheduler batches this stream with the other requests in flight
+        gen = scheduler.generate_audio_stream_async(
+            model_state=model_state,
+            text_to_generate=text,
+            frames_after_eos=None, # Auto
+            seed=seed, # Same seed, same audio
+            cancel_event=cancel_event,
+        )
+        if cache_key is not None:
+            gen = record_in_cache(gen)
         try:
-            # We must use the model instance to generate stream
-            gen = current_model.generate_audio_stream(
-                model_state=model_state,
-                text_to_generate=text,
-                frames_after_eos=None, # Auto
-                copy_state=True
-            )
-            
-            # Write to our queue wrapper
-            write_audio_chunks(
-                FileLikeToQueue(queue),
-                gen,
-                current_model.config.mimi.sample_rate
-            )
-        except Exception as e:
-            logger.error(f"Streaming error: {e}")
+            async with contextlib.aclosing(gen):
+                async for data in stream_wav_bytes(gen, current_model.config.mimi.sample_rate):
+                    yield data
+        except Exception:
+            # Raised again so that the response is aborted: a client must not take the audio
+            # generated so far for the whole text
+            logger.exception("Streaming error")
+            raise
         finally:
-            queue.put(None) # Signal end
-
-    thread = threading.Thread(target=write_to_queue_wrapper)
-    thread.start()
-
-    def yield_chunks():
-        while True:
-            data = queue.get()
-            if data is None:
-                break
-            yield data
-        thread.join()
+            cancel_event.set()
 
+    # Requests served from the audio cache are never refused. The others are checked here, since the
+    # stream only joins the queue once the response has started
+    check_queue(scheduler)
     return StreamingResponse(
         yield_chunks(),
         media_type="audio/wav",
@@ -246,5 +312,19 @@ async def generate_audio(
         }
     )
 
+def run_worker(cores, ready):
+    # Entry point of the server processes started by the supervisor
+    pin_to_cores(cores)
+    get_scheduler()  # Load the model before taking connections
+    sock = listen_locally()
+    ready.send(sock.getsockname()[1])
+    ready.close()
+    # Each request comes through its own connection, so the supervisor dispatches every request
+    uvicorn.Server(uvicorn.Config(close_after_each_response(app))).run(sockets=[sock])
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    if WORKERS > 1:
+        # The supervisor dispatches the connections to the workers, the audio cache directory is shared by them
+        Supervisor(run_worker, (), WORKERS).run("0.0.0.0", 8000)
+    else:
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
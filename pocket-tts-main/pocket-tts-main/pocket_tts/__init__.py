@@ -11,6 +11,7 @@ from pocket_tts.models.tts_model import TTSModel  # noqa: E402
 # TTSModel.load_model
 # TTSModel.generate_audio
 # TTSModel.generate_audio_stream
+# TTSModel.generate_audio_batch
 # TTSModel.get_state_for_audio_prompt
 
 __all__ = ["TTSModel"]
@@ -1,3 +1,4 @@
+import functools
 import logging
 
 import sentencepiece
@@ -30,9 +31,15 @@ class SentencePieceTokenizer:
         assert nbins == self.sp.vocab_size(), (
             f"sentencepiece tokenizer has vocab size={self.sp.vocab_size()} but nbins={nbins} was specified"
         )
+        # The same texts are tokenized again and again: the whole text and then each of its
+        # chunks, and repeated phrases across requests.
+        self._encode = functools.lru_cache(maxsize=1024)(self._encode_uncached)
+
+    def _encode_uncached(self, text: str) -> tuple[int, ...]:
+        return tuple(self.sp.encode(text, out_type=int))
 
     def __call__(self, text: str) -> TokenizedText:
-        return TokenizedText(torch.tensor(self.sp.encode(text, out_type=int))[None, :])
+        return TokenizedText(torch.tensor(self._encode(text))[None, :])
 
 
 class LUTConditioner(BaseConditioner):
@@ -13,7 +13,7 @@ from typing import Any
 
 import numpy as np
 import torch
-from beartype.typing import Iterator
+from beartype.typing import AsyncIterator, Iterator
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +34,16 @@ def audio_read(filepath: str | Path) -> tuple[torch.Tensor, int]:
         return wav, sample_rate
 
 
+def audio_write(filepath: str | Path, wav: torch.Tensor, sample_rate: int):
+    """Write mono audio to a 16-bit PCM WAV file using Python's wave module."""
+    chunk_int16 = (wav.clamp(-1, 1) * 32767).short()
+    with wave.open(str(filepath), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(chunk_int16.detach().cpu().numpy().tobytes())
+
+
 class StreamingWAVWriter:
     """WAV writer using Python's standard library wave module."""
 
@@ -52,6 +62,9 @@ class StreamingWAVWriter:
         self.wave_writer.setsampwidth(2)  # 16-bit
         self.wave_writer.setframerate(sample_rate)
         self.wave_writer.setnframes(1_000_000_000)
+        # Do not update the header for unseekable streams, even if the writer is never
+        # finalized because the stream was interrupted.
+        self.wave_writer._patchheader = lambda: None
 
     def write_pcm_data(self, audio_chunk: torch.Tensor):
         """Write PCM data using wave module."""
@@ -89,11 +102,42 @@ class StreamingWAVWriter:
         self.wave_writer.writeframesraw(bytes(num_silence_samples * 2))
 
         if self.wave_writer:
-            # do not update the header for unseekable streams
-            self.wave_writer._patchheader = lambda: None
             self.wave_writer.close()
 
 
+class _BytesSink:
+    """File-like object collecting the bytes written by a `StreamingWAVWriter`."""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        """Returns the bytes written since the last call."""
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+async def stream_wav_bytes(audio_chunks: AsyncIterator[torch.Tensor], sample_rate: int):
+    """Encodes asynchronously generated audio chunks as a streamed WAV file, yielding bytes."""
+    sink = _BytesSink()
+    writer = StreamingWAVWriter(sink, sample_rate)
+    writer.write_header(sample_rate)
+    async for chunk in audio_chunks:
+        writer.write_pcm_data(chunk)
+        data = sink.take()
+        if data:
+            yield data
+    writer.finalize()
+    yield sink.take()
+
+
 def is_file_like(obj):
     """Check if object has basic file-like methods."""
     return all(hasattr(obj, attr) for attr in ["write", "close"])
@@ -1,19 +1,28 @@
-import io
+import asyncio
+import contextlib
+import csv
+import hashlib
+import importlib.metadata
+import json
 import logging
+import math
+import multiprocessing
 import os
 import tempfile
 import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from queue import Queue
 
+import torch
 import typer
 import uvicorn
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from typing_extensions import Annotated
 
-from pocket_tts.data.audio import stream_audio_chunks
+from pocket_tts.data.audio import audio_write, stream_audio_chunks, stream_wav_bytes
 from pocket_tts.default_parameters import (
     DEFAULT_AUDIO_PROMPT,
     DEFAULT_EOS_THRESHOLD,
@@ -23,9 +32,19 @@ from pocket_tts.default_parameters import (
     DEFAULT_TEMPERATURE,
     DEFAULT_VARIANT,
 )
+from pocket_tts.models.batch_scheduler import BatchScheduler, QueueFullError
 from pocket_tts.models.tts_model import TTSModel
+from pocket_tts.utils.audio_cache import AudioCache
+from pocket_tts.utils.benchmark import WORKLOADS, run_benchmark
 from pocket_tts.utils.logging_utils import enable_logging
+from pocket_tts.utils.supervisor import (
+    Supervisor,
+    close_after_each_response,
+    listen_locally,
+    pin_to_cores,
+)
 from pocket_tts.utils.utils import PREDEFINED_VOICES, size_of_dict
+from pocket_tts.utils.voice_cache import VoiceCache
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +60,15 @@ cli_app = typer.Typer(
 # Global model instance
 tts_model = None
 global_model_state = None
+# Batches the generation of concurrent requests together
+batch_scheduler = None
+# Voice prompt of `global_model_state`
+global_voice = None
+# Renderings of previous requests, served again for identical requests. None if disabled.
+audio_cache = None
+# Blocking work of the requests, like loading voice prompts, runs in this pool rather than in
+# the event loop. The generation itself runs in the thread of the batch scheduler.
+blocking_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pocket-tts-io")
 
 web_app = FastAPI(
     title="Kyutai Pocket TTS API", description="Text-to-Speech generation API", version="1.0.0"
@@ -70,52 +98,94 @@ async def health():
     return {"status": "healthy"}
 
 
-def write_to_queue(queue, text_to_generate, model_state):
-    """Allows writing to the StreamingResponse as if it were a file."""
-
-    class FileLikeToQueue(io.IOBase):
-        def __init__(self, queue):
-            self.queue = queue
+@web_app.get("/stats")
+async def stats():
+    """Load of the server, and queue waits and service times of the recent requests."""
+    return batch_scheduler.stats()
 
-        def write(self, data):
-            self.queue.put(data)
 
-        def flush(self):
-            pass
+def too_many_requests(error: QueueFullError) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=str(error),
+        headers={"Retry-After": str(math.ceil(error.retry_after))},
+    )
 
-        def close(self):
-            self.queue.put(None)
 
-    audio_chunks = tts_model.generate_audio_stream(
-        model_state=model_state, text_to_generate=text_to_generate
+def audio_cache_key(text: str, voice: str, seed: int | None) -> str:
+    return AudioCache.key(
+        text,
+        voice,
+        tts_model.temp,
+        tts_model.lsd_decode_steps,
+        tts_model.eos_threshold,
+        seed,
+        tts_model._config_signature,
     )
-    stream_audio_chunks(FileLikeToQueue(queue), audio_chunks, tts_model.config.mimi.sample_rate)
 
 
-def generate_data_with_state(text_to_generate: str, model_state: dict):
-    queue = Queue()
+async def run_blocking(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, function, *args)
+
+
+async def record_in_audio_cache(audio_chunks, cache_key: str):
+    """Yields the audio chunks, then stores the whole audio in the cache once it is complete."""
+    chunks = []
+    async with contextlib.aclosing(audio_chunks):
+        async for chunk in audio_chunks:
+            chunks.append(chunk)
+            yield chunk
+    if chunks:
+        await run_blocking(
+            audio_cache.put, cache_key, torch.cat(chunks), tts_model.config.mimi.sample_rate
+        )
+
+
+async def generate_wav_stream(
+    text_to_generate: str, model_state: dict, seed: int | None = None, cache_key=None
+):
+    """Yields the bytes of the WAV file of a text, generated by the batch scheduler.
 
-    # Run your function in a thread
-    thread = threading.Thread(target=write_to_queue, args=(queue, text_to_generate, model_state))
-    thread.start()
+    The scheduler pauses the stream while the client reads slower than the audio is
+    generated, and closing this generator, e.g. when the client disconnects, stops the
+    generation.
+    """
+    cancel_event = threading.Event()
+    audio_chunks = batch_scheduler.generate_audio_stream_async(
+        model_state=model_state,
+        text_to_generate=text_to_generate,
+        seed=seed,
+        cancel_event=cancel_event,
+    )
+    if cache_key is not None:
+        audio_chunks = record_in_audio_cache(audio_chunks, cache_key)
+    try:
+        async with contextlib.aclosing(audio_chunks):
+            async for data in stream_wav_bytes(audio_chunks, tts_model.config.mimi.sample_rate):
+                yield data
+    finally:
+        # Nothing left to generate if the response is complete, otherwise the client is
+        # gone: the stream leaves the batch at the next step.
+        cancel_event.set()
 
-    # Yield data as it becomes available
-    i = 0
-    while True:
-        data = queue.get()
-        if data is None:
-            break
-        i += 1
-        yield data
 
-    thread.join()
+def get_state_for_uploaded_voice(content: bytes) -> dict:
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
+        temp_file.write(content)
+        temp_file.flush()
+
+        try:
+            return tts_model.get_state_for_audio_prompt(Path(temp_file.name), truncate=True)
+        finally:
+            os.unlink(temp_file.name)
 
 
 @web_app.post("/tts")
-def text_to_speech(
+async def text_to_speech(
     text: str = Form(...),
     voice_url: str | None = Form(None),
     voice_wav: UploadFile | None = File(None),
+    seed: int | None = Form(None),
 ):
     """
     Generate speech from text using the pre-loaded voice prompt or a custom voice.
@@ -124,6 +194,8 @@ def text_to_speech(
         text: Text to convert to speech
         voice_url: Optional voice URL (http://, https://, or hf://)
         voice_wav: Optional uploaded voice file (mutually exclusive with voice_url)
+        seed: Optional seed of the sampling, the same request with the same seed gives
+            the same audio
     """
     if not text.strip():
         raise HTTPException(status_code=400, detail="Text cannot be empty")
@@ -131,6 +203,25 @@ def text_to_speech(
     if voice_url is not None and voice_wav is not None:
         raise HTTPException(status_code=400, detail="Cannot provide both voice_url and voice_wav")
 
+    voice_content = await voice_wav.read() if voice_wav is not None else None
+    cache_key = None
+    if audio_cache is not None:
+        if voice_url is not None:
+            voice = f"url:{voice_url}"
+        elif voice_content is not None:
+            voice = f"sha256:{hashlib.sha256(voice_content).hexdigest()}"
+        else:
+            voice = f"default:{global_voice}"
+        cache_key = audio_cache_key(text, voice, seed)
+        content = await run_blocking(audio_cache.get, cache_key)
+        if content is not None:
+            # The whole file is known, so it is sent with its length rather than chunked.
+            return Response(
+                content,
+                media_type="audio/wav",
+                headers={"Content-Disposition": "attachment; filename=generated_speech.wav"},
+            )
+
     # Use the appropriate model state
     if voice_url is not None:
         if not (
@@ -142,27 +233,26 @@ def text_to_speech(
             raise HTTPException(
                 status_code=400, detail="voice_url must start with http://, https://, or hf://"
             )
-        model_state = tts_model._cached_get_state_for_audio_prompt(voice_url, truncate=True)
+        model_state = await run_blocking(
+            tts_model._cached_get_state_for_audio_prompt, voice_url, True
+        )
         logging.warning("Using voice from URL: %s", voice_url)
     elif voice_wav is not None:
         # Use uploaded voice file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
-            content = voice_wav.file.read()
-            temp_file.write(content)
-            temp_file.flush()
-
-            try:
-                model_state = tts_model.get_state_for_audio_prompt(
-                    Path(temp_file.name), truncate=True
-                )
-            finally:
-                os.unlink(temp_file.name)
+        model_state = await run_blocking(get_state_for_uploaded_voice, voice_content)
     else:
         # Use default global model state
         model_state = global_model_state
 
+    try:
+        # Requests served from the audio cache are never refused. The others are checked
+        # here, since the stream is only submitted once the headers of the response are
+        # sent, too late to refuse it.
+        batch_scheduler.check_queue()
+    except QueueFullError as e:
+        raise too_many_requests(e)
     return StreamingResponse(
-        generate_data_with_state(text, model_state),
+        generate_wav_stream(text, model_state, seed, cache_key),
         media_type="audio/wav",
         headers={
             "Content-Disposition": "attachment; filename=generated_speech.wav",
@@ -179,17 +269,92 @@ def serve(
     host: Annotated[str, typer.Option(help="Host to bind to")] = "localhost",
     port: Annotated[int, typer.Option(help="Port to bind to")] = 8000,
     reload: Annotated[bool, typer.Option(help="Enable auto-reload")] = False,
+    max_batch_size: Annotated[
+        int, typer.Option(help="Maximum number of requests generated together in one batch")
+    ] = 8,
+    quantize: Annotated[
+        bool, typer.Option(help="Quantize the model to int8 for faster generation on CPU")
+    ] = False,
+    dtype: Annotated[
+        str, typer.Option(help="Dtype of the model, float32 or bfloat16 (faster on recent CPUs)")
+    ] = "float32",
+    max_queue_depth: Annotated[
+        int,
+        typer.Option(help="Maximum number of requests waiting for a batch row, others get a 429"),
+    ] = 32,
+    audio_cache_mb: Annotated[
+        float, typer.Option(help="Size of the disk cache of rendered audio in MB, 0 to disable")
+    ] = 0,
+    voice_cache_dir: Annotated[
+        str | None,
+        typer.Option(
+            help="Directory where the encodings of uploaded voices are kept across restarts"
+        ),
+    ] = None,
+    workers: Annotated[
+        int,
+        typer.Option(
+            help="Number of server processes, each with its own model and CPU cores",
+            envvar="POCKET_TTS_WORKERS",
+        ),
+    ] = 1,
 ):
     """Start the FastAPI server."""
+    server_kwargs = dict(
+        voice=voice,
+        max_batch_size=max_batch_size,
+        quantize=quantize,
+        dtype=dtype,
+        max_queue_depth=max_queue_depth,
+        audio_cache_mb=audio_cache_mb,
+        voice_cache_dir=voice_cache_dir,
+    )
+    if workers > 1:
+        if reload:
+            raise typer.BadParameter("--reload cannot be used with several workers")
+        with enable_logging("pocket_tts", logging.INFO):
+            supervisor = Supervisor(_run_server_worker, (server_kwargs, logging.INFO), workers)
+            supervisor.run(host, port)
+        return
+
+    _load_server(**server_kwargs)
+    uvicorn.run("pocket_tts.main:web_app", host=host, port=port, reload=reload)
 
-    global tts_model, global_model_state
-    tts_model = TTSModel.load_model(DEFAULT_VARIANT)
+
+def _load_server(
+    voice: str,
+    max_batch_size: int,
+    quantize: bool,
+    dtype: str,
+    max_queue_depth: int,
+    audio_cache_mb: float,
+    voice_cache_dir: str | None,
+):
+    global tts_model, global_model_state, batch_scheduler, global_voice, audio_cache
+    tts_model = TTSModel.load_model(DEFAULT_VARIANT, quantize=quantize, dtype=dtype)
+    if voice_cache_dir is not None:
+        tts_model.voice_cache = VoiceCache(voice_cache_dir)
+    batch_scheduler = BatchScheduler(
+        tts_model, max_batch_size=max_batch_size, max_queue_depth=max_queue_depth
+    )
+    global_voice = voice
+    if audio_cache_mb > 0:
+        audio_cache = AudioCache(max_size_mb=audio_cache_mb)
 
     # Pre-load the voice prompt
     global_model_state = tts_model.get_state_for_audio_prompt(voice)
     logger.info(f"The size of the model state is {size_of_dict(global_model_state) // 1e6} MB")
 
-    uvicorn.run("pocket_tts.main:web_app", host=host, port=port, reload=reload)
+
+def _run_server_worker(cores: list[int], ready, server_kwargs: dict, log_level: int):
+    """Entry point of the processes of `serve --workers`, started by the `Supervisor`."""
+    logging.basicConfig(level=log_level, format="%(levelname)s: %(message)s")
+    pin_to_cores(cores)
+    _load_server(**server_kwargs)
+    sock = listen_locally()
+    ready.send(sock.getsockname()[1])
+    ready.close()
+    uvicorn.Server(uvicorn.Config(close_after_each_response(web_app))).run(sockets=[sock])
 
 
 # ------------------------------------------------------
@@ -218,10 +383,25 @@ def generate(
     frames_after_eos: Annotated[
         int, typer.Option(help="Number of frames to generate after EOS")
     ] = DEFAULT_FRAMES_AFTER_EOS,
+    long_form: Annotated[
+        bool, typer.Option(help="Generate each sentence as the continuation of the previous one")
+    ] = False,
+    seed: Annotated[
+        int | None, typer.Option(help="Seed of the sampling, for reproducible outputs")
+    ] = None,
     output_path: Annotated[
         str, typer.Option(help="Output path for generated audio")
     ] = "./tts_output.wav",
     device: Annotated[str, typer.Option(help="Device to use")] = "cpu",
+    quantize: Annotated[
+        bool, typer.Option(help="Quantize the model to int8 for faster generation on CPU")
+    ] = False,
+    dtype: Annotated[
+        str, typer.Option(help="Dtype of the model, float32 or bfloat16 (faster on recent CPUs)")
+    ] = "float32",
+    compile: Annotated[
+        bool, typer.Option(help="Compile the generation step with torch.compile, slower to load")
+    ] = False,
 ):
     """Generate speech using Kyutai Pocket TTS."""
     if "cuda" in device:
@@ -231,7 +411,14 @@ def generate(
     log_level = logging.ERROR if quiet else logging.INFO
     with enable_logging("pocket_tts", log_level):
         tts_model = TTSModel.load_model(
-            variant, temperature, lsd_decode_steps, noise_clamp, eos_threshold
+            variant,
+            temperature,
+            lsd_decode_steps,
+            noise_clamp,
+            eos_threshold,
+            quantize,
+            dtype,
+            compile,
         )
         tts_model.to(device)
 
@@ -241,6 +428,8 @@ def generate(
             model_state=model_state_for_voice,
             text_to_generate=text,
             frames_after_eos=frames_after_eos,
+            long_form=long_form,
+            seed=seed,
         )
 
         stream_audio_chunks(output_path, audio_chunks, tts_model.config.mimi.sample_rate)
@@ -253,5 +442,335 @@ def generate(
         )
 
 
+# ------------------------------------------------------
+# The pocket-tts bulk generation CLI implementation
+# ------------------------------------------------------
+
+# Model of the current worker process of the `batch` command
+_batch_worker_model = None
+_batch_worker_voice_states = {}
+
+
+def read_manifest(manifest_path: str | Path) -> list[dict]:
+    """Reads the rows of a JSONL or CSV manifest with `id`, `text` and optional `voice` fields."""
+    manifest_path = Path(manifest_path)
+    with open(manifest_path, newline="") as f:
+        if manifest_path.suffix.lower() == ".csv":
+            raw_rows = list(csv.DictReader(f))
+        else:
+            raw_rows = [json.loads(line) for line in f if line.strip()]
+
+    rows = []
+    seen_ids = set()
+    for line_number, raw_row in enumerate(raw_rows, start=1):
+        row_id = str(raw_row.get("id") or "").strip()
+        text = raw_row.get("text") or ""
+        if not row_id or not text.strip():
+            raise ValueError(f"Row {line_number} of {manifest_path} needs an id and a text.")
+        if "/" in row_id or "\\" in row_id or row_id in (".", ".."):
+            raise ValueError(f"Row {line_number} of {manifest_path} has an invalid id: {row_id}")
+        if row_id in seen_ids:
+            raise ValueError(f"Row {line_number} of {manifest_path} has a duplicate id: {row_id}")
+        seen_ids.add(row_id)
+        rows.append(
+            {"id": row_id, "text": text, "voice": raw_row.get("voice") or DEFAULT_AUDIO_PROMPT}
+        )
+    return rows
+
+
+def _init_batch_worker(num_threads: int, model_kwargs: dict, log_level: int):
+    global _batch_worker_model
+    logging.basicConfig(level=log_level, format="%(levelname)s: %(message)s")
+    torch.set_num_threads(num_threads)
+    _batch_worker_model = TTSModel.load_model(**model_kwargs)
+
+
+def _batch_error_result(row: dict, error: BaseException) -> dict:
+    return {"id": row["id"], "error": f"{type(error).__name__}: {error}"}
+
+
+def _generate_batch_rows(
+    rows: list[dict], output_dir: str, frames_after_eos: int | None, seed: int | None
+):
+    """Generates the rows in the current worker process, returns their results.
+
+    Rows whose voice cannot be loaded get an error result, the others are still generated.
+    """
+    model = _batch_worker_model
+    results = []
+    model_states = []
+    rows_to_generate = []
+    for row in rows:
+        try:
+            if row["voice"] not in _batch_worker_voice_states:
+                _batch_worker_voice_states[row["voice"]] = model.get_state_for_audio_prompt(
+                    row["voice"], truncate=True
+                )
+        except Exception as e:
+            logger.error("Cannot load the voice %s of row %s: %s", row["voice"], row["id"], e)
+            results.append(_batch_error_result(row, e))
+            continue
+        model_states.append(_batch_worker_voice_states[row["voice"]])
+        rows_to_generate.append(row)
+    if not rows_to_generate:
+        return results
+    rows = rows_to_generate
+
+    t_generating = time.monotonic()
+    audios = model.generate_audio_batch(
+        model_states,
+        [row["text"] for row in rows],
+        frames_after_eos=frames_after_eos,
+        seeds=[seed] * len(rows),
+    )
+    generation_time = time.monotonic() - t_generating
+    batch_duration = sum(audio.shape[-1] for audio in audios) / model.sample_rate
+
+    for row, audio in zip(rows, audios):
+        output_path = Path(output_dir) / f"{row['id']}.wav"
+        # Write to a temporary file first so that interrupted runs never leave
+        # a partial file that would be skipped when resuming.
+        temp_path = output_path.with_suffix(".wav.tmp")
+        audio_write(temp_path, audio, model.sample_rate)
+        os.replace(temp_path, output_path)
+        results.append(
+            {
+                "id": row["id"],
+                "path": str(output_path),
+                "duration_s": round(audio.shape[-1] / model.sample_rate, 3),
+                # Rows of a batch are generated together, so they share the same timing.
+                "generation_time_s": round(generation_time, 3),
+                "rtf": round(batch_duration / generation_time, 3),
+                "batch_size": len(rows),
+                "worker_pid": os.getpid(),
+            }
+        )
+    return results
+
+
+@cli_app.command()
+def batch(
+    manifest: Annotated[
+        str, typer.Option(help="JSONL or CSV file with `id`, `text` and optional `voice` fields")
+    ],
+    output_dir: Annotated[
+        str, typer.Option(help="Directory where the WAV files and results are written")
+    ] = "./tts_outputs",
+    num_workers: Annotated[int, typer.Option(help="Number of worker processes")] = 1,
+    threads_per_worker: Annotated[
+        int | None,
+        typer.Option(help="Torch threads per worker (default: CPU cores split between workers)"),
+    ] = None,
+    batch_size: Annotated[
+        int, typer.Option(help="Number of rows generated together by a worker")
+    ] = 1,
+    quiet: Annotated[bool, typer.Option("-q", "--quiet", help="Disable logging output")] = False,
+    variant: Annotated[str, typer.Option(help="Model signature")] = DEFAULT_VARIANT,
+    lsd_decode_steps: Annotated[
+        int, typer.Option(help="Number of generation steps")
+    ] = DEFAULT_LSD_DECODE_STEPS,
+    temperature: Annotated[
+        float, typer.Option(help="Temperature for generation")
+    ] = DEFAULT_TEMPERATURE,
+    noise_clamp: Annotated[float, typer.Option(help="Noise clamp value")] = DEFAULT_NOISE_CLAMP,
+    eos_threshold: Annotated[float, typer.Option(help="EOS threshold")] = DEFAULT_EOS_THRESHOLD,
+    frames_after_eos: Annotated[
+        int, typer.Option(help="Number of frames to generate after EOS")
+    ] = DEFAULT_FRAMES_AFTER_EOS,
+    seed: Annotated[
+        int | None, typer.Option(help="Seed of the sampling of every row, for reproducible outputs")
+    ] = None,
+    quantize: Annotated[
+        bool, typer.Option(help="Quantize the model to int8 for faster generation on CPU")
+    ] = False,
+    dtype: Annotated[
+        str, typer.Option(help="Dtype of the model, float32 or bfloat16 (faster on recent CPUs)")
+    ] = "float32",
+):
+    """Generate one WAV file per row of a manifest, with several worker processes.
+
+    Rows whose WAV file already exists in the output directory are skipped, so an
+    interrupted run can be resumed by running the same command again. Rows that fail get
+    an error in the results, without stopping the others, and the command exits with 1.
+    """
+    log_level = logging.ERROR if quiet else logging.INFO
+    with enable_logging("pocket_tts", log_level):
+        rows = read_manifest(manifest)
+        output_path = Path(output_dir)
+        output_path.mkdir(parents=True, exist_ok=True)
+        pending = [row for row in rows if not (output_path / f"{row['id']}.wav").exists()]
+        logger.info(
+            "%d rows in the manifest, %d already generated, %d to generate",
+            len(rows),
+            len(rows) - len(pending),
+            len(pending),
+        )
+        if not pending:
+            return
+
+        num_workers = max(1, min(num_workers, len(pending)))
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+        model_kwargs = dict(
+            variant=variant,
+            temp=temperature,
+            lsd_decode_steps=lsd_decode_steps,
+            noise_clamp=noise_clamp,
+            eos_threshold=eos_threshold,
+            quantize=quantize,
+            dtype=dtype,
+        )
+        groups = [pending[i : i + batch_size] for i in range(0, len(pending), batch_size)]
+
+        t_start = time.monotonic()
+        total_duration = 0.0
+        with (
+            ProcessPoolExecutor(
+                max_workers=num_workers,
+                # Forking a process using torch threads is not safe.
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_batch_worker,
+                initargs=(threads_per_worker, model_kwargs, log_level),
+            ) as executor,
+            open(output_path / "results.jsonl", "a") as results_file,
+        ):
+            futures = {
+                executor.submit(
+                    _generate_batch_rows, group, str(output_path), frames_after_eos, seed
+                ): group
+                for group in groups
+            }
+            num_failed = 0
+            for future in as_completed(futures):
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # A failing group, or a worker that died, does not stop the other groups.
+                    group = futures[future]
+                    logger.error("Rows %s failed: %s", ", ".join(row["id"] for row in group), e)
+                    results = [_batch_error_result(row, e) for row in group]
+                for result in results:
+                    results_file.write(json.dumps(result) + "\n")
+                    if "error" in result:
+                        num_failed += 1
+                    else:
+                        total_duration += result["duration_s"]
+                results_file.flush()
+
+        wall_time = time.monotonic() - t_start
+        logger.info(
+            "Generated %d files, %.1f s of audio in %.1f s (%.2f audio seconds per second)",
+            len(pending) - num_failed,
+            total_duration,
+            wall_time,
+            total_duration / wall_time,
+        )
+        logger.info("Results written in %s", output_path / "results.jsonl")
+        if num_failed:
+            logger.error(
+                "%d rows failed, running the same command again generates them again", num_failed
+            )
+            raise typer.Exit(code=1)
+
+
+# ------------------------------------------------------
+# The pocket-tts benchmark CLI implementation
+# ------------------------------------------------------
+
+
+@cli_app.command()
+def bench(
+    workloads: Annotated[
+        str, typer.Option(help=f"Comma-separated workloads to run, among {', '.join(WORKLOADS)}")
+    ] = ",".join(WORKLOADS),
+    concurrency: Annotated[
+        int, typer.Option(help="Number of simultaneous requests of the concurrent workload")
+    ] = 4,
+    repeats: Annotated[int, typer.Option(help="Number of times each workload is run")] = 1,
+    warmup: Annotated[bool, typer.Option(help="Generate a short text before measuring")] = True,
+    output_path: Annotated[
+        str, typer.Option(help="Path of the JSON report, or - for stdout")
+    ] = "-",
+    voice: Annotated[
+        str, typer.Option(help="Path to audio conditioning file (voice to clone)")
+    ] = DEFAULT_AUDIO_PROMPT,
+    quiet: Annotated[bool, typer.Option("-q", "--quiet", help="Disable logging output")] = False,
+    variant: Annotated[str, typer.Option(help="Model signature")] = DEFAULT_VARIANT,
+    lsd_decode_steps: Annotated[
+        int, typer.Option(help="Number of generation steps")
+    ] = DEFAULT_LSD_DECODE_STEPS,
+    temperature: Annotated[
+        float, typer.Option(help="Temperature for generation")
+    ] = DEFAULT_TEMPERATURE,
+    noise_clamp: Annotated[float, typer.Option(help="Noise clamp value")] = DEFAULT_NOISE_CLAMP,
+    eos_threshold: Annotated[float, typer.Option(help="EOS threshold")] = DEFAULT_EOS_THRESHOLD,
+    device: Annotated[str, typer.Option(help="Device to use")] = "cpu",
+    quantize: Annotated[
+        bool, typer.Option(help="Quantize the model to int8 for faster generation on CPU")
+    ] = False,
+    dtype: Annotated[
+        str, typer.Option(help="Dtype of the model, float32 or bfloat16 (faster on recent CPUs)")
+    ] = "float32",
+    compile: Annotated[
+        bool, typer.Option(help="Compile the generation step with torch.compile, slower to load")
+    ] = False,
+):
+    """Measure the speed of the model on fixed workloads and write a JSON report."""
+    selected = [workload.strip() for workload in workloads.split(",") if workload.strip()]
+    unknown = [workload for workload in selected if workload not in WORKLOADS]
+    if unknown:
+        raise typer.BadParameter(f"Unknown workloads {unknown}, choose among {WORKLOADS}")
+    if "cuda" in device:
+        # Cuda graphs capturing does not play nice with multithreading.
+        os.environ["NO_CUDA_GRAPH"] = "1"
+
+    log_level = logging.ERROR if quiet else logging.WARNING
+    with enable_logging("pocket_tts", log_level):
+        t_load = time.monotonic()
+        tts_model = TTSModel.load_model(
+            variant,
+            temperature,
+            lsd_decode_steps,
+            noise_clamp,
+            eos_threshold,
+            quantize,
+            dtype,
+            compile,
+        )
+        tts_model.to(device)
+        load_time = time.monotonic() - t_load
+        model_state = tts_model.get_state_for_audio_prompt(voice)
+
+        results = run_benchmark(
+            tts_model,
+            model_state,
+            selected,
+            repeats=repeats,
+            concurrency=concurrency,
+            warmup=warmup,
+        )
+
+    report = dict(
+        pocket_tts_version=importlib.metadata.version("pocket-tts"),
+        torch_version=torch.__version__,
+        torch_threads=torch.get_num_threads(),
+        device=device,
+        variant=variant,
+        voice=voice,
+        lsd_decode_steps=lsd_decode_steps,
+        temperature=temperature,
+        quantize=quantize,
+        dtype=dtype,
+        compile=compile,
+        load_time_s=round(load_time, 3),
+        workloads=results,
+    )
+    report_json = json.dumps(report, indent=2)
+    if output_path == "-":
+        print(report_json)
+    else:
+        Path(output_path).write_text(report_json + "\n")
+
+
 if __name__ == "__main__":
     cli_app()
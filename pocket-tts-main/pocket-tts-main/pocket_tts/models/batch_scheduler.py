@@ -0,0 +1,591 @@
+"""Continuous batching of concurrent generation requests.
+
+All the streams being generated share one batched FlowLM state and one batched Mimi
+state. A single worker thread advances every active stream by one autoregressive step
+with one forward pass, so that concurrent requests share the matmuls instead of
+competing for the same cores. Streams join the batch as soon as a row is free and leave
+it as soon as they are done, without waiting for the other streams.
+
+Streams whose consumer falls behind leave the batch until it catches up, and streams
+whose consumer is gone are dropped at the next step, so that slow or disconnected
+clients neither grow the memory nor use the cores of the others.
+
+Streams waiting for a row are served by length: the shortest texts first, within the limit
+of their arrival times, see `BatchScheduler`. Past a maximum number of waiting streams, new
+ones are rejected with `QueueFullError` rather than all of them getting slower.
+"""
+
+import asyncio
+import collections
+import itertools
+import logging
+import math
+import queue
+import statistics
+import threading
+import time
+
+import torch
+
+from pocket_tts.models.tts_model import (
+    TTSModel,
+    chunk_generators,
+    prepare_text_prompt,
+    split_into_best_sentences,
+)
+from pocket_tts.modules.stateful_module import (
+    copy_state_rows,
+    init_states,
+    narrow_states,
+    restore_states,
+    snapshot_states,
+)
+
+logger = logging.getLogger(__name__)
+
+# Rough duration of the speech of a word, to order the waiting streams by their length.
+SECONDS_PER_WORD = 0.4
+# Order of the entries of the pending queue: streams coming back to the batch after a pause
+# or a cancellation, new streams, then the request to stop.
+_RETURNING, _NEW, _STOP = 0, 1, 2
+
+
+class QueueFullError(RuntimeError):
+    """Raised when a stream is submitted while `max_queue_depth` streams wait for a row.
+
+    `retry_after` is the estimated time in seconds for the streams waiting to be admitted.
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too many requests waiting, retry in {math.ceil(retry_after)} s")
+        self.retry_after = retry_after
+
+
+class _Stream:
+    """A generation request, made of one or more text chunks generated one after another."""
+
+    def __init__(
+        self,
+        model_state: dict,
+        chunks: list[tuple[str, int, torch.Generator | None]],
+        cancel_event: threading.Event | None = None,
+        notify=None,
+    ):
+        self.model_state = model_state
+        self.chunks = collections.deque(chunks)
+        # Messages to the consumer. Its size is bounded by pausing the stream, not by the
+        # queue itself, so that the worker thread never blocks on a slow consumer.
+        self.output = queue.Queue()
+        # Called after each message, e.g. to wake up an event loop.
+        self.notify = notify
+        # Protects `paused`, which is set by both the worker and the consumer.
+        self.lock = threading.Lock()
+        self.paused = False
+        self.cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        # Rows of the states and latent of a paused stream, to resume it.
+        self.paused_state = None
+        self.start_time = time.monotonic()
+        self.admitted_time = None
+        self.generated_samples = 0
+        self.failed = False
+        # Progress of the chunk being generated.
+        self.step = 0
+        self.eos_step = None
+        self.frames_after_eos = 0
+        self.max_gen_len = 0
+        self.generator = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def put(self, kind: str, value):
+        self.output.put((kind, value))
+        if self.notify is not None:
+            self.notify()
+
+
+class BatchScheduler:
+    """Generates several audio streams at once with a single model.
+
+    The voice states given to `generate_audio_stream` are only read, so the same state
+    can be shared by any number of concurrent requests without being copied.
+
+    Args:
+        tts_model: The model used for generation. It should not be used for generation
+            by other threads while the scheduler is running.
+        max_batch_size: Maximum number of streams generated together. Additional requests
+            wait until a row of the batch is free.
+        sequence_length: Capacity of the FlowLM cache of each row, in steps. It must be
+            larger than the voice prompts; past it, the oldest positions after the voice
+            prompt are overwritten.
+        max_buffered_frames: Number of audio frames of 80 ms a stream can be ahead of its
+            consumer. Past it, the stream leaves the batch, keeping a copy of its state,
+            and it joins it again once the consumer has read half of them.
+        max_queue_depth: Maximum number of streams waiting for a row. Past it, new streams
+            raise `QueueFullError` when iterated, so that an overloaded server fails fast
+            instead of slowing down every stream. If None, there is no limit.
+
+    When the batch is full, waiting streams are admitted by their arrival time plus the
+    duration of their text: short texts go first, but a text is never overtaken by texts
+    that arrived more than its duration after it. Queue waits and service times of recent
+    streams are reported by `stats`.
+    """
+
+    def __init__(
+        self,
+        tts_model: TTSModel,
+        max_batch_size: int = 8,
+        sequence_length: int = 1000,
+        max_buffered_frames: int = 25,
+        max_queue_depth: int | None = None,
+    ):
+        self.tts_model = tts_model
+        self.max_batch_size = max_batch_size
+        self.sequence_length = sequence_length
+        self.max_buffered_frames = max_buffered_frames
+        self.max_queue_depth = max_queue_depth
+        self._pending = queue.PriorityQueue()
+        # Breaks the ties of the pending queue, whose streams cannot be compared.
+        self._sequence = itertools.count()
+        self._stats_lock = threading.Lock()
+        self._num_queued = 0
+        self._num_active = 0
+        self._num_rejected = 0
+        self._num_completed = 0
+        # Queue wait and service time of the last streams done, in seconds.
+        self._recent_times = collections.deque(maxlen=256)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops the worker thread once the streams already submitted are done."""
+        self._put_pending(_STOP, 0.0, None)
+        self._thread.join()
+
+    def stats(self) -> dict:
+        """Load of the scheduler and percentiles of the times of the recent streams.
+
+        `queue_wait_s` is the time from the submission of a stream to its admission in the
+        batch, `service_s` the time from its admission to its end.
+        """
+        with self._stats_lock:
+            queue_waits = sorted(queue_wait for queue_wait, _ in self._recent_times)
+            service_times = sorted(service_time for _, service_time in self._recent_times)
+            return dict(
+                max_batch_size=self.max_batch_size,
+                max_queue_depth=self.max_queue_depth,
+                active=self._num_active,
+                queued=self._num_queued,
+                completed=self._num_completed,
+                rejected=self._num_rejected,
+                queue_wait_s=dict(
+                    p50=_percentile(queue_waits, 50), p95=_percentile(queue_waits, 95)
+                ),
+                service_s=dict(
+                    p50=_percentile(service_times, 50), p95=_percentile(service_times, 95)
+                ),
+            )
+
+    def check_queue(self):
+        """Raises `QueueFullError` if a stream submitted now would be rejected.
+
+        It allows callers to fail before doing any work for a request, e.g. loading a voice.
+        """
+        with self._stats_lock:
+            self._check_queue_locked()
+
+    def _check_queue_locked(self):
+        if self.max_queue_depth is not None and self._num_queued >= self.max_queue_depth:
+            self._num_rejected += 1
+            raise QueueFullError(self._retry_after())
+
+    def _put_pending(self, rank: int, deadline: float, stream: _Stream | None):
+        self._pending.put((rank, deadline, next(self._sequence), stream))
+
+    def _retry_after(self) -> float:
+        """Estimated time for the waiting streams to be admitted."""
+        service_times = [service_time for _, service_time in self._recent_times]
+        # Before any stream is done, the service time of a sentence is a guess.
+        mean_service_time = statistics.mean(service_times) if service_times else 5.0
+        return max(1.0, self._num_queued * mean_service_time / self.max_batch_size)
+
+    def _submit(
+        self,
+        model_state: dict,
+        text_to_generate: str,
+        frames_after_eos: int | None,
+        seed: int | None,
+        cancel_event: threading.Event | None,
+        notify=None,
+    ) -> _Stream:
+        text_chunks = split_into_best_sentences(
+            self.tts_model.flow_lm.conditioner.tokenizer, text_to_generate
+        )
+        generators = chunk_generators(seed, len(text_chunks), self.tts_model.flow_lm.device)
+        chunks = []
+        for chunk, generator in zip(text_chunks, generators):
+            _, frames_after_eos_guess = prepare_text_prompt(chunk)
+            if frames_after_eos is None:
+                chunks.append((chunk, frames_after_eos_guess + 2, generator))
+            else:
+                chunks.append((chunk, frames_after_eos, generator))
+
+        with self._stats_lock:
+            self._check_queue_locked()
+            self._num_queued += 1
+        stream = _Stream(model_state, chunks, cancel_event, notify)
+        deadline = stream.start_time + len(text_to_generate.split()) * SECONDS_PER_WORD
+        self._put_pending(_NEW, deadline, stream)
+        return stream
+
+    def _consumed(self, stream: _Stream):
+        """Called after each message read by the consumer, resumes the stream if it can."""
+        with stream.lock:
+            if not stream.paused or stream.output.qsize() > self.max_buffered_frames // 2:
+                return
+            stream.paused = False
+        self._put_pending(_RETURNING, 0.0, stream)
+
+    def _cancel(self, stream: _Stream):
+        """Stops generating `stream`, whose consumer is gone."""
+        with stream.lock:
+            stream.cancel_event.set()
+            paused, stream.paused = stream.paused, False
+        if paused:
+            # Given back to the worker thread, which drops it.
+            self._put_pending(_RETURNING, 0.0, stream)
+
+    def generate_audio_stream(
+        self,
+        model_state: dict,
+        text_to_generate: str,
+        frames_after_eos: int | None = None,
+        seed: int | None = None,
+        cancel_event: threading.Event | None = None,
+    ):
+        """Generate audio streaming chunks from text input.
+
+        Same as `TTSModel.generate_audio_stream`, except that this method is thread-safe:
+        concurrent calls are batched together by the scheduler.
+
+        Args:
+            model_state: Voice state obtained from `TTSModel.get_state_for_audio_prompt()`.
+                It is not modified.
+            text_to_generate: Input text to convert to speech.
+            frames_after_eos: Number of additional frames to generate after detecting
+                end-of-sequence. If None, automatically determined for each sentence chunk.
+            seed: Seed of the sampling noise, see `TTSModel.generate_audio_stream`. The
+                stream draws the same noise as with the model alone, whatever the other
+                streams of the batch.
+            cancel_event: Event that stops the generation when set, e.g. from another
+                thread: the stream leaves the batch at the next step and ends early. It is
+                also set if the generator is closed before the end.
+
+        Yields:
+            torch.Tensor: Audio chunks with shape [samples] at the model's sample rate.
+        """
+        stream = self._submit(model_state, text_to_generate, frames_after_eos, seed, cancel_event)
+        kind = None
+        try:
+            while kind not in ("done", "error"):
+                kind, value = stream.output.get()
+                self._consumed(stream)
+                if kind == "chunk":
+                    yield value
+                elif kind == "error":
+                    raise value
+        finally:
+            if kind not in ("done", "error"):
+                # The caller closed the generator early.
+                self._cancel(stream)
+
+    async def generate_audio_stream_async(
+        self,
+        model_state: dict,
+        text_to_generate: str,
+        frames_after_eos: int | None = None,
+        seed: int | None = None,
+        cancel_event: threading.Event | None = None,
+    ):
+        """Same as `generate_audio_stream`, as an asynchronous iterator.
+
+        Waiting for the chunks does not block the event loop nor use a thread. The
+        generation stops as soon as the iterator is closed or its task is cancelled, e.g.
+        when the client of a server disconnects. If the chunks are not read fast enough,
+        the stream is paused, see `max_buffered_frames`.
+        """
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def notify():
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:  # The event loop is closed.
+                pass
+
+        stream = self._submit(
+            model_state, text_to_generate, frames_after_eos, seed, cancel_event, notify
+        )
+        kind = None
+        try:
+            while kind not in ("done", "error"):
+                try:
+                    kind, value = stream.output.get_nowait()
+                except queue.Empty:
+                    ready.clear()
+                    # A message put before `clear` would not wake us up.
+                    if stream.output.empty():
+                        await ready.wait()
+                    continue
+                self._consumed(stream)
+                if kind == "chunk":
+                    yield value
+                elif kind == "error":
+                    raise value
+        finally:
+            if kind not in ("done", "error"):
+                self._cancel(stream)
+
+    @torch.no_grad
+    def _run(self):
+        flow_lm = self.tts_model.flow_lm
+        mimi = self.tts_model.mimi
+        flow_lm_state = init_states(
+            flow_lm, batch_size=self.max_batch_size, sequence_length=self.sequence_length
+        )
+        mimi_state = init_states(mimi, batch_size=self.max_batch_size, sequence_length=1000)
+        initial_mimi_state = init_states(mimi, batch_size=1, sequence_length=1000)
+        latents = torch.full(
+            (self.max_batch_size, 1, flow_lm.ldim),
+            fill_value=float("NaN"),
+            device=flow_lm.device,
+            dtype=flow_lm.dtype,
+        )
+
+        active: list[_Stream] = []
+        num_paused = 0
+        stopping = False
+        # Paused streams are still being generated, they are waited for before stopping.
+        while not stopping or active or num_paused:
+            # Admit new streams, waiting for one only if there is nothing else to do.
+            while len(active) < self.max_batch_size:
+                if stopping and not active and not num_paused:
+                    break
+                try:
+                    _, _, _, stream = self._pending.get(block=not active)
+                except queue.Empty:
+                    break
+                if stream is None:
+                    stopping = True
+                    continue
+                if stream.admitted_time is None:
+                    stream.admitted_time = time.monotonic()
+                    with self._stats_lock:
+                        self._num_queued -= 1
+                if stream.paused_state is not None:
+                    num_paused -= 1
+                if stream.cancelled:
+                    stream.paused_state = None
+                    stream.put("done", None)
+                    continue
+                row = len(active)
+                try:
+                    if stream.paused_state is not None:
+                        self._resume(stream, row, flow_lm_state, mimi_state, latents)
+                    else:
+                        self._start_chunk(
+                            stream, row, flow_lm_state, mimi_state, initial_mimi_state
+                        )
+                        latents[row] = float("NaN")
+                except Exception as e:
+                    stream.put("error", e)
+                    continue
+                active.append(stream)
+            self._num_active = len(active)
+            if not active:
+                continue
+
+            try:
+                finished = self._step(active, flow_lm_state, mimi_state, latents)
+            except Exception as e:
+                logger.error(f"Error in batched generation: {e}")
+                for stream in active:
+                    stream.put("error", e)
+                active = []
+                continue
+            to_pause = self._streams_to_pause(active, finished)
+
+            # Going backwards, the last row is always already processed when it is moved.
+            for row in sorted(finished + to_pause, reverse=True):
+                stream = active[row]
+                if row in to_pause:
+                    self._pause(stream, row, flow_lm_state, mimi_state, latents)
+                    num_paused += 1
+                elif stream.chunks and not stream.cancelled:
+                    try:
+                        self._start_chunk(
+                            stream, row, flow_lm_state, mimi_state, initial_mimi_state
+                        )
+                        latents[row] = float("NaN")
+                        continue
+                    except Exception as e:
+                        self._fail(stream, e)
+                elif not stream.failed:
+                    if not stream.cancelled:
+                        self._record_stream_done(stream)
+                    stream.put("done", None)
+                last = len(active) - 1
+                if row != last:
+                    copy_state_rows(flow_lm, flow_lm_state, row, flow_lm_state, last)
+                    copy_state_rows(mimi, mimi_state, row, mimi_state, last)
+                    latents[row] = latents[last]
+                    active[row] = active[last]
+                active.pop()
+            self._num_active = len(active)
+
+    def _streams_to_pause(self, active: list[_Stream], finished: list[int]) -> list[int]:
+        """Rows of the streams whose consumer is too far behind, which are marked as paused."""
+        to_pause = []
+        for row, stream in enumerate(active):
+            if row in finished or stream.output.qsize() < self.max_buffered_frames:
+                continue
+            with stream.lock:
+                # Checked again, the consumer may have read or cancelled the stream meanwhile.
+                if stream.cancelled or stream.output.qsize() < self.max_buffered_frames:
+                    continue
+                stream.paused = True
+            to_pause.append(row)
+        return to_pause
+
+    def _pause(
+        self,
+        stream: _Stream,
+        row: int,
+        flow_lm_state: dict,
+        mimi_state: dict,
+        latents: torch.Tensor,
+    ):
+        """Copies the row of a paused stream, so that it can leave the batch."""
+        stream.paused_state = (
+            snapshot_states(
+                self.tts_model.flow_lm, narrow_states(self.tts_model.flow_lm, flow_lm_state, row, 1)
+            ),
+            snapshot_states(
+                self.tts_model.mimi, narrow_states(self.tts_model.mimi, mimi_state, row, 1)
+            ),
+            latents[row].clone(),
+        )
+
+    def _resume(
+        self,
+        stream: _Stream,
+        row: int,
+        flow_lm_state: dict,
+        mimi_state: dict,
+        latents: torch.Tensor,
+    ):
+        """Sets up the row `row` of the batch to continue a paused stream where it stopped."""
+        flow_lm_snapshot, mimi_snapshot, latent = stream.paused_state
+        stream.paused_state = None
+        flow_lm = self.tts_model.flow_lm
+        mimi = self.tts_model.mimi
+        restore_states(flow_lm, narrow_states(flow_lm, flow_lm_state, row, 1), flow_lm_snapshot)
+        restore_states(mimi, narrow_states(mimi, mimi_state, row, 1), mimi_snapshot)
+        latents[row] = latent
+
+    def _start_chunk(
+        self,
+        stream: _Stream,
+        row: int,
+        flow_lm_state: dict,
+        mimi_state: dict,
+        initial_mimi_state: dict,
+    ):
+        """Sets up the row `row` of the batch to generate the next chunk of `stream`."""
+        text_to_generate, stream.frames_after_eos, stream.generator = stream.chunks.popleft()
+        stream.step = 0
+        stream.eos_step = None
+        gen_len_sec = len(text_to_generate.split()) * 1 + 2.0
+        stream.max_gen_len = int(gen_len_sec * 12.5)
+
+        copy_state_rows(self.tts_model.flow_lm, flow_lm_state, row, stream.model_state, 0)
+        copy_state_rows(self.tts_model.mimi, mimi_state, row, initial_mimi_state, 0)
+        self.tts_model._prompt_text_or_use_cache(
+            narrow_states(self.tts_model.flow_lm, flow_lm_state, row, 1), text_to_generate
+        )
+
+    def _step(
+        self, active: list[_Stream], flow_lm_state: dict, mimi_state: dict, latents: torch.Tensor
+    ) -> list[int]:
+        """Advances all the active streams by one frame, returns the rows that are done."""
+        batch_size = len(active)
+        # Seeded streams draw their noise from their own generator, the others from the
+        # global RNG. If no stream is seeded, the noise of all the rows is drawn at once.
+        generators = [stream.generator for stream in active]
+        next_latents, is_eos = self.tts_model._run_flow_lm_and_increment_step(
+            model_state=narrow_states(self.tts_model.flow_lm, flow_lm_state, 0, batch_size),
+            backbone_input_latents=latents[:batch_size],
+            compiled=False,
+            generator=generators if any(g is not None for g in generators) else None,
+        )
+        latents[:batch_size] = next_latents
+
+        batch_mimi_state = narrow_states(self.tts_model.mimi, mimi_state, 0, batch_size)
+        audio_frames = self.tts_model._decode_latent(next_latents, batch_mimi_state, compiled=False)
+
+        finished = []
+        for row, (stream, row_is_eos) in enumerate(zip(active, is_eos[:, 0].tolist())):
+            if stream.cancelled:
+                finished.append(row)
+                continue
+            if row_is_eos and stream.eos_step is None:
+                stream.eos_step = stream.step
+            if stream.eos_step is not None and stream.step >= stream.eos_step + (
+                stream.frames_after_eos
+            ):
+                finished.append(row)
+                continue
+            stream.put("chunk", audio_frames[row, 0])
+            stream.generated_samples += audio_frames.shape[-1]
+            stream.step += 1
+            if stream.step >= stream.max_gen_len:
+                try:
+                    self.tts_model._handle_missing_eos()
+                except RuntimeError as e:
+                    self._fail(stream, e)
+                finished.append(row)
+        return finished
+
+    def _fail(self, stream: _Stream, error: Exception):
+        stream.failed = True
+        stream.chunks.clear()
+        stream.put("error", error)
+
+    def _record_stream_done(self, stream: _Stream):
+        now = time.monotonic()
+        queue_wait = stream.admitted_time - stream.start_time
+        service_time = now - stream.admitted_time
+        with self._stats_lock:
+            self._num_completed += 1
+            self._recent_times.append((queue_wait, service_time))
+
+        duration_generated_audio = int(
+            stream.generated_samples * 1000 / self.tts_model.config.mimi.sample_rate
+        )
+        generation_time = int((now - stream.start_time) * 1000)
+        logger.info(
+            "Generated: %d ms of audio in %d ms so %.2fx faster than real-time, "
+            "after %d ms in the queue",
+            duration_generated_audio,
+            generation_time,
+            duration_generated_audio / max(generation_time, 1),
+            int(queue_wait * 1000),
+        )
+
+
+def _percentile(sorted_values: list[float], percentile: int) -> float | None:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(percentile / 100 * len(sorted_values)) - 1))
+    return round(sorted_values[index], 3)
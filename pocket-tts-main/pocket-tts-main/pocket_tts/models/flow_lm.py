@@ -13,7 +13,7 @@ from pocket_tts.utils.config import FlowLMConfig
 
 logger = logging.getLogger(__name__)
 
-FlowNet2 = Callable[[torch.Tensor, torch.Tensor, torch.Tensor], torch.Tensor]
+FlowNet2 = Callable[[int, torch.Tensor], torch.Tensor]
 
 
 def lsd_decode(v_t: FlowNet2, x_0: torch.Tensor, num_steps: int = 1) -> torch.Tensor:
@@ -22,7 +22,8 @@ def lsd_decode(v_t: FlowNet2, x_0: torch.Tensor, num_steps: int = 1) -> torch.Te
     Lagrangian Self Distillation (https://arxiv.org/pdf/2505.18825)
 
     Args:
-        v_t: Function taking t and x_t as input and returning the flow.
+        v_t: Function taking the index i of the step and x_t as input and returning the
+            flow from s = i / num_steps to t = (i + 1) / num_steps.
         x_0: Starting point from the known distribution.
         num_steps: Number of steps to take.
 
@@ -31,15 +32,28 @@ def lsd_decode(v_t: FlowNet2, x_0: torch.Tensor, num_steps: int = 1) -> torch.Te
     """
     current = x_0
     for i in range(num_steps):
-        s = i / num_steps
-        t = (i + 1) / num_steps
-        flow_dir = v_t(
-            s * torch.ones_like(x_0[..., :1]), t * torch.ones_like(x_0[..., :1]), current
-        )
+        flow_dir = v_t(i, current)
         current += flow_dir / num_steps
     return current
 
 
+def check_num_candidates(num_candidates: int):
+    """Raises `ValueError` unless `num_candidates` is 1 or at least 3.
+
+    Two candidates are always equally close to each other, so the selection would keep the
+    first one and decoding the second would be wasted.
+    """
+    if num_candidates < 1 or num_candidates == 2:
+        raise ValueError(f"num_candidates must be 1 or at least 3, got {num_candidates}")
+
+
+def _select_typical_candidates(candidates: torch.Tensor) -> torch.Tensor:
+    """Picks, for each row of a [B, K, D] tensor, the candidate closest to the others."""
+    distances = torch.cdist(candidates, candidates).sum(dim=-1)
+    best = distances.argmin(dim=-1)
+    return candidates[torch.arange(candidates.shape[0], device=best.device), best]
+
+
 class FlowLMModel(nn.Module):
     """Transformer-based flow language model on multiple streams of latents.
 
@@ -83,6 +97,10 @@ class FlowLMModel(nn.Module):
         self.transformer = transformer
         self.out_norm = nn.LayerNorm(dim, eps=1e-5)
         self.out_eos = nn.Linear(dim, 1, dtype=dtype)
+        # Time embeddings of the flow network for the steps of `lsd_decode`, see
+        # `lsd_time_embeddings`. Recomputed when new weights are loaded.
+        self.register_buffer("_time_embeddings", torch.empty(0), persistent=False)
+        self.register_load_state_dict_post_hook(FlowLMModel._refresh_lsd_time_embeddings)
 
     @property
     def device(self) -> str:
@@ -97,6 +115,9 @@ class FlowLMModel(nn.Module):
         temp: float,
         noise_clamp: float | None,
         eos_threshold: float,
+        noise: torch.Tensor | None = None,
+        num_candidates: int = 1,
+        generator: torch.Generator | None = None,
     ) -> tuple[torch.Tensor, torch.Tensor]:
         """Apply language model on sequence and conditions.
         Given a tensor of sequence of shape [B, S, ldim], returns the loss in training mode
@@ -108,12 +129,21 @@ class FlowLMModel(nn.Module):
                 tensor.
             lsd_decode_steps (int): Number of steps to decode when generating audio.
                 If zero, the model computes the loss.
+            noise (torch.Tensor, optional): Starting points of the flow, see `sample_noise`,
+                `num_candidates` for each row. Sampled with `temp` and `noise_clamp` if not
+                given.
+            num_candidates (int): Number of latents decoded for each row, from different
+                noises, in a single batch. The one closest to the others is returned, which
+                avoids outliers. Either 1 or at least 3, see `check_num_candidates`.
+            generator (torch.Generator, optional): Generator of the noise, if it is not
+                given. The global RNG is used if None.
         Returns:
             (output, eos_output, metrics). If `lsd_decode_steps` is zero, `output` is the loss tensor of shape [B, S],
             otherwise it is the reconstructed latent.
         """
+        check_num_candidates(num_candidates)
         # NaN values signal a BOS position.
-        sequence = torch.where(torch.isnan(sequence), self.bos_emb, sequence)
+        sequence = torch.where(torch.isnan(sequence), self.bos_emb, sequence).to(self.dtype)
         input_ = self.input_linear(sequence)
 
         transformer_out = self.backbone(input_, text_embeddings, sequence, model_state=model_state)
@@ -123,15 +153,79 @@ class FlowLMModel(nn.Module):
         transformer_out = transformer_out[:, -1]
         out_eos = self.out_eos(transformer_out) > eos_threshold
 
-        noise_shape = transformer_out.shape[:-1] + (self.ldim,)
+        batch_size = transformer_out.shape[0]
+        if noise is None:
+            noise = self.sample_noise(batch_size * num_candidates, temp, noise_clamp, generator)
+        # The conditioning and the times are embedded once for all the steps and candidates.
+        c_emb = self.flow_net.cond_embed(transformer_out.to(self.dtype))
+        if num_candidates > 1:
+            c_emb = c_emb.repeat_interleave(num_candidates, dim=0)
+        # The noise and the sampled latent stay in float32, only the flow network runs in
+        # the dtype of the model.
+        conditioned_flow = partial(
+            self._run_flow_net, c_emb, self.lsd_time_embeddings(lsd_decode_steps)
+        )
+        latents = lsd_decode(conditioned_flow, noise, lsd_decode_steps)
+        if num_candidates > 1:
+            latents = _select_typical_candidates(latents.view(batch_size, num_candidates, -1))
+        return latents, out_eos
+
+    def sample_noise(
+        self,
+        batch_size: int,
+        temp: float,
+        noise_clamp: float | None,
+        generator: torch.Generator | None = None,
+    ) -> torch.Tensor:
+        """Starting points of the flow for `batch_size` latents, in float32.
+
+        They are drawn from `generator`, or from the global RNG if it is None.
+        """
         std = temp**0.5
-        noise = torch.empty(noise_shape, dtype=transformer_out.dtype, device=transformer_out.device)
+        noise = torch.empty(
+            (batch_size, self.ldim), dtype=torch.float32, device=self.bos_emb.device
+        )
         if noise_clamp is None:
-            torch.nn.init.normal_(noise, mean=0.0, std=std)
+            torch.nn.init.normal_(noise, mean=0.0, std=std, generator=generator)
         else:
-            torch.nn.init.trunc_normal_(noise, mean=0.0, std=std, a=-noise_clamp, b=noise_clamp)
-        conditioned_flow = partial(self.flow_net, transformer_out)
-        return lsd_decode(conditioned_flow, noise, lsd_decode_steps), out_eos
+            torch.nn.init.trunc_normal_(
+                noise, mean=0.0, std=std, a=-noise_clamp, b=noise_clamp, generator=generator
+            )
+        return noise
+
+    def _refresh_lsd_time_embeddings(self, incompatible_keys=None):
+        num_steps = self._time_embeddings.shape[0]
+        if num_steps:
+            self._time_embeddings = self._compute_lsd_time_embeddings(num_steps)
+
+    def lsd_time_embeddings(self, num_steps: int) -> torch.Tensor:
+        """Embeddings of the times of the `num_steps` steps of `lsd_decode`, one per row.
+
+        They only depend on the weights, so they are computed once, when loading the model
+        for its number of decoding steps, rather than at every step of every latent.
+        """
+        if self._time_embeddings.shape[0] != num_steps:
+            self._time_embeddings = self._compute_lsd_time_embeddings(num_steps)
+        return self._time_embeddings
+
+    @torch.no_grad
+    def _compute_lsd_time_embeddings(self, num_steps: int) -> torch.Tensor:
+        device = self.bos_emb.device
+        return torch.cat(
+            [
+                self.flow_net.embed_times(
+                    torch.full((1, 1), i / num_steps, device=device),
+                    torch.full((1, 1), (i + 1) / num_steps, device=device),
+                )
+                for i in range(num_steps)
+            ]
+        )
+
+    def _run_flow_net(
+        self, c_emb: torch.Tensor, time_embeddings: torch.Tensor, step: int, x: torch.Tensor
+    ) -> torch.Tensor:
+        t_emb = time_embeddings[step : step + 1]
+        return self.flow_net.forward_embedded(c_emb, t_emb, x.to(self.dtype)).to(x.dtype)
 
     def backbone(
         self, input_, text_embeddings: torch.Tensor, sequence, model_state: dict
@@ -160,6 +254,8 @@ class FlowLMModel(nn.Module):
         temp: float,
         noise_clamp: float | None,
         eos_threshold: float,
+        num_candidates: int = 1,
+        noise: torch.Tensor | None = None,
     ) -> tuple[torch.Tensor, torch.Tensor]:
         """Sample next latent from the model given a sequence and a set of conditions.
         Args:
@@ -168,6 +264,7 @@ class FlowLMModel(nn.Module):
                 S = 1 in streaming mode, except for the first step that contains a bigger prompt.
             text_embeddings (torch.Tensor): Condition tensor.
             n_steps (int): Number of flow steps to decode when generating audio.
+            noise (torch.Tensor, optional): Starting points of the flow, see `forward`.
         Returns:
             next_latent (torch.Tensor), is_eos (torch.Tensor): Next latent tensor of shape [B, 1, ldim]
                 and is_eos tensor of shape [B, 1] with 1 on EOS positions.
@@ -180,6 +277,8 @@ class FlowLMModel(nn.Module):
             noise_clamp=noise_clamp,
             eos_threshold=eos_threshold,
             model_state=model_state,
+            noise=noise,
+            num_candidates=num_candidates,
         )
 
         return result
@@ -0,0 +1,224 @@
+"""Long-lived threads generating and decoding the latents of one sentence chunk at a time.
+
+`TTSModel` keeps a pool of workers, so that streaming a chunk does not need to start new
+threads or allocate a new Mimi state: the generation thread, the decoding thread and
+the Mimi state of a worker are reused by all the chunks it generates.
+
+Idle workers do not reference the model, so that the model and its pool can be garbage
+collected, which stops the threads of the workers.
+"""
+
+import logging
+import queue
+import threading
+
+import torch
+
+from pocket_tts.modules.stateful_module import init_states, restore_states, snapshot_states
+
+logger = logging.getLogger(__name__)
+
+
+# Put in the queue of jobs of a worker to stop its threads.
+_STOP = object()
+# Put in the queue of idle workers of a closed pool, to wake the callers waiting for one.
+_CLOSED = object()
+
+
+class _Job:
+    def __init__(
+        self,
+        tts_model,
+        model_state: dict,
+        max_gen_len: int,
+        frames_after_eos: int,
+        result_queue: queue.Queue,
+        mimi_state: dict | None,
+        generator: torch.Generator | None,
+        cancel_event: threading.Event | None,
+    ):
+        self.tts_model = tts_model
+        self.model_state = model_state
+        self.max_gen_len = max_gen_len
+        self.frames_after_eos = frames_after_eos
+        self.result_queue = result_queue
+        self.mimi_state = mimi_state
+        self.generator = generator
+        self.cancel_event = cancel_event
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+
+class WorkerPool:
+    """Generation workers of a model, reused by its chunks, at most `max_workers` of them.
+
+    Once all of them are busy, `acquire` waits for one to finish its job, or for the pool
+    to be closed.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._idle_workers = queue.Queue()
+        self._num_workers = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def acquire(self, tts_model) -> "GenerationWorker":
+        """Returns an idle worker, starting a new one if the pool is not full yet."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The generation workers of this model were closed")
+            start_worker = self._idle_workers.empty() and self._num_workers < self.max_workers
+            if start_worker:
+                self._num_workers += 1
+        if start_worker:
+            return GenerationWorker(tts_model, on_idle=self._release)
+        worker = self._idle_workers.get()
+        if worker is _CLOSED:
+            # Left for the next caller waiting.
+            self._idle_workers.put(_CLOSED)
+            raise RuntimeError("The generation workers of this model were closed")
+        return worker
+
+    def _release(self, worker: "GenerationWorker"):
+        with self._lock:
+            if not self._closed:
+                self._idle_workers.put(worker)
+                return
+        worker.close()
+
+    def close(self):
+        """Stops the idle workers, and the busy ones once their job is done."""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                worker = self._idle_workers.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not _CLOSED:
+                worker.close()
+        # Busy workers are not given back anymore, so the callers waiting for one would wait
+        # forever.
+        self._idle_workers.put(_CLOSED)
+
+
+class GenerationWorker:
+    """A generation thread and a Mimi decoding thread connected by a bounded queue.
+
+    Args:
+        tts_model: The model whose Mimi state is allocated for the worker. The jobs
+            reference the model they are generated with.
+        on_idle: Called with the worker once a job is fully decoded, to give it back to
+            its pool.
+        max_pending_latents: Number of latents the generation thread can be ahead of
+            the decoding thread.
+    """
+
+    def __init__(self, tts_model, on_idle, max_pending_latents: int = 16):
+        self._on_idle = on_idle
+        self._jobs = queue.Queue()
+        # Latents of the current job, with the job itself first and then None, or the
+        # error raised by the generation, last.
+        self._latents = queue.Queue(maxsize=max_pending_latents)
+        self._mimi_state = init_states(tts_model.mimi, batch_size=1, sequence_length=1000)
+        self._initial_mimi_state = snapshot_states(tts_model.mimi, self._mimi_state)
+        self.threads = [
+            threading.Thread(
+                target=self._run_generation, name="pocket-tts-generation", daemon=True
+            ),
+            threading.Thread(target=self._run_decoding, name="pocket-tts-decoding", daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        """Stops the threads once the jobs already submitted are done."""
+        self._jobs.put(_STOP)
+
+    def submit(
+        self,
+        tts_model,
+        model_state: dict,
+        max_gen_len: int,
+        frames_after_eos: int,
+        result_queue: queue.Queue,
+        mimi_state: dict | None = None,
+        generator: torch.Generator | None = None,
+        cancel_event: threading.Event | None = None,
+    ):
+        """Starts generating from `model_state`, which must already be prompted.
+
+        Audio frames are put in `result_queue` as `("chunk", frame)`, followed by
+        `("done", None)`, or `("error", exception)` if the generation failed.
+        Latents are decoded from a fresh Mimi state, unless `mimi_state` is given: then
+        decoding continues from it, e.g. to chain the chunks of a long-form stream.
+        The noise is drawn from `generator`, or from the global RNG if it is None.
+        Once `cancel_event` is set, the job stops at the next step and its remaining latents
+        are not decoded; `("done", None)` is still put in `result_queue`.
+        """
+        self._jobs.put(
+            _Job(
+                tts_model,
+                model_state,
+                max_gen_len,
+                frames_after_eos,
+                result_queue,
+                mimi_state,
+                generator,
+                cancel_event,
+            )
+        )
+
+    @torch.no_grad
+    def _run_generation(self):
+        while True:
+            job = self._jobs.get()
+            self._latents.put(job)
+            if job is _STOP:
+                return
+            try:
+                job.tts_model._autoregressive_generation(
+                    job.model_state,
+                    job.max_gen_len,
+                    job.frames_after_eos,
+                    self._latents,
+                    job.generator,
+                    job.cancel_event,
+                )
+            except Exception as e:
+                logger.error(f"Error in autoregressive generation: {e}")
+                self._latents.put(e)
+            # Waiting for the next job must not keep the model of this one alive.
+            del job
+
+    @torch.no_grad
+    def _run_decoding(self):
+        job, mimi_state, failed = None, None, False
+        while True:
+            item = self._latents.get()
+            if item is _STOP:
+                return
+            if isinstance(item, _Job):
+                job, mimi_state, failed = item, item.mimi_state, False
+                if mimi_state is None:
+                    mimi_state = self._mimi_state
+                    restore_states(job.tts_model.mimi, mimi_state, self._initial_mimi_state)
+            elif item is None or isinstance(item, Exception):
+                if not failed:
+                    job.result_queue.put(("done", None) if item is None else ("error", item))
+                # Neither the job nor the traceback of its error keep the model alive.
+                job = item = None
+                self._on_idle(self)
+            elif not failed and not job.cancelled:
+                try:
+                    audio_frame = job.tts_model._decode_latent(item, mimi_state)
+                except Exception as e:
+                    # The remaining latents of the job are still consumed, so that the
+                    # generation thread is not blocked.
+                    failed = True
+                    job.result_queue.put(("error", e))
+                    continue
+                job.result_queue.put(("chunk", audio_frame))
@@ -1,10 +1,13 @@
-import copy
+import hashlib
 import logging
 import os
 import queue
 import statistics
 import threading
 import time
+import warnings
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from pathlib import Path
 
@@ -24,13 +27,24 @@ from pocket_tts.default_parameters import (
     DEFAULT_TEMPERATURE,
     DEFAULT_VARIANT,
 )
-from pocket_tts.models.flow_lm import FlowLMModel
+from pocket_tts.models.flow_lm import FlowLMModel, check_num_candidates
+from pocket_tts.models.generation_worker import WorkerPool
 from pocket_tts.models.mimi import MimiModel
-from pocket_tts.modules import mimi_transformer
+from pocket_tts.modules import mimi_transformer, mlp
 from pocket_tts.modules.dummy_quantizer import DummyQuantizer
 from pocket_tts.modules.seanet import SEANetDecoder, SEANetEncoder
-from pocket_tts.modules.stateful_module import increment_steps, init_states
+from pocket_tts.modules.stateful_module import (
+    copy_state_rows,
+    increment_steps,
+    init_states,
+    narrow_states,
+    rebuild_stateful_modules,
+    restore_states,
+    snapshot_states,
+    stateful_modules,
+)
 from pocket_tts.utils.config import Config, load_config
+from pocket_tts.utils.text_prompt_cache import TextPromptCache, apply_state_delta, state_delta
 from pocket_tts.utils.utils import (
     PREDEFINED_VOICES,
     display_execution_time,
@@ -38,12 +52,34 @@ from pocket_tts.utils.utils import (
     load_predefined_voice,
     size_of_dict,
 )
-from pocket_tts.utils.weights_loading import get_flow_lm_state_dict, get_mimi_state_dict
+from pocket_tts.utils.voice_cache import VoiceCache
+from pocket_tts.utils.weights_loading import (
+    empty_weights,
+    get_flow_lm_state_dict,
+    get_mimi_state_dict,
+    load_weights,
+)
 
 torch.set_num_threads(1)
 logger = logging.getLogger(__name__)
 
 
+def _upcast_inputs(module: nn.Module, args: tuple) -> tuple:
+    return tuple(arg.float() if isinstance(arg, torch.Tensor) else arg for arg in args)
+
+
+def _cast_inputs_to_bfloat16(module: nn.Module, args: tuple) -> tuple:
+    return tuple(arg.to(torch.bfloat16) if isinstance(arg, torch.Tensor) else arg for arg in args)
+
+
+def _cast_output_to_bfloat16(module: nn.Module, args: tuple, output: torch.Tensor) -> torch.Tensor:
+    return output.to(torch.bfloat16)
+
+
+def _upcast_outputs(module: nn.Module, args: tuple, outputs: list) -> list:
+    return [output.float() for output in outputs]
+
+
 class TTSModel(nn.Module):
     def __init__(
         self,
@@ -53,15 +89,40 @@ class TTSModel(nn.Module):
         noise_clamp: float | None,
         eos_threshold,
         config: Config,
+        num_candidates: int = 1,
     ):
         super().__init__()
+        check_num_candidates(num_candidates)
         self.flow_lm = flow_lm
         self.temp = temp
         self.lsd_decode_steps = lsd_decode_steps
         self.noise_clamp = noise_clamp
         self.eos_threshold = eos_threshold
+        # Latents decoded from different noises at each step, see `FlowLMModel.forward`.
+        self.num_candidates = num_candidates
         self.config = config
         self.has_voice_cloning = True
+        # Whether the linear layers were quantized to int8, see `load_model`.
+        self.quantized = False
+        # Set to None to always run the Mimi encoder on audio prompts.
+        self.voice_cache = VoiceCache()
+        # Set to None to always prompt the FlowLM with the text of each chunk.
+        self.text_prompt_cache = TextPromptCache()
+        # Positions of the FlowLM cache of the states returned by `get_state_for_audio_prompt`,
+        # the voice prompt included. Once it is full, the oldest positions after the voice
+        # prompt are overwritten. All the voices share it, so their states have one shape.
+        self.flow_lm_cache_length = 1000
+        # Preallocated FlowLM states that sentence chunks are generated into, see
+        # `_acquire_state_buffer`.
+        self._state_buffers = []
+        self._state_buffers_lock = threading.Lock()
+        # Threads generating the sentence chunks, at most one pair per CPU core. They are
+        # stopped by `close`, or once the model is garbage collected.
+        self._worker_pool = WorkerPool(max_workers=os.cpu_count() or 1)
+        weakref.finalize(self, self._worker_pool.close)
+        # Compiled versions of `_decode_step` and `_decode_frame`, see `_compile`.
+        self._compiled_decode_step = None
+        self._compiled_decode_frame = None
 
     @property
     def device(self) -> str:
@@ -73,24 +134,49 @@ class TTSModel(nn.Module):
 
     @classmethod
     def _from_pydantic_config(
-        cls, config: Config, temp, lsd_decode_steps, noise_clamp: float | None, eos_threshold
+        cls,
+        config: Config,
+        temp,
+        lsd_decode_steps,
+        noise_clamp: float | None,
+        eos_threshold,
+        num_candidates: int = 1,
     ) -> Self:
         flow_lm = FlowLMModel.from_pydantic_config(
             config.flow_lm, latent_dim=config.mimi.quantizer.dimension
         )
-        tts_model = cls(flow_lm, temp, lsd_decode_steps, noise_clamp, eos_threshold, config)
+        tts_model = cls(
+            flow_lm, temp, lsd_decode_steps, noise_clamp, eos_threshold, config, num_candidates
+        )
         return tts_model
 
     @classmethod
     def _from_pydantic_config_with_weights(
-        cls, config: Config, temp, lsd_decode_steps, noise_clamp: float | None, eos_threshold
+        cls,
+        config: Config,
+        temp,
+        lsd_decode_steps,
+        noise_clamp: float | None,
+        eos_threshold,
+        quantize: bool = False,
+        dtype: str = "float32",
+        compile: bool = False,
+        num_candidates: int = 1,
     ) -> Self:
-        tts_model = cls._from_pydantic_config(
-            config, temp, lsd_decode_steps, noise_clamp, eos_threshold
-        )
-        tts_model.flow_lm.speaker_proj_weight = torch.nn.Parameter(
-            torch.zeros((1024, 512), dtype=torch.float32)
-        )
+        if dtype not in ("float32", "bfloat16"):
+            raise ValueError(f"Unsupported dtype {dtype!r}, expected 'float32' or 'bfloat16'")
+        if dtype == "bfloat16" and quantize:
+            raise ValueError("A model cannot be both quantized to int8 and run in bfloat16")
+        # Modules whose weights are loaded are built on the meta device: their random
+        # initialization is skipped, and `load_weights` gives them the tensors of the files.
+        has_weights = config.flow_lm.weights_path is not None or config.weights_path is not None
+        with empty_weights() if has_weights else torch.device("cpu"):
+            tts_model = cls._from_pydantic_config(
+                config, temp, lsd_decode_steps, noise_clamp, eos_threshold, num_candidates
+            )
+            tts_model.flow_lm.speaker_proj_weight = torch.nn.Parameter(
+                torch.zeros((1024, 512), dtype=torch.float32)
+            )
         if config.flow_lm.weights_path is not None:
             if config.mimi.weights_path is None:
                 raise ValueError(
@@ -100,31 +186,36 @@ class TTSModel(nn.Module):
             state_dict_flowlm = get_flow_lm_state_dict(
                 download_if_necessary(config.flow_lm.weights_path)
             )
-            tts_model.flow_lm.load_state_dict(state_dict_flowlm, strict=True)
+            load_weights(tts_model.flow_lm, state_dict_flowlm)
 
         # safetensors.torch.save_file(tts_model.state_dict(), "7442637a.safetensors")
         # Create mimi config directly from the provided config using model_dump
         mimi_config = config.mimi.model_dump()
 
         # Build mimi model from config
-        encoder = SEANetEncoder(**mimi_config["seanet"])
-        decoder = SEANetDecoder(**mimi_config["seanet"])
-
-        encoder_transformer = mimi_transformer.ProjectedTransformer(**mimi_config["transformer"])
-        decoder_transformer = mimi_transformer.ProjectedTransformer(**mimi_config["transformer"])
-        quantizer = DummyQuantizer(**mimi_config["quantizer"])
-
-        tts_model.mimi = MimiModel(
-            encoder,
-            decoder,
-            quantizer,
-            channels=mimi_config["channels"],
-            sample_rate=mimi_config["sample_rate"],
-            frame_rate=mimi_config["frame_rate"],
-            encoder_frame_rate=mimi_config["sample_rate"] / encoder.hop_length,
-            encoder_transformer=encoder_transformer,
-            decoder_transformer=decoder_transformer,
-        ).to(device="cpu")
+        with empty_weights() if has_weights else torch.device("cpu"):
+            encoder = SEANetEncoder(**mimi_config["seanet"])
+            decoder = SEANetDecoder(**mimi_config["seanet"])
+
+            encoder_transformer = mimi_transformer.ProjectedTransformer(
+                **mimi_config["transformer"]
+            )
+            decoder_transformer = mimi_transformer.ProjectedTransformer(
+                **mimi_config["transformer"]
+            )
+            quantizer = DummyQuantizer(**mimi_config["quantizer"])
+
+            tts_model.mimi = MimiModel(
+                encoder,
+                decoder,
+                quantizer,
+                channels=mimi_config["channels"],
+                sample_rate=mimi_config["sample_rate"],
+                frame_rate=mimi_config["frame_rate"],
+                encoder_frame_rate=mimi_config["sample_rate"] / encoder.hop_length,
+                encoder_transformer=encoder_transformer,
+                decoder_transformer=decoder_transformer,
+            )
 
         # Load mimi weights from the config safetensors file with complete mapping for strict loading
 
@@ -135,7 +226,7 @@ class TTSModel(nn.Module):
                 )
             logger.info(f"Loading Mimi weights from {config.mimi.weights_path}")
             mimi_state = get_mimi_state_dict(download_if_necessary(config.mimi.weights_path))
-            tts_model.mimi.load_state_dict(mimi_state, strict=True)
+            load_weights(tts_model.mimi, mimi_state)
 
         tts_model.mimi.eval()
         # tts_model.to(dtype=torch.float32)
@@ -151,8 +242,7 @@ class TTSModel(nn.Module):
                 tts_model.has_voice_cloning = False
                 weights_file = download_if_necessary(config.weights_path_without_voice_cloning)
 
-            state_dict = safetensors.torch.load_file(weights_file)
-            tts_model.load_state_dict(state_dict, strict=True)
+            load_weights(tts_model, safetensors.torch.load_file(weights_file))
 
         if config.flow_lm.weights_path is None and config.weights_path is None:
             logger.warning(
@@ -161,14 +251,131 @@ class TTSModel(nn.Module):
         size_in_mb = size_of_dict(tts_model.state_dict()) // 1e6
         logging.info(f"TTS Model loaded successfully. Its size is {size_in_mb} MB")
 
+        if quantize:
+            with display_execution_time("Quantizing linear layers to int8"):
+                tts_model._quantize()
+        if dtype == "bfloat16":
+            tts_model._to_bfloat16()
+        # Constant for a given number of decoding steps, computed once in the final dtype.
+        tts_model.flow_lm.lsd_time_embeddings(lsd_decode_steps)
+        left_on_meta = [
+            name
+            for name, tensor in [*tts_model.named_parameters(), *tts_model.named_buffers()]
+            if tensor.is_meta
+        ]
+        if left_on_meta:
+            raise RuntimeError(f"Tensors not initialized by the weights files: {left_on_meta}")
+        # Every generation step goes through the stateful modules, find them once.
+        rebuild_stateful_modules(tts_model.flow_lm)
+        rebuild_stateful_modules(tts_model.mimi)
+        if compile:
+            with display_execution_time("Compiling the generation step and the frame decoding"):
+                tts_model._compile()
+
         return tts_model
 
+    def _quantize(self):
+        """Replaces the linear layers of the transformers and of the flow network by
+        dynamically quantized int8 ones.
+
+        Weights are stored in int8 and activations are quantized on the fly, which makes
+        the matmuls of the generation steps faster on CPU. Embeddings, norms, convolutions
+        and the small input and EOS projections stay in float32.
+        """
+        for module in (
+            self.flow_lm.transformer,
+            self.flow_lm.flow_net,
+            self.mimi.encoder_transformer,
+            self.mimi.decoder_transformer,
+        ):
+            with warnings.catch_warnings():
+                # Recent versions of torch warn that quantized tensors will move to torchao.
+                warnings.filterwarnings("ignore", message=".*quantize_per_tensor.*")
+                torch.ao.quantization.quantize_dynamic(
+                    module, {nn.Linear}, dtype=torch.qint8, inplace=True
+                )
+        self.quantized = True
+
+    def _to_bfloat16(self):
+        """Converts the transformers and the flow network to bfloat16.
+
+        Their weights, activations and attention caches take half the memory and their
+        matmuls are faster on CPUs supporting bfloat16. The norms, the timestep embeddings
+        of the flow network and the EOS head stay in float32: their inputs are upcast and
+        their outputs cast back to bfloat16. The flow noise and the sampled latents stay in
+        float32 too, see `FlowLMModel.forward`. The convolutions of Mimi are slower in
+        bfloat16 on CPU, so only the transformers of Mimi are converted.
+        """
+        flow_lm = self.flow_lm
+        for module in (flow_lm.conditioner, flow_lm.transformer, flow_lm.flow_net):
+            module.to(torch.bfloat16)
+        flow_lm.input_linear.to(torch.bfloat16)
+        flow_lm.dtype = torch.bfloat16
+        for module in (self.mimi.encoder_transformer, self.mimi.decoder_transformer):
+            module.to(torch.bfloat16)
+            module.register_forward_pre_hook(_cast_inputs_to_bfloat16)
+            module.register_forward_hook(_upcast_outputs)
+        for module in self.modules():
+            if isinstance(module, (nn.LayerNorm, mlp.LayerNorm, mlp.TimestepEmbedder)):
+                module.float()
+                module.register_forward_pre_hook(_upcast_inputs)
+                if module is not flow_lm.out_norm:
+                    module.register_forward_hook(_cast_output_to_bfloat16)
+
+    def _compile(self):
+        """Compiles `_decode_step` and `_decode_frame` with `torch.compile` and warms them up.
+
+        If compilation fails, e.g. because no C++ compiler is available, the model stays
+        in eager mode and a warning is logged.
+        """
+        self._compiled_decode_step = torch.compile(self._decode_step)
+        self._compiled_decode_frame = torch.compile(self._decode_frame)
+        try:
+            self._warm_up_compiled()
+        except Exception as e:
+            logger.warning("Could not compile the model, falling back to eager mode: %s", e)
+            self._compiled_decode_step = None
+            self._compiled_decode_frame = None
+
+    @torch.no_grad
+    def _warm_up_compiled(self):
+        flow_lm_state = init_states(self.flow_lm, batch_size=1, sequence_length=1000)
+        mimi_state = init_states(self.mimi, batch_size=1, sequence_length=1000)
+        device = self.flow_lm.bos_emb.device
+        latents = torch.full(
+            (1, 1, self.flow_lm.ldim), float("NaN"), dtype=self.flow_lm.dtype, device=device
+        )
+        # The first step starts from the BOS latents, in the dtype of the model, the next
+        # ones from sampled latents, in float32: both versions of the graph are compiled.
+        for _ in range(2):
+            noise = torch.zeros((self.num_candidates, self.flow_lm.ldim), device=device)
+            latents, _ = self._compiled_decode_step(flow_lm_state, latents, noise)
+            self._compiled_decode_frame(latents, mimi_state)
+
+    def _run_compiled(self, compiled_name: str, eager, *args):
+        """Runs the compiled version of `eager`, or `eager` itself if it is not compiled."""
+        compiled = getattr(self, compiled_name)
+        if compiled is not None:
+            try:
+                return compiled(*args)
+            except Exception as e:
+                # E.g. a new device or state size whose graph does not compile.
+                logger.warning(
+                    "Compiled %s failed, falling back to eager mode: %s", eager.__name__, e
+                )
+                setattr(self, compiled_name, None)
+        return eager(*args)
+
     def load_model(
         variant: str = DEFAULT_VARIANT,
         temp: float | int = DEFAULT_TEMPERATURE,
         lsd_decode_steps: int = DEFAULT_LSD_DECODE_STEPS,
         noise_clamp: float | int | None = DEFAULT_NOISE_CLAMP,
         eos_threshold: float = DEFAULT_EOS_THRESHOLD,
+        quantize: bool = False,
+        dtype: str = "float32",
+        compile: bool = False,
+        num_candidates: int = 1,
     ) -> Self:
         """Load a pre-trained TTS model with specified configuration.
 
@@ -187,6 +394,22 @@ class TTSModel(nn.Module):
                 is applied. Helps prevent extreme values in generation.
             eos_threshold: Threshold for end-of-sequence detection. Higher values
                 make the model more likely to continue generating.
+            quantize: Whether to quantize the linear layers of the transformers and
+                of the flow network to int8. This makes generation faster on CPU,
+                with a small loss of quality. Quantized models only run on CPU.
+            dtype: Either "float32" or "bfloat16". In bfloat16, the weights, the
+                activations and the caches take half the memory and the matmuls are
+                faster on CPUs supporting it, while the norms, the end-of-sequence
+                detection and the sampling noise stay in float32. It cannot be combined
+                with `quantize`.
+            compile: Whether to compile the generation step and the decoding of audio
+                frames with `torch.compile`. Loading takes longer because both are
+                compiled and warmed up, then each step has less Python overhead. Falls
+                back to eager mode if compilation fails.
+            num_candidates: Number of latents decoded from different noises at each step,
+                in a single batched call of the flow network. The one closest to the others
+                is kept, which avoids outlier latents. 1 decodes a single latent, 2 is
+                rejected since neither of two candidates is closer to the other.
 
         Returns:
             TTSModel: Fully initialized model with loaded weights on cpu, ready for
@@ -199,7 +422,15 @@ class TTSModel(nn.Module):
         """
         config = load_config(Path(__file__).parents[1] / f"config/{variant}.yaml")
         tts_model = TTSModel._from_pydantic_config_with_weights(
-            config, temp, lsd_decode_steps, noise_clamp, eos_threshold
+            config,
+            temp,
+            lsd_decode_steps,
+            noise_clamp,
+            eos_threshold,
+            quantize=quantize,
+            dtype=dtype,
+            compile=compile,
+            num_candidates=num_candidates,
         )
         return tts_model
 
@@ -209,17 +440,51 @@ class TTSModel(nn.Module):
         text_tokens: torch.Tensor | None = None,
         backbone_input_latents: torch.Tensor | None = None,
         audio_conditioning: torch.Tensor | None = None,
+        compiled: bool = True,
+        generator: torch.Generator | list | None = None,
     ) -> tuple[torch.Tensor, torch.Tensor]:
-        """First one is the backbone output, second one is the audio decoding output."""
+        """First one is the backbone output, second one is the audio decoding output.
+
+        Single steps of a batch of one use the compiled graph if the model was compiled,
+        unless `compiled` is False. It is set by callers whose states are views of a
+        larger batch, which would need a graph per batch size.
+        The noise of the flow is drawn from `generator`, see `_sample_noise`.
+        """
+        if (
+            compiled
+            and self._compiled_decode_step is not None
+            and text_tokens is None
+            and audio_conditioning is None
+            and backbone_input_latents is not None
+            and backbone_input_latents.shape[:2] == (1, 1)
+        ):
+            noise = self._sample_noise(backbone_input_latents.shape[0], generator)
+            return self._run_compiled(
+                "_compiled_decode_step",
+                self._decode_step,
+                model_state,
+                backbone_input_latents,
+                noise,
+            )
+        provided = [
+            x for x in (text_tokens, backbone_input_latents, audio_conditioning) if x is not None
+        ]
+        batch_size = provided[0].shape[0] if provided else 1
         if text_tokens is None:
-            text_tokens = torch.zeros((1, 0), dtype=torch.int64, device=self.flow_lm.device)
+            text_tokens = torch.zeros(
+                (batch_size, 0), dtype=torch.int64, device=self.flow_lm.device
+            )
         if backbone_input_latents is None:
             backbone_input_latents = torch.empty(
-                (1, 0, self.flow_lm.ldim), dtype=self.flow_lm.dtype, device=self.flow_lm.device
+                (batch_size, 0, self.flow_lm.ldim),
+                dtype=self.flow_lm.dtype,
+                device=self.flow_lm.device,
             )
         if audio_conditioning is None:
             audio_conditioning = torch.empty(
-                (1, 0, self.flow_lm.dim), dtype=self.flow_lm.dtype, device=self.flow_lm.device
+                (batch_size, 0, self.flow_lm.dim),
+                dtype=self.flow_lm.dtype,
+                device=self.flow_lm.device,
             )
 
         output = self._run_flow_lm(
@@ -227,6 +492,7 @@ class TTSModel(nn.Module):
             backbone_input_latents=backbone_input_latents,
             model_state=model_state,
             audio_conditioning=audio_conditioning,
+            noise=None if generator is None else self._sample_noise(batch_size, generator),
         )
         increment_by = (
             text_tokens.shape[1] + backbone_input_latents.shape[1] + audio_conditioning.shape[1]
@@ -234,15 +500,87 @@ class TTSModel(nn.Module):
         increment_steps(self.flow_lm, model_state, increment=increment_by)
         return output
 
+    def _sample_noise(self, batch_size: int, generator) -> torch.Tensor:
+        """Noise of the flow for a step of `batch_size` rows.
+
+        `generator` is a `torch.Generator` for the whole batch, a list with one for each
+        row, or None to use the global RNG. In a list, rows whose generator is None use the
+        global RNG.
+        """
+        if not isinstance(generator, list):
+            return self.flow_lm.sample_noise(
+                batch_size * self.num_candidates, self.temp, self.noise_clamp, generator
+            )
+        return torch.cat(
+            [
+                self.flow_lm.sample_noise(self.num_candidates, self.temp, self.noise_clamp, g)
+                for g in generator
+            ]
+        )
+
+    @torch.no_grad
+    def _decode_step(
+        self, model_state: dict, backbone_input_latents: torch.Tensor, noise: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Same as `_run_flow_lm_and_increment_step` for one step from the previous latents.
+
+        It only runs tensor operations whose shapes do not depend on the state, so that it
+        can be compiled as a single graph. The noise of the flow is sampled outside, so
+        that the compiled and the eager steps draw the same random numbers.
+        """
+        text_embeddings = torch.empty(
+            (backbone_input_latents.shape[0], 0, self.flow_lm.dim),
+            dtype=self.flow_lm.dtype,
+            device=backbone_input_latents.device,
+        )
+        next_latents, is_eos = self.flow_lm(
+            sequence=backbone_input_latents,
+            text_embeddings=text_embeddings,
+            model_state=model_state,
+            lsd_decode_steps=self.lsd_decode_steps,
+            temp=self.temp,
+            noise_clamp=self.noise_clamp,
+            eos_threshold=self.eos_threshold,
+            noise=noise,
+            num_candidates=self.num_candidates,
+        )
+        increment_steps(self.flow_lm, model_state, increment=1)
+        return next_latents[:, None, :], is_eos
+
+    def _prompt_flow_lm_and_increment_step(
+        self,
+        model_state: dict,
+        text_tokens: torch.Tensor | None = None,
+        audio_conditioning: torch.Tensor | None = None,
+    ):
+        """Feeds text tokens or audio conditioning to the FlowLM.
+
+        Unlike `_run_flow_lm_and_increment_step`, no latent is sampled: the output would be
+        discarded anyway. So this neither runs the flow network nor draws random numbers,
+        and it can run in another thread without changing the generated audio.
+        """
+        conditioning = []
+        if text_tokens is not None:
+            conditioning.append(self.flow_lm.conditioner(TokenizedText(text_tokens)))
+        if audio_conditioning is not None:
+            conditioning.append(audio_conditioning.to(self.flow_lm.dtype))
+        text_embeddings = torch.cat(conditioning, dim=1)
+        # Only the side effect on the attention caches matters.
+        self.flow_lm.transformer(text_embeddings, model_state)
+        increment_steps(self.flow_lm, model_state, increment=text_embeddings.shape[1])
+
     def _run_flow_lm(
         self,
         model_state: dict,
         text_tokens: torch.Tensor,
         backbone_input_latents: torch.Tensor,
         audio_conditioning: torch.Tensor,
+        noise: torch.Tensor | None = None,
     ) -> tuple[torch.Tensor, torch.Tensor]:
         text_embeddings = self.flow_lm.conditioner(TokenizedText(text_tokens))
-        text_embeddings = torch.cat([text_embeddings, audio_conditioning], dim=1)
+        text_embeddings = torch.cat(
+            [text_embeddings, audio_conditioning.to(text_embeddings)], dim=1
+        )
 
         output_embeddings, is_eos = self.flow_lm._sample_next_latent(
             backbone_input_latents,
@@ -252,9 +590,34 @@ class TTSModel(nn.Module):
             temp=self.temp,
             noise_clamp=self.noise_clamp,
             eos_threshold=self.eos_threshold,
+            num_candidates=self.num_candidates,
+            noise=noise,
         )
         return output_embeddings[:, None, :], is_eos
 
+    @property
+    def _config_signature(self) -> str:
+        signature = self.config.model_dump_json() + ("int8" if self.quantized else "")
+        if self.flow_lm.dtype != torch.float32:
+            signature += str(self.flow_lm.dtype)
+        return hashlib.sha256(signature.encode()).hexdigest()
+
+    def _get_audio_prompt_conditioning(self, audio: torch.Tensor, truncate: bool) -> torch.Tensor:
+        """Encodes the audio prompt, or gets its conditioning from the voice cache."""
+        if self.voice_cache is None:
+            with display_execution_time("Encoding audio prompt"):
+                return self._encode_audio(audio.unsqueeze(0).to(self.device))
+
+        key = VoiceCache.key(audio, self._config_signature, truncate)
+        prompt = self.voice_cache.get(key)
+        if prompt is not None:
+            logger.info("Using cached encoding of the audio prompt %s", key[:16])
+            return prompt.to(self.device)
+        with display_execution_time("Encoding audio prompt"):
+            prompt = self._encode_audio(audio.unsqueeze(0).to(self.device))
+        self.voice_cache.put(key, prompt)
+        return prompt
+
     def _encode_audio(self, audio: torch.Tensor) -> torch.Tensor:
         encoded = self.mimi.encode_to_latent(audio)
         latents = encoded.transpose(-1, -2).to(torch.float32)
@@ -262,31 +625,59 @@ class TTSModel(nn.Module):
         return conditioning
 
     @torch.no_grad
-    def _decode_audio_worker(self, latents_queue: queue.Queue, result_queue: queue.Queue):
-        """Worker thread function for decoding audio latents from queue with immediate streaming."""
+    def _decode_latent(
+        self, latent: torch.Tensor, mimi_state: dict, compiled: bool = True
+    ) -> torch.Tensor:
+        """Decodes one latent frame of each row of the batch into audio.
+
+        Like `_run_flow_lm_and_increment_step`, uses the compiled graph for a batch of one
+        unless `compiled` is False.
+        """
+        t = time.monotonic()
+        if compiled and latent.shape[0] == 1:
+            audio_frame = self._run_compiled(
+                "_compiled_decode_frame", self._decode_frame, latent, mimi_state
+            )
+        else:
+            audio_frame = self._decode_frame(latent, mimi_state)
+        audio_frame_duration = audio_frame.shape[2] / self.config.mimi.sample_rate
+        # We could log the timings here.
+        logger.debug(
+            " " * 30 + "Decoded %d ms of audio with mimi in %d ms",
+            int(audio_frame_duration * 1000),
+            int((time.monotonic() - t) * 1000),
+        )
+        return audio_frame
+
+    @torch.no_grad
+    def _decode_frame(self, latent: torch.Tensor, mimi_state: dict) -> torch.Tensor:
+        mimi_decoding_input = latent * self.flow_lm.emb_std + self.flow_lm.emb_mean
+        transposed = mimi_decoding_input.transpose(-1, -2)
+        quantized = self.mimi.quantizer(transposed)
+        audio_frame = self.mimi.decode_from_latent(quantized, mimi_state)
+        increment_steps(self.mimi, mimi_state, increment=16)
+        return audio_frame
+
+    def _decode_audio_worker(
+        self,
+        latents_queue: queue.Queue,
+        result_queue: queue.Queue,
+        batch_size: int = 1,
+        cancel_event: threading.Event | None = None,
+    ):
+        """Worker thread function for decoding audio latents from queue with immediate streaming.
+
+        Once `cancel_event` is set, the remaining latents are consumed without being decoded.
+        """
         try:
-            audio_chunks = []
-            mimi_state = init_states(self.mimi, batch_size=1, sequence_length=1000)
+            mimi_state = init_states(self.mimi, batch_size=batch_size, sequence_length=1000)
             while True:
                 latent = latents_queue.get()
                 if latent is None:
                     break
-                mimi_decoding_input = latent * self.flow_lm.emb_std + self.flow_lm.emb_mean
-                transposed = mimi_decoding_input.transpose(-1, -2)
-                quantized = self.mimi.quantizer(transposed)
-
-                t = time.monotonic()
-                audio_frame = self.mimi.decode_from_latent(quantized, mimi_state)
-                increment_steps(self.mimi, mimi_state, increment=16)
-                audio_frame_duration = audio_frame.shape[2] / self.config.mimi.sample_rate
-                # We could log the timings here.
-                logger.debug(
-                    " " * 30 + "Decoded %d ms of audio with mimi in %d ms",
-                    int(audio_frame_duration * 1000),
-                    int((time.monotonic() - t) * 1000),
-                )
-                audio_chunks.append(audio_frame)
-
+                if cancel_event is not None and cancel_event.is_set():
+                    continue
+                audio_frame = self._decode_latent(latent, mimi_state)
                 result_queue.put(("chunk", audio_frame))
 
                 latents_queue.task_done()
@@ -298,6 +689,13 @@ class TTSModel(nn.Module):
             # Put error in result queue
             result_queue.put(("error", e))
 
+    def close(self):
+        """Stops the threads generating the sentence chunks, the model cannot generate anymore.
+
+        They are also stopped once the model is garbage collected.
+        """
+        self._worker_pool.close()
+
     @torch.no_grad
     def generate_audio(
         self,
@@ -305,6 +703,9 @@ class TTSModel(nn.Module):
         text_to_generate: str,
         frames_after_eos: int | None = None,
         copy_state: bool = True,
+        long_form: bool = False,
+        seed: int | None = None,
+        cancel_event: threading.Event | None = None,
     ) -> torch.Tensor:
         """Generate complete audio tensor from text input.
 
@@ -325,9 +726,16 @@ class TTSModel(nn.Module):
             frames_after_eos: Number of additional frames to generate after
                 detecting end-of-sequence. If None, automatically determined
                 based on text length (1-3 frames).
-            copy_state: Whether to create a deep copy of the model state before
-                generation. If True, preserves the original state for reuse.
-                If False, modifies the input state in-place. Defaults to True.
+            copy_state: Whether to generate from a copy of the model state. If True,
+                preserves the original state for reuse; only the filled part of the
+                caches is copied. If False, modifies the input state in-place.
+                Defaults to True.
+            long_form: Whether to generate the sentence chunks as one continuous stream,
+                see `generate_audio_stream`. Defaults to False.
+            seed: Seed of the sampling noise, see `generate_audio_stream`. Defaults to
+                None.
+            cancel_event: Event that stops the generation when set, e.g. from another
+                thread, see `generate_audio_stream`. Defaults to None.
 
         Returns:
             torch.Tensor: Generated audio tensor with shape [channels, samples]
@@ -345,10 +753,150 @@ class TTSModel(nn.Module):
             text_to_generate=text_to_generate,
             frames_after_eos=frames_after_eos,
             copy_state=copy_state,
+            long_form=long_form,
+            seed=seed,
+            cancel_event=cancel_event,
         ):
             audio_chunks.append(chunk)
+        if not audio_chunks:
+            return torch.zeros(0)
         return torch.cat(audio_chunks, dim=0)
 
+    @torch.no_grad
+    def generate_audio_batch(
+        self,
+        model_states: list[dict],
+        texts: list[str],
+        frames_after_eos: int | None = None,
+        sequence_length: int = 1000,
+        seeds: list[int | None] | None = None,
+        cancel_event: threading.Event | None = None,
+    ) -> list[torch.Tensor]:
+        """Generate complete audio tensors for several texts at once.
+
+        All the texts are generated together in a single batch, which makes a much
+        better use of the hardware than generating them one after another when there
+        are many of them. Long texts are split into sentence chunks like in
+        `generate_audio_stream()`, and every chunk gets its own row in the batch.
+
+        This method is NOT thread-safe; separate model instances should be used
+        for concurrent generation.
+
+        Args:
+            model_states: Voice state for each text, as obtained from
+                get_state_for_audio_prompt(). The same state can be used for several
+                texts. The states are not modified.
+            texts: Input texts to convert to speech.
+            frames_after_eos: Number of additional frames to generate after
+                detecting end-of-sequence. If None, automatically determined
+                for each sentence chunk.
+            sequence_length: Capacity of the FlowLM cache of each row, in steps.
+            seeds: Seed of the sampling noise of each text, see `generate_audio_stream`.
+                A text is generated with the same noise as by `generate_audio_stream` with
+                the same seed. Texts whose seed is None use the global RNG.
+            cancel_event: Event that stops the generation of all the texts at the next
+                step when set, e.g. from another thread. The audio decoded so far is
+                returned.
+
+        Returns:
+            list[torch.Tensor]: Generated audio for each text, with shape [samples].
+        """
+        if len(model_states) != len(texts):
+            raise ValueError(
+                f"Got {len(model_states)} model states for {len(texts)} texts, "
+                "there should be exactly one state per text."
+            )
+
+        if seeds is None:
+            seeds = [None] * len(texts)
+        if len(seeds) != len(texts):
+            raise ValueError(f"Got {len(seeds)} seeds for {len(texts)} texts.")
+
+        rows = []  # (text index, chunk, frames after eos)
+        generators = []
+        for text_index, text in enumerate(texts):
+            text_chunks = split_into_best_sentences(self.flow_lm.conditioner.tokenizer, text)
+            generators.extend(
+                chunk_generators(seeds[text_index], len(text_chunks), self.flow_lm.device)
+            )
+            for chunk in text_chunks:
+                _, frames_after_eos_guess = prepare_text_prompt(chunk)
+                if frames_after_eos is None:
+                    rows.append((text_index, chunk, frames_after_eos_guess + 2))
+                else:
+                    rows.append((text_index, chunk, frames_after_eos))
+
+        model_state = init_states(
+            self.flow_lm, batch_size=len(rows), sequence_length=sequence_length
+        )
+        max_gen_len = []
+        with display_execution_time("Prompting text"):
+            for row, (text_index, chunk, _) in enumerate(rows):
+                copy_state_rows(self.flow_lm, model_state, row, model_states[text_index], 0)
+                self._prompt_text_or_use_cache(
+                    narrow_states(self.flow_lm, model_state, row, 1), chunk
+                )
+                gen_len_sec = len(chunk.split()) * 1 + 2.0
+                max_gen_len.append(int(gen_len_sec * 12.5))
+
+        latents_queue = queue.Queue()
+        result_queue = queue.Queue()
+        decoder_thread = threading.Thread(
+            target=self._decode_audio_worker,
+            args=(latents_queue, result_queue, len(rows), cancel_event),
+            daemon=True,
+        )
+        t_generating = time.monotonic()
+        decoder_thread.start()
+        try:
+            num_frames = self._autoregressive_generation(
+                model_state,
+                max_gen_len,
+                [fae for _, _, fae in rows],
+                latents_queue,
+                generators if any(g is not None for g in generators) else None,
+                cancel_event,
+            )
+        except Exception:
+            latents_queue.put(None)
+            decoder_thread.join()
+            raise
+
+        audio_frames = []
+        while True:
+            kind, value = result_queue.get()
+            if kind == "chunk":
+                audio_frames.append(value)
+            elif kind == "done":
+                break
+            elif kind == "error":
+                decoder_thread.join()
+                raise value
+        decoder_thread.join()
+
+        frame_size = self.mimi.frame_size
+        if audio_frames:
+            batch_audio = torch.cat(audio_frames, dim=-1)[:, 0]
+        else:
+            batch_audio = torch.zeros((len(rows), 0))
+        audio_per_text = [[] for _ in texts]
+        for row, (text_index, _, _) in enumerate(rows):
+            audio_per_text[text_index].append(batch_audio[row, : num_frames[row] * frame_size])
+        results = [torch.cat(chunks, dim=0) for chunks in audio_per_text]
+
+        duration_generated_audio = int(
+            sum(x.shape[-1] for x in results) * 1000 / self.config.mimi.sample_rate
+        )
+        generation_time = int((time.monotonic() - t_generating) * 1000)
+        logger.info(
+            "Generated: %d ms of audio for %d texts in %d ms so %.2fx faster than real-time",
+            duration_generated_audio,
+            len(texts),
+            generation_time,
+            duration_generated_audio / max(generation_time, 1),
+        )
+        return results
+
     @torch.no_grad
     def generate_audio_stream(
         self,
@@ -356,6 +904,9 @@ class TTSModel(nn.Module):
         text_to_generate: str,
         frames_after_eos: int | None = None,
         copy_state: bool = True,
+        long_form: bool = False,
+        seed: int | None = None,
+        cancel_event: threading.Event | None = None,
     ):
         """Generate audio streaming chunks from text input.
 
@@ -365,6 +916,24 @@ class TTSModel(nn.Module):
         This method is NOT thread-safe; separate model instances should be used
         for concurrent generation.
 
+        Long texts are split into sentence chunks. By default, every chunk is generated
+        from the voice state alone. With `long_form`, each chunk continues from the
+        previous one instead: the latents generated for the previous chunks stay in the
+        FlowLM cache as context, and the Mimi decoder is not reset between chunks, so the
+        whole text is rendered as one continuous stream. The cache is a ring buffer that
+        keeps the voice prompt, see `get_state_for_audio_prompt`, so the memory and the
+        time of each step stay the same however long the text is.
+
+        The noise of the flow is drawn from the global RNG, unless a `seed` is given: then
+        each sentence chunk draws its noise from its own generator, derived from the seed,
+        and the same request always gives the same audio on the same machine. It is not
+        affected by the other threads using the global RNG, which makes the output
+        cacheable and comparable across builds.
+
+        The generation stops at the next step when the generator is closed before the end,
+        e.g. when the caller stops iterating, or when `cancel_event` is set. Then no more
+        latents are generated or decoded, instead of running to the end of the text.
+
         Args:
             model_state: Model state dictionary containing hidden states and
                 positional information. Can be obtained from get_state_for_audio_prompt()
@@ -375,9 +944,17 @@ class TTSModel(nn.Module):
             frames_after_eos: Number of additional frames to generate after
                 detecting end-of-sequence. If None, automatically determined
                 based on text length (1-3 frames). Defaults to None.
-            copy_state: Whether to create a deep copy of the model state before
-                generation. If True, preserves the original state for reuse.
-                If False, modifies the input state in-place. Defaults to True.
+            copy_state: Whether to generate from a copy of the model state. If True,
+                preserves the original state for reuse; only the filled part of the
+                caches is copied. If False, modifies the input state in-place.
+                Defaults to True.
+            long_form: Whether each sentence chunk continues from the previous one,
+                rather than from the voice state. Defaults to False.
+            seed: Seed of the sampling noise. If None, the global RNG is used. Defaults
+                to None.
+            cancel_event: Event that stops the generation when set, e.g. from another
+                thread. The stream then ends early. It is also set if the generator is
+                closed before the end. Defaults to None.
 
         Yields:
             torch.Tensor: Audio chunks with shape [samples] at the model's
@@ -394,48 +971,227 @@ class TTSModel(nn.Module):
             real-time factor (RTF) metrics.
         """
 
-        # This is a very simplistic way of handling long texts. We could do much better
-        # by using teacher forcing, but it would be a bit slower.
-        # TODO: add the teacher forcing method for long texts where we use the audio of one chunk
-        # as conditioning for the next chunk.
-        chunks = split_into_best_sentences(self.flow_lm.conditioner.tokenizer, text_to_generate)
+        # Unless `long_form` is set, long texts are handled by restarting from the voice
+        # state for each chunk. It is a bit faster than `long_form`, whose chunks attend to
+        # the audio of the previous ones, but the chunks do not sound like one take.
+        chunks = []
+        for chunk in split_into_best_sentences(
+            self.flow_lm.conditioner.tokenizer, text_to_generate
+        ):
+            _, frames_after_eos_guess = prepare_text_prompt(chunk)
+            chunks.append((chunk, frames_after_eos_guess + 2))
+        generators = chunk_generators(seed, len(chunks), self.flow_lm.device)
+        if cancel_event is None:
+            cancel_event = threading.Event()
+
+        completed = False
+        try:
+            yield from self._generate_chunks_audio_stream(
+                model_state, chunks, copy_state, long_form, generators, cancel_event
+            )
+            completed = True
+        finally:
+            if not completed:
+                # Stops the generation thread, which would otherwise run to the end.
+                cancel_event.set()
 
-        for chunk in chunks:
-            text_to_generate, frames_after_eos_guess = prepare_text_prompt(chunk)
-            frames_after_eos_guess += 2
+    def _generate_chunks_audio_stream(
+        self,
+        model_state: dict,
+        chunks: list[tuple[str, int]],
+        copy_state: bool,
+        long_form: bool,
+        generators: list,
+        cancel_event: threading.Event,
+    ):
+        if long_form:
+            yield from self._generate_long_form_audio_stream(
+                model_state, chunks, copy_state, generators, cancel_event
+            )
+            return
+
+        if not copy_state:
+            # Each chunk continues from the state left by the previous one.
+            for chunk_index, ((chunk, frames_after_eos_guess), generator) in enumerate(
+                zip(chunks, generators)
+            ):
+                if cancel_event.is_set():
+                    return
+                # Only the first chunk is prompted from the voice state, the next ones follow
+                # generated audio and would fill the cache with entries that never hit.
+                self._prompt_text(model_state, chunk, use_cache=chunk_index == 0)
+                yield from self._generate_audio_stream_short_text(
+                    model_state=model_state,
+                    text_to_generate=chunk,
+                    frames_after_eos=frames_after_eos_guess,
+                    generator=generator,
+                    cancel_event=cancel_event,
+                )
+            return
+
+        # Every chunk starts from the same voice state, which only has to be read once.
+        snapshot = snapshot_states(self.flow_lm, model_state)
+        # The state of the next chunk is prepared in the background while the current
+        # chunk is generated and decoded, so that the next chunk can start right away.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_chunk_state = executor.submit(
+                self._prepare_chunk_state, model_state, snapshot, chunks[0][0]
+            )
+            for chunk_index, (chunk, frames_after_eos_guess) in enumerate(chunks):
+                chunk_state = next_chunk_state.result()
+                if cancel_event.is_set():
+                    self._release_state_buffer(chunk_state)
+                    return
+                if chunk_index + 1 < len(chunks):
+                    next_chunk_state = executor.submit(
+                        self._prepare_chunk_state, model_state, snapshot, chunks[chunk_index + 1][0]
+                    )
+                yield from self._generate_audio_stream_short_text(
+                    model_state=chunk_state,
+                    text_to_generate=chunk,
+                    frames_after_eos=frames_after_eos_guess,
+                    generator=generators[chunk_index],
+                    cancel_event=cancel_event,
+                )
+                # The generation thread is done with the state once all the latents are
+                # decoded. If the caller stops early, the state is not reused since that
+                # thread may still be running.
+                self._release_state_buffer(chunk_state)
+
+    def _generate_long_form_audio_stream(
+        self,
+        model_state: dict,
+        chunks: list[tuple[str, int]],
+        copy_state: bool,
+        generators: list,
+        cancel_event: threading.Event,
+    ):
+        """Generates the chunks one after another into the same FlowLM and Mimi states.
+
+        The latents of a chunk are fed back to the FlowLM as it generates them, so the
+        next chunk is prompted after them and generated with them as context. Once the
+        cache is full, the oldest positions after the voice prompt are overwritten.
+        """
+        state = model_state
+        if copy_state:
+            state = self._acquire_state_buffer(model_state)
+            restore_states(self.flow_lm, state, snapshot_states(self.flow_lm, model_state))
+        # One Mimi state for the whole text, so that there is no discontinuity in the audio
+        # between chunks.
+        mimi_state = init_states(self.mimi, batch_size=1, sequence_length=1000)
+        for chunk_index, ((chunk, frames_after_eos_guess), generator) in enumerate(
+            zip(chunks, generators)
+        ):
+            if cancel_event.is_set():
+                break
+            # Only the first chunk is prompted from the voice state, see `_prompt_text`.
+            self._prompt_text(state, chunk, use_cache=chunk_index == 0)
             yield from self._generate_audio_stream_short_text(
-                model_state=model_state,
+                model_state=state,
                 text_to_generate=chunk,
                 frames_after_eos=frames_after_eos_guess,
-                copy_state=copy_state,
+                mimi_state=mimi_state,
+                generator=generator,
+                cancel_event=cancel_event,
             )
+        if copy_state:
+            self._release_state_buffer(state)
+
+    def _prompt_text(self, model_state: dict, text_to_generate: str, use_cache: bool = True):
+        with display_execution_time("Prompting text"):
+            self._prompt_text_or_use_cache(model_state, text_to_generate, use_cache)
+
+    @torch.no_grad
+    def _prompt_text_or_use_cache(
+        self, model_state: dict, text_to_generate: str, use_cache: bool = True
+    ):
+        """Prompts `model_state` with a text, or applies the result cached for the same state.
+
+        `use_cache` is False for states that do not come straight from a voice prompt, e.g.
+        after the audio of a previous chunk: their entries would never be used again.
+        """
+        key = None
+        if use_cache and self.text_prompt_cache is not None:
+            key = self.text_prompt_cache.key(self.flow_lm, model_state, text_to_generate)
+        if key is not None:
+            delta = self.text_prompt_cache.get(key)
+            if delta is not None and apply_state_delta(self.flow_lm, model_state, delta):
+                return
+        start = int(next(iter(model_state.values()))["offset"][0]) if key is not None else 0
+        prepared = self.flow_lm.conditioner.prepare(text_to_generate)
+        self._prompt_flow_lm_and_increment_step(
+            model_state=model_state, text_tokens=prepared.tokens
+        )
+        if key is not None:
+            delta = state_delta(self.flow_lm, model_state, start)
+            if delta is not None:
+                self.text_prompt_cache.put(key, delta)
+
+    @torch.no_grad
+    def _prepare_chunk_state(
+        self, model_state: dict, snapshot: dict, text_to_generate: str
+    ) -> dict:
+        """Restores the voice state into a buffer and prompts it with the text of a chunk."""
+        chunk_state = self._acquire_state_buffer(model_state)
+        restore_states(self.flow_lm, chunk_state, snapshot)
+        self._prompt_text(chunk_state, text_to_generate)
+        return chunk_state
+
+    def _acquire_state_buffer(self, model_state: dict) -> dict:
+        """Returns a FlowLM state with the same shapes as `model_state`, to be overwritten.
+
+        Buffers are given back with `_release_state_buffer` and reused by the next
+        generations, so that the large caches are not allocated for every sentence.
+        """
+        with self._state_buffers_lock:
+            for i, buffer in enumerate(self._state_buffers):
+                if all(
+                    buffer[module_name][key].shape == value.shape
+                    for module_name, module_state in model_state.items()
+                    for key, value in module_state.items()
+                ):
+                    return self._state_buffers.pop(i)
+        return {
+            module_name: {key: torch.zeros_like(value) for key, value in module_state.items()}
+            for module_name, module_state in model_state.items()
+        }
+
+    def _release_state_buffer(self, buffer: dict):
+        with self._state_buffers_lock:
+            self._state_buffers.append(buffer)
 
     @torch.no_grad
     def _generate_audio_stream_short_text(
-        self, model_state: dict, text_to_generate: str, frames_after_eos: int, copy_state: bool
+        self,
+        model_state: dict,
+        text_to_generate: str,
+        frames_after_eos: int,
+        mimi_state: dict | None = None,
+        generator: torch.Generator | None = None,
+        cancel_event: threading.Event | None = None,
     ):
-        if copy_state:
-            model_state = copy.deepcopy(model_state)
+        """Generates one chunk from `model_state`, which must already be prompted with its text.
 
-        # Set up multithreaded generation and decoding
-        latents_queue = queue.Queue()
-        result_queue = queue.Queue()
+        The audio is decoded from a fresh Mimi state, or continues from `mimi_state`. The
+        noise is drawn from `generator`, or from the global RNG if it is None. The chunk
+        ends early once `cancel_event` is set.
+        """
+        gen_len_sec = len(text_to_generate.split()) * 1 + 2.0
+        max_gen_len = int(gen_len_sec * 12.5)
 
-        # Start decoder worker thread
-        decoder_thread = threading.Thread(
-            target=self._decode_audio_worker, args=(latents_queue, result_queue), daemon=True
-        )
+        # Latents are generated and decoded in parallel by the threads of a pooled worker.
+        result_queue = queue.Queue()
         logger.info("starting timer now!")
         t_generating = time.monotonic()
-        decoder_thread.start()
-
-        # Generate latents and add them to queue (decoder processes them in parallel)
-        self._generate(
-            model_state=model_state,
-            text_to_generate=text_to_generate,
-            frames_after_eos=frames_after_eos,
-            latents_queue=latents_queue,
-            result_queue=result_queue,
+        self._worker_pool.acquire(self).submit(
+            self,
+            model_state,
+            max_gen_len,
+            frames_after_eos,
+            result_queue,
+            mimi_state,
+            generator,
+            cancel_event,
         )
 
         # Stream audio chunks as they become available
@@ -451,16 +1207,9 @@ class TTSModel(nn.Module):
                 # Generation complete
                 break
             elif result[0] == "error":
-                # Wait for decoder thread to finish cleanly before propagating error
-                with display_execution_time("Waiting for mimi decoder to finish"):
-                    decoder_thread.join()
                 # Propagate error
                 raise result[1]
 
-        # Wait for decoder thread to finish cleanly
-        with display_execution_time("Waiting for mimi decoder to finish"):
-            decoder_thread.join()
-
         # Print timing information
         duration_generated_audio = int(
             total_generated_samples * 1000 / self.config.mimi.sample_rate
@@ -476,60 +1225,62 @@ class TTSModel(nn.Module):
         )
 
     @torch.no_grad
-    def _generate(
+    def _autoregressive_generation(
         self,
         model_state: dict,
-        text_to_generate: str,
-        frames_after_eos: int,
+        max_gen_len: int | list[int],
+        frames_after_eos: int | list[int],
         latents_queue: queue.Queue,
-        result_queue: queue.Queue,
-    ):
-        gen_len_sec = len(text_to_generate.split()) * 1 + 2.0
-        max_gen_len = int(gen_len_sec * 12.5)
-        prepared = self.flow_lm.conditioner.prepare(text_to_generate)
-
-        with display_execution_time("Prompting text"):
-            self._run_flow_lm_and_increment_step(
-                model_state=model_state, text_tokens=prepared.tokens
-            )
-
-        def run_generation():
-            try:
-                self._autoregressive_generation(
-                    model_state, max_gen_len, frames_after_eos, latents_queue
-                )
-            except Exception as e:
-                logger.error(f"Error in autoregressive generation: {e}")
-                # Signal decoder to stop by putting None (completion sentinel)
-                if latents_queue is not None:
-                    latents_queue.put(None)
-                # Report error to main thread
-                if result_queue is not None:
-                    result_queue.put(("error", e))
-
-        generation_thread = threading.Thread(target=run_generation, daemon=True)
-        generation_thread.start()
-
-    @torch.no_grad
-    def _autoregressive_generation(
-        self, model_state: dict, max_gen_len: int, frames_after_eos: int, latents_queue: queue.Queue
-    ):
+        generator: torch.Generator | list | None = None,
+        cancel_event: threading.Event | None = None,
+    ) -> list[int]:
+        """Generates latents until every row of the batch is done.
+
+        `max_gen_len` and `frames_after_eos` can be given per row. The latents of the whole
+        batch are put in the queue at each step, row `i` being done after its first
+        `num_frames[i]` latents, where `num_frames` is the returned list. The noise is
+        drawn from `generator`, see `_sample_noise`. `cancel_event` is checked before each
+        step: once it is set, the rows that are not done yet end at the current step.
+        """
+        if isinstance(max_gen_len, int):
+            max_gen_len = [max_gen_len]
+        if isinstance(frames_after_eos, int):
+            frames_after_eos = [frames_after_eos] * len(max_gen_len)
+        batch_size = len(max_gen_len)
         backbone_input = torch.full(
-            (1, 1, self.flow_lm.ldim),
+            (batch_size, 1, self.flow_lm.ldim),
             fill_value=float("NaN"),
             device=next(iter(self.flow_lm.parameters())).device,
             dtype=self.flow_lm.dtype,
         )
         steps_times = []
-        eos_step = None
-        for generation_step in range(max_gen_len):
+        eos_steps = [None] * batch_size
+        num_frames = [None] * batch_size
+        for generation_step in range(max(max_gen_len)):
+            if cancel_event is not None and cancel_event.is_set():
+                logger.info("Generation cancelled after %d steps", generation_step)
+                num_frames = [generation_step if n is None else n for n in num_frames]
+                break
             with display_execution_time("Generating latent", print_output=False) as timer:
                 next_latent, is_eos = self._run_flow_lm_and_increment_step(
-                    model_state=model_state, backbone_input_latents=backbone_input
+                    model_state=model_state,
+                    backbone_input_latents=backbone_input,
+                    generator=generator,
                 )
-                if is_eos.item() and eos_step is None:
-                    eos_step = generation_step
-                if eos_step is not None and generation_step >= eos_step + frames_after_eos:
+                for row, row_is_eos in enumerate(is_eos[:, 0].tolist()):
+                    if num_frames[row] is not None:
+                        continue
+                    if row_is_eos and eos_steps[row] is None:
+                        eos_steps[row] = generation_step
+                    if (
+                        eos_steps[row] is not None
+                        and generation_step >= eos_steps[row] + frames_after_eos[row]
+                    ):
+                        num_frames[row] = generation_step
+                    elif generation_step == max_gen_len[row]:
+                        num_frames[row] = generation_step
+                        self._handle_missing_eos()
+                if None not in num_frames:
                     break
 
                 # Add generated latent to queue for immediate decoding
@@ -537,15 +1288,23 @@ class TTSModel(nn.Module):
                 backbone_input = next_latent
             steps_times.append(timer.elapsed_time_ms)
         else:
-            if os.environ.get("KPOCKET_TTS_ERROR_WITHOUT_EOS", "0") == "1":
-                raise RuntimeError("Generation reached maximum length without EOS!")
-            logger.warning(
-                "Maximum generation length reached without EOS, this very often indicates an error."
-            )
+            for row in range(batch_size):
+                if num_frames[row] is None:
+                    num_frames[row] = max_gen_len[row]
+                    self._handle_missing_eos()
 
         # Add sentinel value to signal end of generation
         latents_queue.put(None)
-        logger.info("Average generation step time: %d ms", int(statistics.mean(steps_times)))
+        if steps_times:
+            logger.info("Average generation step time: %d ms", int(statistics.mean(steps_times)))
+        return num_frames
+
+    def _handle_missing_eos(self):
+        if os.environ.get("KPOCKET_TTS_ERROR_WITHOUT_EOS", "0") == "1":
+            raise RuntimeError("Generation reached maximum length without EOS!")
+        logger.warning(
+            "Maximum generation length reached without EOS, this very often indicates an error."
+        )
 
     @lru_cache(maxsize=2)
     def _cached_get_state_for_audio_prompt(
@@ -619,22 +1378,42 @@ class TTSModel(nn.Module):
                     audio, conditioning_sample_rate, self.config.mimi.sample_rate, 1
                 )
 
-            with display_execution_time("Encoding audio prompt"):
-                prompt = self._encode_audio(audio_conditioning.unsqueeze(0).to(self.device))
-                # import safetensors.torch
-                # safetensors.torch.save_file(
-                #     {"audio_prompt": prompt},
-                #     "/projects/huggingface/pocket-tts/embeddings/cosette.safetensors"
-                # )
+            prompt = self._get_audio_prompt_conditioning(audio_conditioning, truncate)
+            # import safetensors.torch
+            # safetensors.torch.save_file(
+            #     {"audio_prompt": prompt},
+            #     "/projects/huggingface/pocket-tts/embeddings/cosette.safetensors"
+            # )
 
-        model_state = init_states(self.flow_lm, batch_size=1, sequence_length=1000)
+        model_state = init_states(
+            self.flow_lm, batch_size=1, sequence_length=self.flow_lm_cache_length
+        )
 
         with display_execution_time("Prompting audio"):
-            self._run_flow_lm_and_increment_step(model_state=model_state, audio_conditioning=prompt)
+            self._prompt_flow_lm_and_increment_step(
+                model_state=model_state, audio_conditioning=prompt
+            )
+        # The voice prompt is never overwritten, even when a long generation wraps around
+        # the cache.
+        for module_name, module in stateful_modules(self.flow_lm):
+            module.pin_prefix(model_state[module_name])
 
         return model_state
 
 
+def chunk_generators(seed: int | None, num_chunks: int, device: str) -> list:
+    """Generators of the noise of the sentence chunks of a request seeded with `seed`.
+
+    Every chunk gets its own generator, so that it draws the same noise whether the chunks
+    are generated one after another or as rows of a batch. Returns a list of None if
+    `seed` is None, for the global RNG.
+    """
+    if seed is None:
+        return [None] * num_chunks
+    seeds = torch.randint(2**62, (num_chunks,), generator=torch.Generator().manual_seed(seed))
+    return [torch.Generator(device).manual_seed(chunk_seed) for chunk_seed in seeds.tolist()]
+
+
 def prepare_text_prompt(text: str) -> tuple[str, int]:
     text = text.strip()
     if text == "":
@@ -664,6 +1443,11 @@ def prepare_text_prompt(text: str) -> tuple[str, int]:
 
 
 def split_into_best_sentences(tokenizer, text_to_generate: str) -> list[str]:
+    return list(_split_into_best_sentences(tokenizer, text_to_generate))
+
+
+@lru_cache(maxsize=256)
+def _split_into_best_sentences(tokenizer, text_to_generate: str) -> tuple[str, ...]:
     text_to_generate, _ = prepare_text_prompt(text_to_generate)
     text_to_generate = text_to_generate.strip()
     tokens = tokenizer(text_to_generate)
@@ -712,4 +1496,4 @@ def split_into_best_sentences(tokenizer, text_to_generate: str) -> list[str]:
     if current_chunk != "":
         chunks.append(current_chunk.strip())
 
-    return chunks
+    return tuple(chunks)
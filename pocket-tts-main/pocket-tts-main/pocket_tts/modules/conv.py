@@ -110,7 +110,7 @@ class StreamingConv1d(StatefulModule):
         if TP:
             state["previous"][:] = x[..., -TP:]
             if self.pad_mode == "replicate":
-                state["first"] = torch.zeros_like(state["first"])
+                state["first"][:] = False
         return y
 
 
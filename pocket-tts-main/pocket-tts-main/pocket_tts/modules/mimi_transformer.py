@@ -9,7 +9,12 @@ from typing_extensions import Self
 from pocket_tts.modules.layer_scale import LayerScale
 from pocket_tts.modules.rope import RotaryEmbedding
 from pocket_tts.modules.stateful_module import StatefulModule
-from pocket_tts.modules.transformer import StreamingMultiheadAttention
+from pocket_tts.modules.transformer import (
+    StreamingMultiheadAttention,
+    linear_device_and_dtype,
+    ring_key_positions,
+    ring_slots,
+)
 from pocket_tts.utils.config import FlowLMTransformerConfig
 
 
@@ -34,8 +39,7 @@ def complete(
     B, H, T, D = k.shape
     assert T > 0
     indexes = torch.arange(T, device=end_offset.device, dtype=end_offset.dtype)
-    indexes = indexes + end_offset.view(-1, 1)
-    indexes = indexes % capacity
+    indexes = ring_slots(indexes + end_offset.view(-1, 1), 0, capacity)
     # indexes is [B, T]
     # k is [B, H, T, D]
     # cache is [B, H, T', D]
@@ -47,22 +51,15 @@ def complete(
     keys = cache[0]
     values = cache[1]
 
-    indexes = torch.arange(capacity, device=end_offset.device, dtype=torch.long)
-
-    # end_index correspond to the actual index where the last value was written.
-    last_offset = end_offset.view(-1, 1) + T - 1
-    end_index = last_offset % capacity
-    delta = indexes - end_index
-
-    positions = torch.where(delta <= 0, last_offset + delta, last_offset + delta - capacity)
     end_offset[:] = end_offset + T
-    invalid = indexes >= end_offset.view(-1, 1)
-    positions = torch.where(invalid, torch.full_like(positions, -1), positions)
+    positions = ring_key_positions(end_offset, 0, capacity)
 
     return KVCacheResult(keys, values, positions)
 
 
 class MimiStreamingMultiheadAttention(StatefulModule):
+    state_batch_dims = {"cache": 1}
+
     def __init__(self, embed_dim: int, num_heads: int, context: int, rope: RotaryEmbedding):
         super().__init__()
 
@@ -77,16 +74,35 @@ class MimiStreamingMultiheadAttention(StatefulModule):
 
     def init_state(self, batch_size: int, sequence_length: int) -> dict[str, torch.Tensor]:
         dim_per_head = self.embed_dim // self.num_heads
+        device, dtype = linear_device_and_dtype(self.in_proj)
+        self.rope.reserve(sequence_length, dim_per_head, device)
 
         state = {}
         state["offset"] = torch.zeros(batch_size, dtype=torch.long)
-        state["cache"] = torch.zeros((2, batch_size, self.num_heads, sequence_length, dim_per_head))
+        state["cache"] = torch.zeros(
+            (2, batch_size, self.num_heads, sequence_length, dim_per_head), dtype=dtype
+        )
         state["end_offset"] = torch.zeros(batch_size, dtype=torch.long)
         return state
 
     def increment_step(self, state, increment: int = 1):
         state["offset"] += increment
 
+    def snapshot_state(self, state: dict) -> dict[str, torch.Tensor]:
+        # Until the ring buffer wraps around, the positions after `end_offset` are never read.
+        end = min(int(state["end_offset"].max()), state["cache"].shape[3])
+        return dict(
+            offset=state["offset"].clone(),
+            cache=state["cache"][:, :, :, :end].clone(),
+            end_offset=state["end_offset"].clone(),
+        )
+
+    def restore_state(self, state: dict, snapshot: dict):
+        end = snapshot["cache"].shape[3]
+        state["cache"][:, :, :, :end] = snapshot["cache"]
+        state["offset"].copy_(snapshot["offset"])
+        state["end_offset"].copy_(snapshot["end_offset"])
+
     def _complete_kv(self, k, v, model_state: dict | None) -> KVCacheResult:
         if model_state is None:
             return KVCacheResult.from_kv(k, v)
@@ -71,9 +71,9 @@ class TimestepEmbedder(nn.Module):
         self.mlp = nn.Sequential(*blocks)
         self.frequency_embedding_size = frequency_embedding_size
         half = frequency_embedding_size // 2
-        self.register_buffer(
-            "freqs", torch.exp(-math.log(max_period) * torch.arange(start=0, end=half) / half)
-        )
+        # On the CPU even under `empty_weights`, arithmetic on meta tensors is slow to set up.
+        positions = torch.arange(start=0, end=half, device="cpu")
+        self.register_buffer("freqs", torch.exp(-math.log(max_period) * positions / half))
 
     def forward(self, t):
         args = t * self.freqs.to(t.dtype)
@@ -196,18 +196,30 @@ class SimpleMLPAdaLN(nn.Module):
         :param x: an [N x C] Tensor of inputs.
         :return: an [N x C] Tensor of outputs.
         """
+        return self.forward_embedded(self.cond_embed(c), self.embed_times(s, t), x)
+
+    def embed_times(self, s: torch.Tensor, t: torch.Tensor) -> torch.Tensor:
+        """Combined embedding of the start and target times, see `forward`."""
         # Combine time conditions
         ts = [s, t]
-        x = self.input_proj(x)
         assert len(ts) == self.num_time_conds, (
             f"Expected {self.num_time_conds} time conditions, got {len(ts)}"
         )
         assert self.num_time_conds != 1
-        t_combined = (
+        return (
             sum(self.time_embed[i](ts[i]) for i in range(self.num_time_conds)) / self.num_time_conds
         )
-        c = self.cond_embed(c)
-        y = t_combined + c
+
+    def forward_embedded(
+        self, c_emb: torch.Tensor, t_emb: torch.Tensor, x: torch.Tensor
+    ) -> torch.Tensor:
+        """Same as `forward`, from the outputs of `cond_embed` and `embed_times`.
+
+        Both only depend on the conditioning and on the times, so they can be computed once
+        for all the steps of a decoding, or once for all the decodings.
+        """
+        x = self.input_proj(x)
+        y = t_emb + c_emb
 
         for block in self.res_blocks:
             x = block(x, y)
@@ -3,19 +3,32 @@ import math
 import torch
 from torch import nn
 
+# Beyond this many positions, the tables are not extended and cos and sin are computed
+# on the fly instead, e.g. for the Mimi decoder whose offset keeps growing with the audio.
+MAX_TABLE_POSITIONS = 16384
+
+
+def _rope_frequencies(D: int, max_period: int | float, device) -> torch.Tensor:
+    ds = torch.arange(D // 2, device=device, dtype=torch.float32)
+    return torch.exp(ds * (-math.log(max_period) * 2 / D))
+
 
 def apply_rope(
     q: torch.Tensor,
     k: torch.Tensor,
     offset: int | torch.Tensor = 0,
     max_period: int | float = 10_000,
+    tables: tuple[torch.Tensor, torch.Tensor] | None = None,
 ):
     """
     Args:
         q (torch.Tensor): Queries, shape `[B, T, H, D]`.
         k (torch.Tensor): Keys, shape `[B, T, H, D]`.
-        offset (int): Current offset, e.g. when streaming.
+        offset (int or torch.Tensor): Current offset, e.g. when streaming. Can be a
+            tensor of shape `[B]` when each row of the batch is at its own offset.
         max_period (float): Maximum period for the cos and sin.
+        tables (tuple of torch.Tensor, optional): Precomputed cos and sin, of shape
+            `[positions, D // 2]`, covering every position that is rotated.
     """
 
     B, T, H, D = q.shape
@@ -25,13 +38,27 @@ def apply_rope(
     assert D % 2 == 0
     assert max_period > 0
 
-    ds = torch.arange(D // 2, device=q.device, dtype=torch.float32)
-    freqs = torch.exp(ds * (-math.log(max_period) * 2 / D))
-
-    # could be optimized in one call
-    ts = torch.arange(T, device=q.device, dtype=torch.float32)
-    ts += offset
-    ts = ts.view(-1, 1, 1)
+    if tables is not None:
+        cos, sin = tables
+        if isinstance(offset, torch.Tensor):
+            positions = offset.view(-1, 1) + torch.arange(T, device=offset.device)
+            rotr = cos[positions].view(-1, T, 1, D // 2)
+            roti = sin[positions].view(-1, T, 1, D // 2)
+        else:
+            rotr = cos[offset : offset + T].view(T, 1, D // 2)
+            roti = sin[offset : offset + T].view(T, 1, D // 2)
+    else:
+        freqs = _rope_frequencies(D, max_period, q.device)
+
+        # could be optimized in one call
+        ts = torch.arange(T, device=q.device, dtype=torch.float32)
+        if isinstance(offset, torch.Tensor):
+            ts = ts.view(1, -1, 1, 1) + offset.view(-1, 1, 1, 1)
+        else:
+            ts += offset
+            ts = ts.view(-1, 1, 1)
+        rotr = torch.cos(freqs * ts)
+        roti = torch.sin(freqs * ts)
 
     q = q.view(B, T, H, D // 2, 2)
     k = k.view(B, T, Hk, D // 2, 2)
@@ -43,8 +70,6 @@ def apply_rope(
     kr = k[..., 0].float()
     ki = k[..., 1].float()
 
-    rotr = torch.cos(freqs * ts)
-    roti = torch.sin(freqs * ts)
     qor = qr * rotr - qi * roti
     qoi = qr * roti + qi * rotr
 
@@ -58,6 +83,20 @@ def apply_rope(
     return qo.view(B, T, H, D), ko.view(B, T, Hk, D)
 
 
+def _tables_cover(
+    tables: tuple[torch.Tensor, torch.Tensor] | None,
+    num_positions: int,
+    head_dim: int,
+    device: torch.device,
+) -> bool:
+    return (
+        tables is not None
+        and tables[0].shape[0] >= num_positions
+        and tables[0].shape[1] == head_dim // 2
+        and tables[0].device == device
+    )
+
+
 class RotaryEmbedding(nn.Module):
     """Rotary positional embedding (RoPE) from [Su et al 2022](https://arxiv.org/abs/2104.09864).
 
@@ -68,7 +107,42 @@ class RotaryEmbedding(nn.Module):
     def __init__(self, max_period: float | int = 10000.0):
         super().__init__()
         self.max_period = max_period
+        # Cos and sin of the positions seen so far, shared by all the layers using this
+        # embedding. Not a buffer, so that it does not end up in the state dict.
+        self._tables: tuple[torch.Tensor, torch.Tensor] | None = None
+
+    def reserve(
+        self, num_positions: int, head_dim: int, device: torch.device | str
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Precompute the cos and sin tables for the positions [0, num_positions)."""
+        num_positions = min(num_positions, MAX_TABLE_POSITIONS)
+        tables = self._tables
+        if _tables_cover(tables, num_positions, head_dim, torch.device(device)):
+            return tables
+        freqs = _rope_frequencies(head_dim, self.max_period, device)
+        ts = torch.arange(num_positions, device=device, dtype=torch.float32).view(-1, 1)
+        tables = (torch.cos(freqs * ts), torch.sin(freqs * ts))
+        self._tables = tables
+        return tables
+
+    def _get_tables(
+        self, end: int, head_dim: int, device: torch.device
+    ) -> tuple[torch.Tensor, torch.Tensor] | None:
+        tables = self._tables
+        if _tables_cover(tables, end, head_dim, device):
+            return tables
+        if end > MAX_TABLE_POSITIONS:
+            return None
+        # Grow geometrically so that long generations only rebuild the tables a few times.
+        capacity = 0 if tables is None else tables[0].shape[0]
+        return self.reserve(max(end, 2 * capacity), head_dim, device)
 
     def forward(self, q: torch.Tensor, k: torch.Tensor, offset: torch.Tensor | int):
         """Apply rope rotation to query or key tensor."""
-        return apply_rope(q, k, offset, self.max_period)
+        if torch.compiler.is_compiling():
+            # Reading the offset would break the graph, cos and sin are computed in it.
+            return apply_rope(q, k, offset, self.max_period)
+        T, D = q.shape[1], q.shape[3]
+        end = (int(offset.max()) if isinstance(offset, torch.Tensor) else offset) + T
+        tables = self._get_tables(end, D, q.device)
+        return apply_rope(q, k, offset, self.max_period, tables=tables)
@@ -4,13 +4,37 @@ import torch
 from torch import nn
 
 
+def stateful_modules(model: nn.Module) -> list:
+    """The stateful modules of `model`, with their names relative to it.
+
+    The list is built on the first call and cached on `model`, so that the functions below,
+    some of which run at every generation step, do not walk the whole module tree.
+    `TTSModel` builds it when loading; a model whose stateful modules are replaced
+    afterwards needs `rebuild_stateful_modules`.
+    """
+    registry = model.__dict__.get("_stateful_modules")
+    if registry is None:
+        registry = rebuild_stateful_modules(model)
+    return registry
+
+
+def rebuild_stateful_modules(model: nn.Module) -> list:
+    """Finds the stateful modules of `model` again and caches them, see `stateful_modules`."""
+    registry = [
+        (module_name, module)
+        for module_name, module in model.named_modules()
+        if isinstance(module, StatefulModule)
+    ]
+    # Not an attribute set through `nn.Module.__setattr__`, it is only a cache.
+    model.__dict__["_stateful_modules"] = registry
+    return registry
+
+
 def init_states(
     model: nn.Module, batch_size: int, sequence_length: int
 ) -> dict[str, dict[str, torch.Tensor]]:
     result = {}
-    for module_name, module in model.named_modules():
-        if not isinstance(module, StatefulModule):
-            continue
+    for module_name, module in stateful_modules(model):
         module._module_absolute_name = module_name
         module_state = module.init_state(batch_size, sequence_length=sequence_length)
         result[module_name] = module_state
@@ -20,14 +44,67 @@ def init_states(
 def increment_steps(
     module: nn.Module, model_state: dict[str, dict[str, torch.Tensor]], increment: int = 1
 ):
-    # print("incrementing steps by", increment)
-    for module_name, module in module.named_modules():
-        if not isinstance(module, StatefulModule):
-            continue
+    for module_name, module in stateful_modules(module):
         module.increment_step(model_state[module_name], increment)
 
 
+def narrow_states(
+    model: nn.Module, model_state: dict[str, dict[str, torch.Tensor]], start: int, length: int
+) -> dict[str, dict[str, torch.Tensor]]:
+    """Returns a view on the rows [start, start + length) of a batched model state.
+
+    The tensors of the returned state share their storage with `model_state`, so running
+    the model on the narrowed state updates the original one in place.
+    """
+    result = {}
+    for module_name, module in stateful_modules(model):
+        result[module_name] = module.narrow_state(model_state[module_name], start, length)
+    return result
+
+
+def copy_state_rows(
+    model: nn.Module,
+    dst_state: dict[str, dict[str, torch.Tensor]],
+    dst_index: int,
+    src_state: dict[str, dict[str, torch.Tensor]],
+    src_index: int,
+):
+    """Copies one batch row of `src_state` into one batch row of `dst_state`."""
+    for module_name, module in stateful_modules(model):
+        module.copy_state_row(dst_state[module_name], dst_index, src_state[module_name], src_index)
+
+
+def snapshot_states(
+    model: nn.Module, model_state: dict[str, dict[str, torch.Tensor]]
+) -> dict[str, dict[str, torch.Tensor]]:
+    """Returns a compact copy of `model_state`, to be restored later with `restore_states`.
+
+    Unlike `copy.deepcopy`, only the part of the caches that was already written is copied.
+    """
+    result = {}
+    for module_name, module in stateful_modules(model):
+        result[module_name] = module.snapshot_state(model_state[module_name])
+    return result
+
+
+def restore_states(
+    model: nn.Module,
+    dst_state: dict[str, dict[str, torch.Tensor]],
+    snapshot: dict[str, dict[str, torch.Tensor]],
+):
+    """Overwrites `dst_state` in place with a snapshot taken by `snapshot_states`.
+
+    `dst_state` must have the same batch size as the snapshot, and caches large enough
+    to hold it. Its tensors are reused, so no allocation is made.
+    """
+    for module_name, module in stateful_modules(model):
+        module.restore_state(dst_state[module_name], snapshot[module_name])
+
+
 class StatefulModule(ABC, nn.Module):
+    # Dimension of the batch in the state tensors, for the keys where it is not the first one.
+    state_batch_dims: dict[str, int] = {}
+
     def __init__(self, *args, **kwds):
         self._module_absolute_name = None
         return super().__init__(*args, **kwds)
@@ -40,6 +117,28 @@ class StatefulModule(ABC, nn.Module):
     def increment_step(self, state: dict, increment: int = 1):
         pass
 
+    def narrow_state(self, state: dict, start: int, length: int) -> dict[str, torch.Tensor]:
+        """View on the rows [start, start + length) of the state of this module."""
+        return {
+            key: value.narrow(self.state_batch_dims.get(key, 0), start, length)
+            for key, value in state.items()
+        }
+
+    def copy_state_row(self, dst: dict, dst_index: int, src: dict, src_index: int):
+        """Copy the row `src_index` of `src` into the row `dst_index` of `dst`."""
+        for key, value in src.items():
+            batch_dim = self.state_batch_dims.get(key, 0)
+            dst[key].select(batch_dim, dst_index).copy_(value.select(batch_dim, src_index))
+
+    def snapshot_state(self, state: dict) -> dict[str, torch.Tensor]:
+        """Copy of the state of this module, see `snapshot_states`."""
+        return {key: value.clone() for key, value in state.items()}
+
+    def restore_state(self, state: dict, snapshot: dict):
+        """Copy a snapshot taken by `snapshot_state` into `state`, in place."""
+        for key, value in snapshot.items():
+            state[key].copy_(value)
+
     def get_state(self, model_state: dict[str, dict[str, torch.Tensor]]) -> dict[str, torch.Tensor]:
         """Get the state for this module from the model state."""
         return model_state[self._module_absolute_name]
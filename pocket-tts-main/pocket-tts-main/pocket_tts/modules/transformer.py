@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
@@ -7,16 +9,57 @@ from pocket_tts.modules.stateful_module import StatefulModule
 
 
 def complete_kv(
-    cache: torch.Tensor, current_end: torch.Tensor, k: torch.Tensor, v: torch.Tensor
+    cache: torch.Tensor, offsets: list[int], k: torch.Tensor, v: torch.Tensor
 ) -> tuple[torch.Tensor, torch.Tensor]:
-    current_end = current_end.shape[0]
-
-    cache[0, :, current_end : current_end + k.shape[1]] = k
-    cache[1, :, current_end : current_end + v.shape[1]] = v
-    valid = cache[:, :, : current_end + k.shape[1]]
+    T = k.shape[1]
+    if len(set(offsets)) == 1:
+        current_end = offsets[0]
+        cache[0, :, current_end : current_end + T] = k
+        cache[1, :, current_end : current_end + T] = v
+    else:
+        # Rows of a batch can be at different positions, e.g. when sequences join
+        # a running batch, so each row is written at its own offset.
+        for row, current_end in enumerate(offsets):
+            cache[0, row, current_end : current_end + T] = k[row]
+            cache[1, row, current_end : current_end + T] = v[row]
+    valid = cache[:, :, : max(offsets) + T]
     return valid[0], valid[1]
 
 
+def ring_slots(positions: torch.Tensor, pinned: torch.Tensor | int, capacity: int) -> torch.Tensor:
+    """Slots of a ring-buffer cache where the absolute `positions` ([B, T]) are written.
+
+    The first `pinned` positions of each row are never overwritten, the following ones
+    cycle through the remaining `capacity - pinned` slots. Until the cache is full, every
+    position is written at its own index.
+    """
+    if isinstance(pinned, torch.Tensor):
+        pinned = pinned.view(-1, 1)
+    return torch.where(
+        positions < pinned, positions, pinned + (positions - pinned) % (capacity - pinned)
+    )
+
+
+def ring_key_positions(
+    end: torch.Tensor, pinned: torch.Tensor | int, capacity: int
+) -> torch.Tensor:
+    """Absolute position held by each slot of a ring-buffer cache, see `ring_slots`.
+
+    Returns a [B, capacity] tensor for rows where the positions [0, end) were written,
+    with -1 for the slots that were not written yet.
+    """
+    slots = torch.arange(capacity, device=end.device, dtype=torch.long)
+    last = end.view(-1, 1) - 1
+    if isinstance(pinned, torch.Tensor):
+        pinned = pinned.view(-1, 1)
+    # The slot of the last position written, the other slots of the window hold the
+    # positions just before it, wrapping around.
+    delta = slots - ring_slots(last, pinned, capacity)
+    positions = torch.where(delta <= 0, last + delta, last + delta - (capacity - pinned))
+    positions = torch.where(slots < pinned, slots, positions)
+    return torch.where(slots >= end.view(-1, 1), torch.full_like(positions, -1), positions)
+
+
 def _materialize_causal_mask(
     shape: tuple[int, ...], shift: int, device: str | torch.device = "cpu"
 ) -> torch.Tensor:
@@ -31,9 +74,55 @@ def _materialize_causal_mask(
     return mask.to(dtype)
 
 
+@lru_cache(maxsize=32)
+def _cached_causal_mask(num_queries: int, num_keys: int, device: torch.device) -> torch.Tensor:
+    # Only used to prompt text and audio, whose lengths repeat a lot. Not to be modified.
+    return _materialize_causal_mask((num_queries, num_keys), shift=0, device=device)
+
+
+def _materialize_ragged_causal_mask(
+    offsets: torch.Tensor, num_queries: int, num_keys: int, device: str | torch.device = "cpu"
+) -> torch.Tensor:
+    """Causal mask of shape [B, 1, T, S] for rows that are each at their own offset."""
+    pos_q = offsets.view(-1, 1, 1).to(device) + torch.arange(num_queries, device=device).view(-1, 1)
+    pos_k = torch.arange(num_keys, device=device).view(1, 1, -1)
+    mask = torch.zeros(pos_q.shape[:1] + (num_queries, num_keys), device=device)
+    mask.masked_fill_(pos_k > pos_q, float("-inf"))
+    return mask[:, None]
+
+
+def linear_device_and_dtype(linear: nn.Module) -> tuple[torch.device, torch.dtype]:
+    """Device and dtype of the outputs of a linear layer, which may be quantized."""
+    if callable(linear.weight):
+        # Dynamically quantized layers only have a method, and compute in float32.
+        return linear.weight().device, torch.float32
+    return linear.weight.device, linear.weight.dtype
+
+
+def _upgrade_legacy_state(state: dict):
+    """Converts in place a state saved by older versions to the current format.
+
+    Older versions stored the position as the length of a `current_end` tensor of zeros,
+    which was reallocated at every step.
+    """
+    if "current_end" in state:
+        current_end = state.pop("current_end")
+        batch_size = state["cache"].shape[1]
+        state["offset"] = torch.full(
+            (batch_size,), current_end.shape[0], dtype=torch.long, device=state["cache"].device
+        )
+    if "pinned" not in state:
+        state["pinned"] = torch.zeros_like(state["offset"])
+
+
 class StreamingMultiheadAttention(StatefulModule):
     """Similar to `nn.MultiheadAttention` but with support for streaming.
 
+    The cache of the state is a ring buffer: once it is full, the oldest positions are
+    overwritten, except the first `pinned` ones of each row, see `pin_prefix`. So the
+    memory of a stream is bounded by the `sequence_length` of its state, and the
+    attention becomes a sliding window over the positions after the pinned prefix.
+
     Args:
         embed_dim (int): Dimension to project to.
         num_heads (int): Number of heads.
@@ -44,6 +133,8 @@ class StreamingMultiheadAttention(StatefulModule):
         dtype (torch.dtype, optional): dtype to use.
     """
 
+    state_batch_dims = {"cache": 1}
+
     def __init__(self, embed_dim: int, num_heads: int, rope: RotaryEmbedding):
         super().__init__()
 
@@ -59,45 +150,108 @@ class StreamingMultiheadAttention(StatefulModule):
         self.in_proj = nn.Linear(embed_dim, mult * out_dim, bias=False)
         self.out_proj = nn.Linear(embed_dim, mult * embed_dim, bias=False)
 
-    def _get_mask(self, shape: tuple[int, int], shift: int, device: torch.device) -> torch.Tensor:
-        return _materialize_causal_mask(shape, shift=shift, device=device)
+    def _get_mask(
+        self, offsets: torch.Tensor, uniform_offset: int | None, shape: tuple[int, int], device
+    ) -> torch.Tensor | None:
+        if uniform_offset is None:
+            return _materialize_ragged_causal_mask(offsets, *shape, device=device)
+        if shape[0] == 1:
+            # A single query at the end of the sequence sees every key.
+            return None
+        return _cached_causal_mask(*shape, device=device)
 
     def init_state(self, batch_size: int, sequence_length: int) -> dict[str, torch.Tensor]:
         dim_per_head = self.embed_dim // self.num_heads
-        initial_current_end = torch.zeros((0,)).to(self.in_proj.weight.device)
+        device, dtype = linear_device_and_dtype(self.in_proj)
+        self.rope.reserve(sequence_length, dim_per_head, device)
         return dict(
-            current_end=initial_current_end,
-            cache=torch.full(
+            offset=torch.zeros(batch_size, dtype=torch.long, device=device),
+            pinned=torch.zeros(batch_size, dtype=torch.long, device=device),
+            # Zeros rather than NaN: `_forward_whole_cache` reads the unwritten positions,
+            # masked, and a NaN would still leak through the attention.
+            cache=torch.zeros(
                 (2, batch_size, sequence_length, self.num_heads, dim_per_head),
-                float("NaN"),
-                device=self.in_proj.weight.device,
-                dtype=self.in_proj.weight.dtype,
+                device=device,
+                dtype=dtype,
             ),
         )
 
     def increment_step(self, state: dict, increment: int = 1):
-        new_size = state["current_end"].shape[0] + increment
-        state["current_end"] = torch.zeros((new_size,)).to(state["current_end"].device)
+        # The position is a tensor updated in place: no allocation at each step.
+        state["offset"] += increment
 
-    def _complete_kv(self, k, v, state: dict | None):
-        k, v = complete_kv(state["cache"], state["current_end"], k, v)
+    def pin_prefix(self, state: dict):
+        """Keeps the positions written so far, e.g. a voice prompt, when the cache wraps."""
+        _upgrade_legacy_state(state)
+        if int(state["offset"].max()) >= state["cache"].shape[2]:
+            raise ValueError("The cache is full, no position would be left after the prefix")
+        state["pinned"].copy_(state["offset"])
+
+    def copy_state_row(self, dst: dict, dst_index: int, src: dict, src_index: int):
+        _upgrade_legacy_state(src)
+        _upgrade_legacy_state(dst)
+        # Only the positions before the offset hold valid keys and values.
+        end = int(src["offset"][src_index])
+        capacity = src["cache"].shape[2]
+        if end > capacity and dst["cache"].shape[2] != capacity:
+            raise ValueError("A wrapped cache can only be copied into a cache of the same size")
+        end = min(end, capacity)
+        dst["cache"][:, dst_index, :end] = src["cache"][:, src_index, :end]
+        dst["offset"][dst_index] = src["offset"][src_index]
+        dst["pinned"][dst_index] = src["pinned"][src_index]
+
+    def snapshot_state(self, state: dict) -> dict[str, torch.Tensor]:
+        _upgrade_legacy_state(state)
+        # The cache is mostly empty: keep only the positions written by at least one row.
+        end = min(int(state["offset"].max()), state["cache"].shape[2])
+        return dict(
+            offset=state["offset"].clone(),
+            pinned=state["pinned"].clone(),
+            cache=state["cache"][:, :, :end].clone(),
+        )
+
+    def restore_state(self, state: dict, snapshot: dict):
+        _upgrade_legacy_state(state)
+        end = snapshot["cache"].shape[2]
+        state["cache"][:, :, :end] = snapshot["cache"]
+        state["offset"].copy_(snapshot["offset"])
+        if "pinned" in snapshot:
+            state["pinned"].copy_(snapshot["pinned"])
+        else:
+            state["pinned"].zero_()
+
+    def _complete_kv(self, k, v, offsets: list[int], state: dict | None):
+        k, v = complete_kv(state["cache"], offsets, k, v)
         return k, v
 
-    def _apply_rope(self, query: torch.Tensor, key: torch.Tensor, state: dict | None):
+    def _apply_rope(
+        self, query: torch.Tensor, key: torch.Tensor, offset: torch.Tensor | int
+    ) -> tuple[torch.Tensor, torch.Tensor]:
         # Apply rope embeddings to query and key tensors.
-        streaming_offset = self._streaming_offset(state)
-        return self.rope(query, key, offset=streaming_offset)
-
-    def _streaming_offset(self, state: dict | None) -> torch.Tensor | int:
-        return state["current_end"].shape[0]
+        return self.rope(query, key, offset=offset)
 
     def check_model_state(self, model_state: dict):
         if model_state is None:
             raise ValueError("model_state must be provided")
-        return self.get_state(model_state)
+        state = self.get_state(model_state)
+        _upgrade_legacy_state(state)
+        return state
 
     def forward(self, query: torch.Tensor, model_state: dict | None):
         state = self.check_model_state(model_state)
+        if torch.compiler.is_compiling():
+            return self._forward_whole_cache(query, state)
+        offsets = state["offset"].tolist()
+        capacity = state["cache"].shape[2]
+        if max(offsets) + query.shape[1] > capacity:
+            if query.shape[1] > capacity - int(state["pinned"].max()):
+                raise ValueError(
+                    f"Cannot feed {query.shape[1]} positions at once to a cache of "
+                    f"{capacity} positions with a prefix of {int(state['pinned'].max())}"
+                )
+            # The cache wraps around: its slots are no longer in the order of the positions.
+            return self._forward_whole_cache(query, state)
+        uniform_offset = offsets[0] if len(set(offsets)) == 1 else None
 
         projected = self.in_proj(query)
         # Reshape from (b, t, p*h*d) to (b, t, p, h, d) where p=3, h=num_heads
@@ -105,13 +259,12 @@ class StreamingMultiheadAttention(StatefulModule):
         d = self.embed_dim // self.num_heads
         packed = projected.view(b, t, 3, self.num_heads, d)
         q, k, v = torch.unbind(packed, dim=2)
-        q, k = self._apply_rope(q, k, state)
-        k, v = self._complete_kv(k, v, state)
-
-        mask_shape = (query.shape[1], query.shape[1] + state["current_end"].shape[0])
-        shift = state["current_end"].shape[0]
+        streaming_offset = state["offset"] if uniform_offset is None else uniform_offset
+        q, k = self._apply_rope(q, k, streaming_offset)
+        k, v = self._complete_kv(k, v, offsets, state)
 
-        attn_mask = self._get_mask(mask_shape, shift=shift, device=q.device)
+        mask_shape = (query.shape[1], k.shape[1])
+        attn_mask = self._get_mask(state["offset"], uniform_offset, mask_shape, device=q.device)
 
         q, k, v = [x.transpose(1, 2) for x in (q, k, v)]
         x = F.scaled_dot_product_attention(q, k, v, attn_mask)
@@ -122,3 +275,36 @@ class StreamingMultiheadAttention(StatefulModule):
         x = self.out_proj(x)
 
         return x
+
+    def _forward_whole_cache(self, query: torch.Tensor, state: dict) -> torch.Tensor:
+        """Same as `forward`, with shapes that do not depend on the offsets.
+
+        The keys and values are written at the slot of their position in the ring buffer,
+        see `ring_slots`, and the queries attend to the whole cache, with the slots holding
+        later positions or nothing masked. It does more work than `forward` but never reads
+        the offsets on the host, so it can be compiled, and it works once the cache wraps.
+        """
+        offset = state["offset"]
+        pinned = state["pinned"]
+        cache = state["cache"]
+        capacity = cache.shape[2]
+        projected = self.in_proj(query)
+        b, t, _ = projected.shape
+        d = self.embed_dim // self.num_heads
+        packed = projected.view(b, t, 3, self.num_heads, d)
+        q, k, v = torch.unbind(packed, dim=2)
+        q, k = self._apply_rope(q, k, offset)
+
+        positions = offset.view(-1, 1) + torch.arange(t, device=offset.device)
+        # Indexing the whole cache, rather than views of it, lets the compiler update it in
+        # place instead of copying it.
+        kv_index = torch.arange(2, device=offset.device).view(2, 1, 1)
+        rows = torch.arange(b, device=offset.device).view(b, 1)
+        cache[kv_index, rows, ring_slots(positions, pinned, capacity)] = torch.stack([k, v])
+        key_positions = ring_key_positions(offset + t, pinned, capacity).view(b, 1, 1, -1)
+        attn_mask = (key_positions >= 0) & (key_positions <= positions.view(b, 1, t, 1))
+
+        q, k, v = [x.transpose(1, 2) for x in (q, cache[0], cache[1])]
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask)
+        x = x.transpose(1, 2).reshape(b, t, self.embed_dim)
+        return self.out_proj(x)
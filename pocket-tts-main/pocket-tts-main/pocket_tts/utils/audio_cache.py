@@ -0,0 +1,73 @@
+"""Size-bounded disk cache of the speech rendered by the server for a voice and a text."""
+
+import hashlib
+from pathlib import Path
+
+import torch
+
+from pocket_tts.data.audio import audio_write
+from pocket_tts.utils.disk_cache import DiskCache
+from pocket_tts.utils.utils import make_cache_directory
+
+# Silence appended to the rendered audio, like at the end of the streamed WAV files.
+TRAILING_SILENCE_SECONDS = 0.2
+
+
+class AudioCache:
+    """Stores finished renderings as WAV files on disk, evicting the least recently used.
+
+    Entries are keyed by the normalized text, the voice, the sampling parameters and the
+    model, so that identical requests (notifications, menu prompts, error messages) are
+    served from disk instead of being generated again. The files have complete WAV
+    headers, unlike the streamed responses whose length is not known in advance.
+
+    Args:
+        cache_dir: Directory of the WAV files. Defaults to an `audio` directory in the
+            pocket_tts cache directory.
+        max_size_mb: Total size of the files, beyond which the least recently used ones
+            are deleted.
+    """
+
+    def __init__(self, cache_dir: str | Path | None = None, max_size_mb: float | int = 512):
+        if cache_dir is None:
+            cache_dir = make_cache_directory() / "audio"
+        self._files = DiskCache(cache_dir, ".wav", int(max_size_mb * 1e6), "audio cache")
+        self.cache_dir = self._files.cache_dir
+
+    @staticmethod
+    def key(
+        text: str,
+        voice: str,
+        temperature: float,
+        lsd_decode_steps: int,
+        eos_threshold: float,
+        seed: int | None,
+        model_signature: str,
+    ) -> str:
+        """Hash of a request, with its text normalized to single spaces.
+
+        `voice` identifies the voice prompt, e.g. its URL or the hash of its content.
+        """
+        normalized_text = " ".join(text.split())
+        hasher = hashlib.sha256()
+        for field in (
+            model_signature,
+            voice,
+            temperature,
+            lsd_decode_steps,
+            eos_threshold,
+            seed,
+            normalized_text,
+        ):
+            hasher.update(f"{field!r}\0".encode())
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        """Contents of the WAV file of `key`, or None if it is not in the cache."""
+        return self._files.read(key, Path.read_bytes)
+
+    def put(self, key: str, audio: torch.Tensor, sample_rate: int):
+        """Writes the rendering of `key`, with the silence added at the end of streams."""
+        silence = torch.zeros(int(sample_rate * TRAILING_SILENCE_SECONDS), dtype=audio.dtype)
+        audio = torch.cat([audio.detach().cpu(), silence])
+        self._files.write(key, lambda path: audio_write(path, audio, sample_rate))
@@ -0,0 +1,198 @@
+"""Fixed workloads to measure the speed of a `TTSModel`, used by the `bench` command."""
+
+import contextlib
+import statistics
+import sys
+import threading
+import time
+
+import torch
+
+from pocket_tts.models.batch_scheduler import BatchScheduler
+
+SHORT_TEXT = "Hello world, this is a short sentence."
+PARAGRAPH_TEXT = (
+    "The old lighthouse stood at the edge of the cliff, its white paint peeling in the salty "
+    "wind. Every evening, the keeper climbed the spiral stairs to light the lamp. Ships far "
+    "out at sea would see the beam sweep across the water and know they were close to home. "
+    "Nobody in the village could remember a night when the light had not been lit."
+)
+LONG_FORM_TEXT = " ".join([PARAGRAPH_TEXT] * 4)
+
+WORKLOADS = ["short", "paragraph", "long-form", "concurrent"]
+
+
+class _Timings:
+    """Durations of the FlowLM generation steps and of the Mimi decoding of frames."""
+
+    def __init__(self):
+        self.flow_lm_steps_ms = []
+        self.mimi_frames_ms = []
+        self._lock = threading.Lock()
+
+    def add(self, values: list[float], duration_ms: float):
+        with self._lock:
+            values.append(duration_ms)
+
+
+@contextlib.contextmanager
+def _record_timings(tts_model):
+    """Times every generation step and frame decoding of `tts_model` while active."""
+    timings = _Timings()
+    run_flow_lm = tts_model._run_flow_lm_and_increment_step
+    decode_latent = tts_model._decode_latent
+
+    def timed_run_flow_lm(*args, **kwargs):
+        t = time.perf_counter()
+        result = run_flow_lm(*args, **kwargs)
+        timings.add(timings.flow_lm_steps_ms, (time.perf_counter() - t) * 1000)
+        return result
+
+    def timed_decode_latent(*args, **kwargs):
+        t = time.perf_counter()
+        result = decode_latent(*args, **kwargs)
+        timings.add(timings.mimi_frames_ms, (time.perf_counter() - t) * 1000)
+        return result
+
+    tts_model._run_flow_lm_and_increment_step = timed_run_flow_lm
+    tts_model._decode_latent = timed_decode_latent
+    try:
+        yield timings
+    finally:
+        del tts_model._run_flow_lm_and_increment_step
+        del tts_model._decode_latent
+
+
+def _percentile(values: list[float], percentile: int) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percentile / 100 * len(values)) - 1))
+    return round(values[index], 3)
+
+
+def _peak_rss_mb() -> float | None:
+    """Peak resident memory of the process so far, including the loading of the model."""
+    try:
+        import resource
+    except ImportError:  # Not available on Windows.
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    if sys.platform == "darwin":
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+def _stream(generate_audio_stream, model_state: dict, text: str, sample_rate: int) -> dict:
+    """Consumes one audio stream, returns its time to first audio and its duration."""
+    t_start = time.perf_counter()
+    time_to_first_audio = None
+    num_samples = 0
+    for chunk in generate_audio_stream(model_state=model_state, text_to_generate=text):
+        if time_to_first_audio is None:
+            time_to_first_audio = time.perf_counter() - t_start
+        num_samples += chunk.shape[-1]
+    return dict(
+        time_to_first_audio_s=time_to_first_audio,
+        audio_s=num_samples / sample_rate,
+        wall_s=time.perf_counter() - t_start,
+    )
+
+
+def _run_streams(tts_model, model_state: dict, texts: list[str], concurrency: int) -> list[dict]:
+    if concurrency == 1:
+        return [
+            _stream(tts_model.generate_audio_stream, model_state, text, tts_model.sample_rate)
+            for text in texts
+        ]
+
+    # Concurrent requests go through the batch scheduler, like in the server.
+    scheduler = BatchScheduler(tts_model, max_batch_size=concurrency)
+    results = [None] * len(texts)
+
+    def run(index: int):
+        results[index] = _stream(
+            scheduler.generate_audio_stream, model_state, texts[index], tts_model.sample_rate
+        )
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(texts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    scheduler.close()
+    return results
+
+
+def run_workload(
+    tts_model, model_state: dict, workload: str, repeats: int = 1, concurrency: int = 4
+) -> dict:
+    """Runs a workload `repeats` times and returns its metrics.
+
+    Durations are in seconds, except the per-step and per-frame ones which are in
+    milliseconds. `rtf` is the duration of the generated audio divided by the wall
+    time of each stream, like in the logs: above 1 is faster than real-time.
+    """
+    if workload == "concurrent":
+        texts, stream_concurrency = [PARAGRAPH_TEXT] * concurrency, concurrency
+    else:
+        text = {"short": SHORT_TEXT, "paragraph": PARAGRAPH_TEXT, "long-form": LONG_FORM_TEXT}
+        texts, stream_concurrency = [text[workload]], 1
+
+    streams = []
+    wall_time = 0.0
+    with _record_timings(tts_model) as timings:
+        for _ in range(repeats):
+            t_start = time.perf_counter()
+            streams.extend(_run_streams(tts_model, model_state, texts, stream_concurrency))
+            wall_time += time.perf_counter() - t_start
+
+    audio_time = sum(stream["audio_s"] for stream in streams)
+    times_to_first_audio = [stream["time_to_first_audio_s"] for stream in streams]
+    return dict(
+        streams=len(streams),
+        concurrency=stream_concurrency,
+        audio_s=round(audio_time, 3),
+        wall_s=round(wall_time, 3),
+        time_to_first_audio_s=dict(
+            mean=round(statistics.mean(times_to_first_audio), 4),
+            p50=_percentile(times_to_first_audio, 50),
+            p95=_percentile(times_to_first_audio, 95),
+        ),
+        flow_lm_step_ms=dict(
+            count=len(timings.flow_lm_steps_ms),
+            p50=_percentile(timings.flow_lm_steps_ms, 50),
+            p95=_percentile(timings.flow_lm_steps_ms, 95),
+            p99=_percentile(timings.flow_lm_steps_ms, 99),
+        ),
+        mimi_frame_ms=dict(
+            count=len(timings.mimi_frames_ms),
+            mean=round(statistics.mean(timings.mimi_frames_ms), 3)
+            if timings.mimi_frames_ms
+            else None,
+            p50=_percentile(timings.mimi_frames_ms, 50),
+            p95=_percentile(timings.mimi_frames_ms, 95),
+        ),
+        rtf=round(statistics.mean(stream["audio_s"] / stream["wall_s"] for stream in streams), 3),
+        throughput_audio_s_per_s=round(audio_time / wall_time, 3),
+        peak_rss_mb=_peak_rss_mb(),
+    )
+
+
+def run_benchmark(
+    tts_model,
+    model_state: dict,
+    workloads: list[str],
+    repeats: int = 1,
+    concurrency: int = 4,
+    warmup: bool = True,
+) -> dict:
+    """Runs the given workloads one after another, returns the metrics of each of them."""
+    if warmup:
+        _stream(tts_model.generate_audio_stream, model_state, SHORT_TEXT, tts_model.sample_rate)
+    torch.manual_seed(0)
+    return {
+        workload: run_workload(tts_model, model_state, workload, repeats, concurrency)
+        for workload in workloads
+    }
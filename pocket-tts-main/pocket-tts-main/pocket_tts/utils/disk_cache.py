@@ -0,0 +1,100 @@
+"""Directory of cache files, written atomically and evicted in least recently used order."""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Temporary files older than this were left by a process that died while writing them.
+# Younger ones may still be written by another process sharing the directory.
+_STALE_TEMP_FILE_S = 3600
+
+
+class DiskCache:
+    """Files named after their key in `cache_dir`, with their total size kept under a limit.
+
+    Files are written to a temporary file first, then renamed, so that concurrent readers,
+    in this process or in another one, never see a partial file. Reading a file updates its
+    modification time, and the files modified least recently are deleted first. The size
+    of the directory is measured at each write rather than tracked in memory, so that
+    several processes, like the workers of `pocket-tts serve --workers`, can share it.
+
+    Args:
+        cache_dir: Directory of the files, created if needed.
+        suffix: Extension of the files, e.g. `.wav`.
+        max_size_bytes: Total size of the files, beyond which the least recently used ones
+            are deleted. None for no limit.
+        description: Name of the cache in the log messages.
+    """
+
+    def __init__(
+        self, cache_dir: str | Path, suffix: str, max_size_bytes: int | None, description: str
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.suffix = suffix
+        self.max_size_bytes = max_size_bytes
+        self.description = description
+        self._lock = threading.Lock()
+        self._remove_stale_temp_files()
+        self._evict()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}{self.suffix}"
+
+    def _remove_stale_temp_files(self):
+        for path in self.cache_dir.glob("*.tmp"):
+            try:
+                if time.time() - path.stat().st_mtime > _STALE_TEMP_FILE_S:
+                    path.unlink()
+            except OSError:
+                # Renamed or removed by its writer meanwhile.
+                pass
+
+    def read(self, key: str, load: Callable[[Path], object]) -> object | None:
+        """Result of `load` on the file of `key`, or None if it is missing or unreadable."""
+        path = self._path(key)
+        try:
+            value = load(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Ignoring unreadable %s entry %s: %s", self.description, path, e)
+            return None
+        with contextlib.suppress(OSError):  # Evicted meanwhile.
+            os.utime(path)
+        return value
+
+    def write(self, key: str, save: Callable[[Path], None]):
+        """Writes the file of `key` with `save`, which is given the path to write to."""
+        path = self._path(key)
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        save(temp_path)
+        os.replace(temp_path, path)
+        self._evict()
+
+    def _evict(self):
+        if self.max_size_bytes is None:
+            return
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.cache_dir):
+                if not entry.name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:  # Evicted by another process meanwhile.
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total_size <= self.max_size_bytes:
+                    break
+                with contextlib.suppress(OSError):
+                    os.unlink(path)
+                total_size -= size
@@ -0,0 +1,318 @@
+"""Runs several server processes behind one port, each on its own CPU cores.
+
+A single process generates every request with one pool of torch threads, which stops scaling
+once the threads span several sockets, or when the streams of the batch compete for the same
+cores. The supervisor instead starts worker processes, each pinned to a disjoint set of cores
+with a matching number of torch threads, and dispatches the incoming connections to the worker
+with the fewest connections open.
+"""
+
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Size of the reads when copying bytes between a client and a worker.
+_BUFFER_SIZE = 64 * 1024
+# Interval at which the supervisor checks that the workers are alive.
+_MONITOR_INTERVAL_S = 0.5
+# Delay before restarting a worker that exited, doubled after each exit in a row, up to the max.
+_RESTART_DELAY_S = 1.0
+_MAX_RESTART_DELAY_S = 60.0
+# A worker that ran this long before exiting is not counted as exiting in a row.
+_STABLE_UPTIME_S = 300.0
+_SERVICE_UNAVAILABLE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Length: 0\r\n"
+    b"Retry-After: 5\r\n"
+    b"Connection: close\r\n\r\n"
+)
+
+
+def available_cores() -> list[int]:
+    """CPU cores the current process is allowed to run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores: list[int], num_workers: int) -> list[list[int]]:
+    """Splits `cores` into one contiguous set per worker.
+
+    Neighbouring core ids usually share a socket and its caches. With more workers than
+    cores, each worker gets a single core, shared with other workers.
+    """
+    if num_workers > len(cores):
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    return [
+        cores[i * len(cores) // num_workers : (i + 1) * len(cores) // num_workers]
+        for i in range(num_workers)
+    ]
+
+
+def pin_to_cores(cores: list[int]):
+    """Restricts the current process to `cores`, with one torch thread per core."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    else:
+        logger.warning("CPU affinity is not supported on this platform, workers are not pinned")
+    torch.set_num_threads(len(cores))
+
+
+def listen_locally() -> socket.socket:
+    """Listening socket on a free port of the loopback interface, for a worker."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(128)
+    return sock
+
+
+class _Worker:
+    def __init__(self, index: int, cores: list[int]):
+        self.index = index
+        self.cores = cores
+        self.process = None
+        # Receives the port of the worker once it is ready to accept connections.
+        self.ready = None
+        self.port = None
+        self.num_connections = 0
+        self.start_time = 0.0
+        # Number of times in a row the worker exited shortly after starting.
+        self.num_exits = 0
+        # Time at which a worker that exited is started again.
+        self.restart_time = None
+
+
+class Supervisor:
+    """Starts HTTP server processes and dispatches the connections of clients to them.
+
+    Each worker runs `target(cores, ready, *args)` in a spawned process, forking a process
+    using torch threads is not safe. `target` must pin the process with `pin_to_cores`,
+    load its model, then serve HTTP on a socket from `listen_locally` after sending its port
+    on the `ready` connection, with its app wrapped by `close_after_each_response`. Workers that exit are started again after a delay, doubled
+    each time they exit in a row, and the supervisor stops once one exits `max_restarts`
+    times in a row.
+
+    Connections are dispatched as raw bytes, so the workers see the requests unchanged and a
+    client that disconnects or reads slowly is seen as such by its worker. Since the workers
+    close each connection after its response, every request is dispatched on its own, even
+    from keep-alive clients, and the open connections are the requests in flight.
+
+    Args:
+        target: Entry point of the workers, a module-level function.
+        args: Arguments of `target`, after the cores and the connection.
+        num_workers: Number of worker processes.
+        cores: CPU cores split between the workers, by default all the available ones.
+        max_restarts: Number of times in a row a worker can exit before the supervisor
+            gives up.
+    """
+
+    def __init__(
+        self,
+        target,
+        args: tuple,
+        num_workers: int,
+        cores: list[int] | None = None,
+        max_restarts: int = 5,
+    ):
+        self.target = target
+        self.args = args
+        self.max_restarts = max_restarts
+        core_sets = split_cores(cores or available_cores(), num_workers)
+        self.workers = [_Worker(index, core_set) for index, core_set in enumerate(core_sets)]
+        self._context = multiprocessing.get_context("spawn")
+
+    def run(self, host: str, port: int):
+        """Starts the workers, then dispatches connections on `host:port` until interrupted."""
+        try:
+            asyncio.run(self._serve(host, port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for worker in self.workers:
+                if worker.process is not None and worker.process.is_alive():
+                    worker.process.terminate()
+            for worker in self.workers:
+                if worker.process is not None:
+                    worker.process.join()
+                _close_ready(worker)
+
+    def _start(self, worker: _Worker):
+        _close_ready(worker)
+        receiver, sender = self._context.Pipe(duplex=False)
+        worker.ready = receiver
+        worker.port = None
+        process = self._context.Process(
+            target=self.target,
+            args=(worker.cores, sender, *self.args),
+            name=f"pocket-tts-worker-{worker.index}",
+        )
+        process.start()
+        worker.process = process
+        worker.start_time = time.monotonic()
+        worker.restart_time = None
+        sender.close()
+        logger.info("Started worker %d on cores %s", worker.index, worker.cores)
+
+    def _check(self, worker: _Worker) -> bool:
+        """Records the port of a worker that became ready, returns False if it exited."""
+        if worker.port is None and worker.ready.poll():
+            with contextlib.suppress(EOFError):
+                worker.port = worker.ready.recv()
+                logger.info("Worker %d is ready", worker.index)
+        return worker.process.is_alive()
+
+    async def _serve(self, host: str, port: int):
+        for worker in self.workers:
+            self._start(worker)
+        while not all(worker.port is not None for worker in self.workers):
+            for worker in self.workers:
+                if not self._check(worker):
+                    raise RuntimeError(f"Worker {worker.index} exited while starting")
+            await asyncio.sleep(_MONITOR_INTERVAL_S)
+
+        stop = asyncio.Event()
+        with contextlib.suppress(NotImplementedError):  # Not available on Windows.
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        server = await asyncio.start_server(self._dispatch, host, port)
+        logger.info(
+            "Dispatching connections on http://%s:%d to %d workers", host, port, len(self.workers)
+        )
+        async with server:
+            while not stop.is_set():
+                for worker in self.workers:
+                    if worker.restart_time is not None:
+                        if time.monotonic() >= worker.restart_time:
+                            self._start(worker)
+                    elif not self._check(worker):
+                        self._schedule_restart(worker)
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stop.wait(), _MONITOR_INTERVAL_S)
+
+    def _schedule_restart(self, worker: _Worker):
+        """Plans the restart of a worker that exited, raises if it exited too often in a row."""
+        uptime = time.monotonic() - worker.start_time
+        worker.num_exits = worker.num_exits + 1 if uptime < _STABLE_UPTIME_S else 1
+        worker.port = None
+        _close_ready(worker)
+        if worker.num_exits > self.max_restarts:
+            raise RuntimeError(
+                f"Worker {worker.index} exited {worker.num_exits} times in a row, "
+                f"last with code {worker.process.exitcode}"
+            )
+        delay = min(_RESTART_DELAY_S * 2 ** (worker.num_exits - 1), _MAX_RESTART_DELAY_S)
+        logger.error(
+            "Worker %d exited with code %s, restarting it in %.0f s",
+            worker.index,
+            worker.process.exitcode,
+            delay,
+        )
+        worker.restart_time = time.monotonic() + delay
+
+    def _least_loaded(self) -> _Worker | None:
+        ready_workers = [worker for worker in self.workers if worker.port is not None]
+        if not ready_workers:
+            return None
+        return min(ready_workers, key=lambda worker: worker.num_connections)
+
+    async def _dispatch(self, client_reader, client_writer):
+        worker = self._least_loaded()
+        worker_writer = None
+        if worker is not None:
+            worker.num_connections += 1
+        try:
+            if worker is None:
+                client_writer.write(_SERVICE_UNAVAILABLE)
+                return
+            try:
+                worker_reader, worker_writer = await asyncio.open_connection(
+                    "127.0.0.1", worker.port
+                )
+            except OSError:
+                # The worker exited, it is restarted by `_serve`.
+                client_writer.write(_SERVICE_UNAVAILABLE)
+                return
+            # Both directions are copied, each end being passed on to the other side, so that a
+            # client that is done sending still gets its response. The exchange is over once
+            # the worker closed the connection after its response, or as soon as a copy fails,
+            # e.g. to a client that is gone: closing the connection of the worker then stops
+            # its generation.
+            to_worker = asyncio.ensure_future(_copy(client_reader, worker_writer))
+            to_client = asyncio.ensure_future(_copy(worker_reader, client_writer))
+            try:
+                done, _ = await asyncio.wait(
+                    [to_worker, to_client], return_when=asyncio.FIRST_COMPLETED
+                )
+                if to_client not in done and to_worker.result():
+                    await to_client
+            finally:
+                for copy in (to_worker, to_client):
+                    copy.cancel()
+                await asyncio.gather(to_worker, to_client, return_exceptions=True)
+        finally:
+            if worker is not None:
+                worker.num_connections -= 1
+            for writer in (client_writer, worker_writer):
+                if writer is not None:
+                    writer.close()
+                    with contextlib.suppress(OSError):
+                        await writer.wait_closed()
+
+
+def _close_ready(worker: _Worker):
+    """Closes the connection on which a worker sent its port, once the worker exited."""
+    if worker.ready is not None:
+        worker.ready.close()
+        worker.ready = None
+
+
+def close_after_each_response(app):
+    """ASGI app answering like `app`, with a `Connection: close` header on every response.
+
+    The HTTP server then closes each connection after its response, so that the next
+    request of the client comes through a new connection, which the supervisor dispatches
+    to the least loaded worker.
+    """
+
+    async def app_closing_connections(scope, receive, send):
+        if scope["type"] != "http":
+            await app(scope, receive, send)
+            return
+
+        async def send_closing_connection(message):
+            if message["type"] == "http.response.start":
+                headers = [
+                    (name, value)
+                    for name, value in message.get("headers", [])
+                    if name.lower() != b"connection"
+                ]
+                message = {**message, "headers": [*headers, (b"connection", b"close")]}
+            await send(message)
+
+        await app(scope, receive, send_closing_connection)
+
+    return app_closing_connections
+
+
+async def _copy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+    """Copies bytes until the end of `reader`, then ends the writing side of `writer`.
+
+    Waits for `writer` to accept each read. Returns False if the connection failed.
+    """
+    try:
+        while data := await reader.read(_BUFFER_SIZE):
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,113 @@
+"""In-memory cache of the FlowLM states obtained by prompting a voice state with a text."""
+
+import collections
+import hashlib
+import threading
+
+import torch
+
+from pocket_tts.modules.stateful_module import stateful_modules
+
+
+class TextPromptCache:
+    """Stores the keys and values written in the FlowLM cache by a text prompt, in an LRU.
+
+    Entries are keyed by the voice state they were prompted from and by the text, so that
+    a frequently repeated sentence (a greeting, a disclaimer, a UI string) spoken by the
+    same voice skips the tokenization, the embedding and the prompting of the FlowLM and
+    goes straight to the generation of latents. Only the positions written by the prompt
+    are stored, as a delta applied on top of the voice state.
+
+    Args:
+        max_entries: Number of (voice, text) pairs kept.
+        max_size_mb: Total size of the stored keys and values, beyond which the least
+            recently used entries are dropped.
+    """
+
+    def __init__(self, max_entries: int = 64, max_size_mb: float | int = 64):
+        self.max_entries = max_entries
+        self.max_size_bytes = int(max_size_mb * 1e6)
+        self._entries = collections.OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(flow_lm: torch.nn.Module, model_state: dict, text: str) -> str | None:
+        """Fingerprint of the state about to be prompted and of the text.
+
+        The keys and values of the last position of the last layer depend on every
+        position before them, so they identify the voice state without hashing all of it.
+        Returns None for batched states and for full caches, which are not cached.
+        """
+        module_name, _ = stateful_modules(flow_lm)[-1]
+        state = model_state[module_name]
+        # States saved by older versions are only upgraded by their first forward.
+        if "offset" not in state or state["offset"].shape[0] != 1:
+            return None
+        end = int(state["offset"][0])
+        if end > state["cache"].shape[2]:
+            # The cache wrapped around, the prompt would not be written contiguously.
+            return None
+        pinned = int(state["pinned"][0]) if "pinned" in state else 0
+        hasher = hashlib.sha256()
+        hasher.update(f"{end} {pinned} {text}".encode())
+        if end > 0:
+            last = state["cache"][:, 0, end - 1]
+            hasher.update(last.detach().to("cpu", torch.float32).contiguous().numpy().tobytes())
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key: str, delta: dict):
+        size = sum(tensor.numel() * tensor.element_size() for tensor in delta.values())
+        if size > self.max_size_bytes:
+            # It would evict every other entry and then itself.
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (delta, size)
+            self._size_bytes += size
+            while len(self._entries) > self.max_entries or self._size_bytes > self.max_size_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size_bytes -= evicted_size
+
+
+def state_delta(flow_lm: torch.nn.Module, model_state: dict, start: int) -> dict | None:
+    """Copy of the keys and values written at the positions [start, offset) of each layer.
+
+    Returns None if the cache wrapped around in between, since the positions would not be
+    contiguous.
+    """
+    delta = {}
+    for module_name, _ in stateful_modules(flow_lm):
+        state = model_state[module_name]
+        end = int(state["offset"][0])
+        if end > state["cache"].shape[2]:
+            return None
+        delta[module_name] = state["cache"][:, :, start:end].clone()
+    return delta
+
+
+def apply_state_delta(flow_lm: torch.nn.Module, model_state: dict, delta: dict) -> bool:
+    """Writes a delta taken by `state_delta` after the current positions, in place.
+
+    Returns False, without modifying the state, if it does not fit in the cache.
+    """
+    modules = stateful_modules(flow_lm)
+    for module_name, _ in modules:
+        state = model_state[module_name]
+        if int(state["offset"][0]) + delta[module_name].shape[2] > state["cache"].shape[2]:
+            return False
+    for module_name, _ in modules:
+        state = model_state[module_name]
+        start = int(state["offset"][0])
+        length = delta[module_name].shape[2]
+        state["cache"][:, :, start : start + length] = delta[module_name]
+        state["offset"] += length
+    return True
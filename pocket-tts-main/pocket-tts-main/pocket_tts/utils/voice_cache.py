@@ -0,0 +1,85 @@
+"""Content-addressed cache of the audio prompt conditionings computed by the Mimi encoder."""
+
+import collections
+import hashlib
+import threading
+from pathlib import Path
+
+import safetensors.torch
+import torch
+
+from pocket_tts.utils.disk_cache import DiskCache
+
+
+class VoiceCache:
+    """Stores the conditioning of audio prompts in an in-memory LRU, optionally backed by disk.
+
+    Entries are keyed by the hash of the audio content and of the model configuration,
+    so uploading the same reference clip again, even under another file name, does not
+    need to run the Mimi encoder. With a `cache_dir`, the conditionings are also stored
+    as safetensors files, which survive restarts and are shared between processes.
+
+    Args:
+        cache_dir: Directory of the safetensors files, None to only keep the conditionings
+            in memory.
+        max_in_memory: Number of conditionings kept in memory.
+        max_size_mb: Total size of the files, beyond which the least recently used ones
+            are deleted.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | Path | None = None,
+        max_in_memory: int = 32,
+        max_size_mb: float | int = 256,
+    ):
+        self._files = None
+        self.cache_dir = None
+        if cache_dir is not None:
+            self._files = DiskCache(
+                cache_dir, ".safetensors", int(max_size_mb * 1e6), "voice cache"
+            )
+            self.cache_dir = self._files.cache_dir
+        self.max_in_memory = max_in_memory
+        self._in_memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(audio: torch.Tensor, model_signature: str, truncate: bool) -> str:
+        """Hash of the audio content (at the model sample rate) and of the model."""
+        hasher = hashlib.sha256()
+        hasher.update(model_signature.encode())
+        hasher.update(b"truncate" if truncate else b"full")
+        hasher.update(str(tuple(audio.shape)).encode())
+        hasher.update(audio.detach().to("cpu", torch.float32).contiguous().numpy().tobytes())
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> torch.Tensor | None:
+        with self._lock:
+            if key in self._in_memory:
+                self._in_memory.move_to_end(key)
+                return self._in_memory[key]
+        if self._files is None:
+            return None
+        conditioning = self._files.read(
+            key, lambda path: safetensors.torch.load_file(path)["audio_prompt"]
+        )
+        if conditioning is not None:
+            self._remember(key, conditioning)
+        return conditioning
+
+    def put(self, key: str, conditioning: torch.Tensor):
+        conditioning = conditioning.detach().to("cpu").contiguous()
+        self._remember(key, conditioning)
+        if self._files is None:
+            return
+        self._files.write(
+            key, lambda path: safetensors.torch.save_file({"audio_prompt": conditioning}, path)
+        )
+
+    def _remember(self, key: str, conditioning: torch.Tensor):
+        with self._lock:
+            self._in_memory[key] = conditioning
+            self._in_memory.move_to_end(key)
+            while len(self._in_memory) > self.max_in_memory:
+                self._in_memory.popitem(last=False)
@@ -1,6 +1,25 @@
+import contextlib
 from pathlib import Path
 
 import safetensors
+import torch
+from torch.overrides import TorchFunctionMode
+
+# Random initializations of parameters, skipped by `empty_weights`. Most of them have no fast
+# implementation for meta tensors, and the first one run imports torch's symbolic shapes.
+_INIT_METHODS = {
+    torch.Tensor.normal_,
+    torch.Tensor.uniform_,
+    torch.nn.init.normal_,
+    torch.nn.init.uniform_,
+    torch.nn.init.trunc_normal_,
+    torch.nn.init.kaiming_normal_,
+    torch.nn.init.kaiming_uniform_,
+    torch.nn.init.xavier_normal_,
+    torch.nn.init.xavier_uniform_,
+    torch.nn.init.orthogonal_,
+}
+_RANDOM_FACTORIES = {torch.randn, torch.rand}
 
 
 def get_flow_lm_state_dict(path: Path) -> dict:
@@ -33,3 +52,40 @@ def get_mimi_state_dict(path: Path) -> dict:
 
             state_dict[key.removeprefix("model.")] = f.get_tensor(key)
     return state_dict
+
+
+def load_weights(module: torch.nn.Module, state_dict: dict):
+    """Loads `state_dict` in `module` by assigning its tensors to the parameters, not copying.
+
+    The tensors read by `safetensors` map the file in memory: the weights are read lazily
+    and their pages are shared by every process loading the same file. `module` can be
+    built on the meta device, without initializing its parameters. Tensors stored with
+    another dtype than the parameter they are loaded in are converted.
+    """
+    module_tensors = module.state_dict(keep_vars=True)
+    for key, tensor in state_dict.items():
+        if key in module_tensors and tensor.dtype != module_tensors[key].dtype:
+            state_dict[key] = tensor.to(module_tensors[key].dtype)
+    module.load_state_dict(state_dict, strict=True, assign=True)
+
+
+class _SkipInitialization(TorchFunctionMode):
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func in _INIT_METHODS:
+            # `torch.nn.init` functions get the tensor as a keyword argument.
+            return args[0] if args else kwargs["tensor"]
+        if func in _RANDOM_FACTORIES:
+            kwargs.pop("generator", None)
+            func = torch.empty
+        return func(*args, **kwargs)
+
+
+@contextlib.contextmanager
+def empty_weights():
+    """Builds modules on the meta device, without initializing their parameters.
+
+    Their weights take no memory and no time until `load_weights` assigns the loaded ones.
+    """
+    with torch.device("meta"), _SkipInitialization():
+        yield
@@ -1,3 +1,28 @@
 import os
+import socket
+
+import pytest
 
 os.environ["POCKET_TTS_ERROR_WITHOUT_EOS"] = "1"
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "network: needs the Hugging Face Hub, skipped when it cannot be reached"
+    )
+
+
+def _hub_is_reachable() -> bool:
+    try:
+        socket.create_connection(("huggingface.co", 443), timeout=5).close()
+    except OSError:
+        return False
+    return True
+
+
+def pytest_collection_modifyitems(config, items):
+    network_items = [item for item in items if "network" in item.keywords]
+    if network_items and not _hub_is_reachable():
+        skip = pytest.mark.skip(reason="The Hugging Face Hub cannot be reached")
+        for item in network_items:
+            item.add_marker(skip)
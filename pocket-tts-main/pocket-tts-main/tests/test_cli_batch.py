@@ -0,0 +1,112 @@
+"""Integration tests for the CLI batch command using real implementation."""
+
+import json
+
+import pytest
+from typer.testing import CliRunner
+
+from pocket_tts.data.audio import audio_read
+from pocket_tts.main import cli_app
+
+# The model is downloaded by the worker processes.
+pytestmark = pytest.mark.network
+
+runner = CliRunner()
+
+
+def test_batch_jsonl_manifest_and_resume(tmp_path):
+    """Test that each row gets a WAV file and that a second run skips existing files."""
+    manifest = tmp_path / "manifest.jsonl"
+    rows = [
+        {"id": "first", "text": "Hello world, this is a test."},
+        {"id": "second", "text": "Testing another voice.", "voice": "marius"},
+        {"id": "third", "text": "And a third one."},
+    ]
+    manifest.write_text("\n".join(json.dumps(row) for row in rows))
+    output_dir = tmp_path / "outputs"
+
+    result = runner.invoke(
+        cli_app,
+        [
+            "batch",
+            "--manifest",
+            str(manifest),
+            "--output-dir",
+            str(output_dir),
+            "--num-workers",
+            "2",
+            "--batch-size",
+            "2",
+        ],
+    )
+
+    assert result.exit_code == 0
+    for row in rows:
+        audio, sample_rate = audio_read(output_dir / f"{row['id']}.wav")
+        assert audio.shape[0] == 1  # Mono channel
+        assert audio.shape[1] > 0  # Has audio samples
+        assert sample_rate == 24000
+    results = [json.loads(line) for line in (output_dir / "results.jsonl").read_text().splitlines()]
+    assert sorted(result["id"] for result in results) == ["first", "second", "third"]
+
+    # Resuming: only the missing file is generated again.
+    (output_dir / "second.wav").unlink()
+    result = runner.invoke(
+        cli_app, ["batch", "--manifest", str(manifest), "--output-dir", str(output_dir)]
+    )
+
+    assert result.exit_code == 0
+    assert (output_dir / "second.wav").exists()
+    lines = (output_dir / "results.jsonl").read_text().splitlines()
+    assert [json.loads(line)["id"] for line in lines[3:]] == ["second"]
+
+
+def test_batch_records_failing_rows_and_continues(tmp_path):
+    """A row whose voice cannot be loaded gets an error result, the others are generated."""
+    manifest = tmp_path / "manifest.jsonl"
+    rows = [
+        {"id": "good", "text": "Hello world, this is a test."},
+        {"id": "bad", "text": "This voice does not exist.", "voice": str(tmp_path / "none.wav")},
+        {"id": "other", "text": "And a third one."},
+    ]
+    manifest.write_text("\n".join(json.dumps(row) for row in rows))
+    output_dir = tmp_path / "outputs"
+
+    result = runner.invoke(
+        cli_app,
+        [
+            "batch",
+            "--manifest",
+            str(manifest),
+            "--output-dir",
+            str(output_dir),
+            "--batch-size",
+            "2",
+        ],
+    )
+
+    assert result.exit_code == 1
+    assert (output_dir / "good.wav").exists()
+    assert (output_dir / "other.wav").exists()
+    assert not (output_dir / "bad.wav").exists()
+    results = {
+        result["id"]: result
+        for result in map(json.loads, (output_dir / "results.jsonl").read_text().splitlines())
+    }
+    assert "error" in results["bad"]
+    assert "error" not in results["good"]
+    assert "error" not in results["other"]
+
+
+def test_batch_csv_manifest(tmp_path):
+    """Test batch generation from a CSV manifest."""
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text('id,text,voice\nline,"Hello, world.",alba\n')
+    output_dir = tmp_path / "outputs"
+
+    result = runner.invoke(
+        cli_app, ["batch", "--manifest", str(manifest), "--output-dir", str(output_dir)]
+    )
+
+    assert result.exit_code == 0
+    assert (output_dir / "line.wav").exists()
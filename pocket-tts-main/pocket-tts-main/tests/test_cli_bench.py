@@ -0,0 +1,43 @@
+"""Integration tests for the CLI bench command using real implementation."""
+
+import json
+
+from typer.testing import CliRunner
+
+from pocket_tts.main import cli_app
+
+runner = CliRunner()
+
+
+def test_bench_writes_json_report(tmp_path):
+    """Test that the report has the metrics of each selected workload."""
+    output_path = tmp_path / "report.json"
+    result = runner.invoke(
+        cli_app,
+        [
+            "bench",
+            "--workloads",
+            "short,concurrent",
+            "--concurrency",
+            "2",
+            "--no-warmup",
+            "--output-path",
+            str(output_path),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    report = json.loads(output_path.read_text())
+    assert set(report["workloads"]) == {"short", "concurrent"}
+    assert report["workloads"]["concurrent"]["streams"] == 2
+    for metrics in report["workloads"].values():
+        assert metrics["audio_s"] > 0
+        assert metrics["time_to_first_audio_s"]["p50"] > 0
+        assert metrics["flow_lm_step_ms"]["count"] > 0
+        assert metrics["mimi_frame_ms"]["count"] > 0
+        assert metrics["throughput_audio_s_per_s"] > 0
+
+
+def test_bench_rejects_unknown_workload():
+    result = runner.invoke(cli_app, ["bench", "--workloads", "short,huge"])
+    assert result.exit_code != 0
@@ -0,0 +1,175 @@
+"""Tests for the CLI serve command and its worker processes."""
+
+import http.client
+import http.server
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import uvicorn
+from typer.testing import CliRunner
+
+from pocket_tts.main import cli_app
+from pocket_tts.utils.supervisor import (
+    Supervisor,
+    close_after_each_response,
+    listen_locally,
+    split_cores,
+)
+
+runner = CliRunner()
+
+
+def test_split_cores_gives_each_worker_its_own_cores():
+    core_sets = split_cores(list(range(8)), 3)
+    assert core_sets == [[0, 1], [2, 3, 4], [5, 6, 7]]
+    # With more workers than cores, the cores are shared.
+    assert split_cores([0, 1], 3) == [[0], [1], [0]]
+
+
+def test_serve_rejects_reload_with_several_workers():
+    result = runner.invoke(cli_app, ["serve", "--workers", "2", "--reload"])
+    assert result.exit_code != 0
+    assert "--reload cannot be used with several workers" in result.output
+
+
+class _ProcessIdHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = str(os.getpid()).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _stub_worker(cores, ready):
+    """Worker answering each request with its process id, without loading a model."""
+    sock = listen_locally()
+    server = http.server.HTTPServer(sock.getsockname(), _ProcessIdHandler, bind_and_activate=False)
+    server.socket = sock
+    ready.send(sock.getsockname()[1])
+    ready.close()
+    server.serve_forever()
+
+
+async def _process_id_app(scope, receive, send):
+    body = str(os.getpid()).encode()
+    headers = [(b"content-length", str(len(body)).encode())]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+def _uvicorn_worker(cores, ready):
+    """Worker serving `_process_id_app` like the workers of `serve`, with uvicorn."""
+    sock = listen_locally()
+    ready.send(sock.getsockname()[1])
+    ready.close()
+    app = close_after_each_response(_process_id_app)
+    uvicorn.Server(uvicorn.Config(app, lifespan="off", log_level="warning")).run(sockets=[sock])
+
+
+def _crashing_worker(cores, ready):
+    """Worker exiting as soon as it gets a connection."""
+    sock = listen_locally()
+    ready.send(sock.getsockname()[1])
+    ready.close()
+    sock.accept()
+    os._exit(1)
+
+
+def _exiting_worker(cores, ready):
+    ready.close()
+
+
+def _run_supervisor(port, target, num_workers, max_restarts=5):
+    Supervisor(target, (), num_workers, max_restarts=max_restarts).run("127.0.0.1", port)
+
+
+def _start_supervisor(*args) -> tuple[multiprocessing.Process, int]:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    supervisor = multiprocessing.get_context("spawn").Process(
+        target=_run_supervisor, args=(port, *args)
+    )
+    supervisor.start()
+    # The supervisor listens once its workers are ready.
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return supervisor, port
+        except ConnectionRefusedError:
+            assert time.monotonic() < deadline, "The supervisor did not start"
+            time.sleep(0.1)
+
+
+def _stop_supervisor(supervisor: multiprocessing.Process):
+    os.kill(supervisor.pid, signal.SIGTERM)
+    supervisor.join(timeout=30)
+    assert supervisor.exitcode == 0
+
+
+def test_supervisor_dispatches_connections_to_both_workers():
+    supervisor, port = _start_supervisor(_stub_worker, 2)
+    try:
+        # A connection stays open on the first worker, so the second one gets the next one.
+        connections = [http.client.HTTPConnection("127.0.0.1", port) for _ in range(2)]
+        for connection in connections:
+            connection.connect()
+        process_ids = set()
+        for connection in connections:
+            connection.request("GET", "/")
+            # A client that is done sending still gets its response.
+            connection.sock.shutdown(socket.SHUT_WR)
+            response = connection.getresponse()
+            assert response.status == 200
+            process_ids.add(response.read())
+            connection.close()
+        assert len(process_ids) == 2
+    finally:
+        _stop_supervisor(supervisor)
+
+
+def test_supervisor_closes_keep_alive_connections_after_each_response():
+    """A keep-alive client does not keep its worker: its next request is dispatched anew."""
+    supervisor, port = _start_supervisor(_uvicorn_worker, 1)
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=30) as client:
+            client.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = b""
+            # Ends once the connection is closed, although the client keeps it open.
+            while data := client.recv(65536):
+                response += data
+        assert response.startswith(b"HTTP/1.1 200")
+        assert b"connection: close" in response.lower()
+    finally:
+        _stop_supervisor(supervisor)
+
+
+def test_supervisor_stops_when_a_worker_keeps_exiting():
+    supervisor, port = _start_supervisor(_crashing_worker, 1, 1)
+    deadline = time.monotonic() + 60
+    while supervisor.exitcode is None:
+        assert time.monotonic() < deadline, "The supervisor did not stop"
+        # Each connection dispatched to the worker makes it exit.
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+        except OSError:
+            pass
+        supervisor.join(timeout=0.1)
+    assert supervisor.exitcode != 0
+
+
+def test_restarting_a_worker_closes_its_previous_connection():
+    supervisor = Supervisor(_exiting_worker, (), 1, max_restarts=10)
+    [worker] = supervisor.workers
+    for _ in range(2):
+        supervisor._start(worker)
+        ready = worker.ready
+        worker.process.join()
+        supervisor._schedule_restart(worker)
+        assert ready.closed
+        assert worker.ready is None
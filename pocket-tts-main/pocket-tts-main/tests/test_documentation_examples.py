@@ -49,6 +49,12 @@ def test_load_model():
         variant="b6369a24", temp=0.5, lsd_decode_steps=5, eos_threshold=-3.0
     )
 
+    # Load an int8 model, faster on CPU
+    model = TTSModel.load_model(quantize=True)
+
+    # Load a bfloat16 model, faster on CPUs supporting bfloat16
+    model = TTSModel.load_model(dtype="bfloat16")
+
 
 def test_device():
     from pocket_tts import TTSModel
@@ -125,6 +131,21 @@ def test_generate_audio_stream():
         # Could save chunks to file or play in real-time
 
 
+def test_generate_audio_batch():
+    from pocket_tts import TTSModel
+
+    model = TTSModel.load_model()
+
+    alba = model.get_state_for_audio_prompt("alba")
+    marius = model.get_state_for_audio_prompt("marius")
+
+    audios = model.generate_audio_batch(
+        [alba, marius, alba], ["Hello world!", "Good morning.", "How are you?"]
+    )
+    for audio in audios:
+        print(f"Audio duration: {audio.shape[-1] / model.sample_rate:.2f} seconds")
+
+
 def test_voice_management():
     from pocket_tts import TTSModel
 
@@ -0,0 +1,651 @@
+"""Integration tests for the Python API using real implementation."""
+
+import asyncio
+import gc
+import os
+import threading
+import time
+import weakref
+
+import pytest
+import requests
+import torch
+
+from pocket_tts import TTSModel
+from pocket_tts.models.batch_scheduler import BatchScheduler, QueueFullError
+from pocket_tts.models.flow_lm import _select_typical_candidates
+from pocket_tts.models.generation_worker import WorkerPool
+from pocket_tts.models.tts_model import split_into_best_sentences
+from pocket_tts.modules.stateful_module import init_states, restore_states, snapshot_states
+from pocket_tts.utils.audio_cache import AudioCache
+from pocket_tts.utils.text_prompt_cache import TextPromptCache
+from pocket_tts.utils.voice_cache import VoiceCache
+
+voice_url = "https://huggingface.co/kyutai/tts-voices/resolve/main/expresso/ex01-ex02_default_001_channel1_168s.wav"
+
+
+@pytest.fixture(scope="module")
+def model():
+    """Default model shared by the tests, which must restore any attribute they change."""
+    return TTSModel.load_model()
+
+
+@pytest.fixture(scope="module")
+def voice_state(model):
+    return model.get_state_for_audio_prompt("alba")
+
+
+def test_batch_scheduler_concurrent_streams(model, voice_state):
+    """Concurrent streams are generated together and all of them complete."""
+    scheduler = BatchScheduler(model, max_batch_size=2)
+
+    texts = ["Hello world.", "This is a test.", "A third request waits for a free row."]
+    results = {}
+
+    def generate(text):
+        results[text] = torch.cat(list(scheduler.generate_audio_stream(voice_state, text)))
+
+    threads = [threading.Thread(target=generate, args=(text,)) for text in texts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    scheduler.close()
+
+    for text in texts:
+        assert results[text].dim() == 1
+        assert results[text].shape[0] > 0
+
+
+def test_batch_scheduler_pauses_slow_consumers_and_streams_async(model, voice_state, monkeypatch):
+    """A stream read slowly is paused and resumed without changing its audio."""
+    text = "Hello world. This is a test."
+    expected = model.generate_audio(voice_state, text, seed=3)
+    scheduler = BatchScheduler(model, max_batch_size=2, max_buffered_frames=4)
+    paused, resumed = threading.Event(), threading.Event()
+    pause, resume = scheduler._pause, scheduler._resume
+
+    def signalled_pause(*args):
+        pause(*args)
+        paused.set()
+
+    def signalled_resume(*args):
+        resume(*args)
+        resumed.set()
+
+    monkeypatch.setattr(scheduler, "_pause", signalled_pause)
+    monkeypatch.setattr(scheduler, "_resume", signalled_resume)
+
+    stream = scheduler.generate_audio_stream(voice_state, text, seed=3)
+    chunks = [next(stream)]
+    # Not read meanwhile, the stream fills its buffer and leaves the batch.
+    assert paused.wait(timeout=60)
+    assert not resumed.is_set()
+    chunks.extend(stream)
+    assert resumed.is_set()
+    torch.testing.assert_close(torch.cat(chunks), expected, atol=1e-4, rtol=0)
+
+    async def generate_async():
+        stream = scheduler.generate_audio_stream_async(voice_state, text, seed=3)
+        return torch.cat([chunk async for chunk in stream])
+
+    torch.testing.assert_close(asyncio.run(generate_async()), expected, atol=1e-4, rtol=0)
+    scheduler.close()
+
+
+def hold_admissions(scheduler, monkeypatch):
+    """Makes the worker thread of `scheduler` wait for `release` before starting each chunk.
+
+    Returns the texts of the chunks started, in order, an event set once the worker thread is
+    waiting, and `release`.
+    """
+    started = []
+    waiting, release = threading.Event(), threading.Event()
+    start_chunk = scheduler._start_chunk
+
+    def held_start_chunk(stream, *args):
+        started.append(stream.chunks[0][0])
+        waiting.set()
+        release.wait()
+        return start_chunk(stream, *args)
+
+    monkeypatch.setattr(scheduler, "_start_chunk", held_start_chunk)
+    return started, waiting, release
+
+
+async def generate_async(scheduler, voice_state, text):
+    stream = scheduler.generate_audio_stream_async(voice_state, text)
+    return torch.cat([chunk async for chunk in stream])
+
+
+def test_batch_scheduler_rejects_requests_beyond_the_queue_depth(model, voice_state, monkeypatch):
+    """A full queue raises `QueueFullError`, and completed streams are in the stats."""
+    scheduler = BatchScheduler(model, max_batch_size=1, max_queue_depth=1)
+    assert len(list(scheduler.generate_audio_stream(voice_state, "Hello world."))) > 0
+
+    stats = scheduler.stats()
+    assert stats["completed"] == 1
+    assert stats["queued"] == 0
+    assert stats["service_s"]["p50"] > 0
+
+    _, waiting, release = hold_admissions(scheduler, monkeypatch)
+
+    async def fill_the_queue():
+        # The first stream takes the only row, the second one the only place in the queue.
+        loop = asyncio.get_running_loop()
+        first = asyncio.ensure_future(generate_async(scheduler, voice_state, "First stream."))
+        await loop.run_in_executor(None, waiting.wait)
+        second = asyncio.ensure_future(generate_async(scheduler, voice_state, "Second stream."))
+        # Runs `second` until it waits for its first chunk, once submitted.
+        await asyncio.sleep(0)
+        assert scheduler.stats()["queued"] == 1
+        with pytest.raises(QueueFullError) as error:
+            scheduler.check_queue()
+        assert error.value.retry_after >= 1
+        release.set()
+        await asyncio.gather(first, second)
+
+    asyncio.run(fill_the_queue())
+    assert scheduler.stats()["rejected"] == 1
+    scheduler.close()
+
+
+def test_batch_scheduler_admits_short_texts_first(model, voice_state, monkeypatch):
+    """A short text submitted after a long one, while the batch is full, is started first."""
+    scheduler = BatchScheduler(model, max_batch_size=1)
+    started, waiting, release = hold_admissions(scheduler, monkeypatch)
+    long_text = "This sentence is much longer than the other one and takes a while to say."
+
+    async def queue_texts():
+        loop = asyncio.get_running_loop()
+        first = asyncio.ensure_future(generate_async(scheduler, voice_state, "Hello world."))
+        await loop.run_in_executor(None, waiting.wait)
+        waiting_streams = []
+        for text in [long_text, "Thank you."]:
+            waiting_streams.append(
+                asyncio.ensure_future(generate_async(scheduler, voice_state, text))
+            )
+            await asyncio.sleep(0)
+        assert scheduler.stats()["queued"] == 2
+        release.set()
+        await asyncio.gather(first, *waiting_streams)
+
+    asyncio.run(queue_texts())
+    tokenizer = model.flow_lm.conditioner.tokenizer
+    expected = [
+        split_into_best_sentences(tokenizer, text)[0]
+        for text in ["Hello world.", "Thank you.", long_text]
+    ]
+    assert started == expected
+    scheduler.close()
+
+
+def test_voice_cache_skips_encoder_for_same_audio(model, tmp_path, monkeypatch):
+    """The same audio content, under another file name, is not encoded twice."""
+    monkeypatch.setattr(model, "voice_cache", VoiceCache(tmp_path / "voices"))
+    content = requests.get(voice_url).content
+    (tmp_path / "first.wav").write_bytes(content)
+    (tmp_path / "second.wav").write_bytes(content)
+
+    first_state = model.get_state_for_audio_prompt(tmp_path / "first.wav", truncate=True)
+    assert len(list((tmp_path / "voices").iterdir())) == 1
+
+    def fail_encoding(audio):
+        raise AssertionError("The audio prompt should come from the cache")
+
+    monkeypatch.setattr(model, "_encode_audio", fail_encoding)
+    # A new cache on the same directory simulates a restart.
+    monkeypatch.setattr(model, "voice_cache", VoiceCache(tmp_path / "voices"))
+    second_state = model.get_state_for_audio_prompt(tmp_path / "second.wav", truncate=True)
+
+    for module_name, module_state in first_state.items():
+        assert torch.equal(module_state["offset"], second_state[module_name]["offset"])
+
+
+def test_voice_cache_evicts_files_beyond_its_size(tmp_path):
+    """Only the most recently used conditionings stay on disk, and nothing by default."""
+    in_memory = VoiceCache()
+    in_memory.put("first", torch.zeros(1, 10, 1024))
+    assert in_memory.cache_dir is None
+    assert in_memory.get("first") is not None
+
+    # Each file holds 40 kB, two of them fit.
+    cache = VoiceCache(tmp_path, max_in_memory=1, max_size_mb=0.1)
+    for key in ("first", "second", "third"):
+        cache.put(key, torch.zeros(1, 10, 1024))
+    assert not (tmp_path / "first.safetensors").exists()
+    assert (tmp_path / "third.safetensors").exists()
+    assert VoiceCache(tmp_path).get("second") is not None
+
+
+def test_audio_cache_serves_and_evicts_renderings(tmp_path):
+    """Renderings are found again under a normalized text and evicted past the size limit."""
+    cache = AudioCache(cache_dir=tmp_path, max_size_mb=0.1)
+    key = AudioCache.key("Hello   world.", "alba", 0.7, 1, -4.0, None, "model")
+    assert key == AudioCache.key(" Hello world. ", "alba", 0.7, 1, -4.0, None, "model")
+    assert cache.get(key) is None
+
+    cache.put(key, torch.zeros(24000), 24000)
+    assert cache.get(key)[:4] == b"RIFF"
+    # Survives a restart.
+    assert AudioCache(cache_dir=tmp_path, max_size_mb=0.1).get(key) is not None
+
+    other_key = AudioCache.key("Another sentence.", "alba", 0.7, 1, -4.0, None, "model")
+    cache.put(other_key, torch.zeros(24000), 24000)
+    assert cache.get(key) is None
+    assert cache.get(other_key) is not None
+
+
+def test_audio_cache_directory_is_shared_between_processes(tmp_path):
+    """Caches on one directory, like the workers of a server, share the files and the size."""
+    first, second = AudioCache(tmp_path, max_size_mb=0.1), AudioCache(tmp_path, max_size_mb=0.1)
+    key = AudioCache.key("Hello world.", "alba", 0.7, 1, -4.0, None, "model")
+    first.put(key, torch.zeros(24000), 24000)
+    assert second.get(key) is not None
+
+    other_key = AudioCache.key("Another sentence.", "alba", 0.7, 1, -4.0, None, "model")
+    second.put(other_key, torch.zeros(24000), 24000)
+    assert list(tmp_path.glob("*.wav")) == [tmp_path / f"{other_key}.wav"]
+
+
+def test_audio_cache_accepts_a_str_directory(tmp_path):
+    """The servers pass the directory read from an environment variable as a str."""
+    cache = AudioCache(cache_dir=str(tmp_path / "audio"), max_size_mb=1)
+    key = AudioCache.key("Hello world.", "alba", 0.7, 1, -4.0, None, "model")
+    cache.put(key, torch.zeros(2400), 24000)
+    assert (tmp_path / "audio" / f"{key}.wav").exists()
+
+
+def test_audio_cache_removes_stale_temporary_files(tmp_path):
+    """Temporary files left by a crashed writer are removed, recent ones may still be written."""
+    stale = tmp_path / "a.wav.1.2.tmp"
+    stale.write_bytes(b"partial")
+    os.utime(stale, (0, 0))
+    recent = tmp_path / "b.wav.1.2.tmp"
+    recent.write_bytes(b"partial")
+    AudioCache(cache_dir=tmp_path)
+    assert not stale.exists()
+    assert recent.exists()
+
+
+def test_audio_cache_ignores_unreadable_entries(tmp_path):
+    """An entry that cannot be read is a miss."""
+    cache = AudioCache(cache_dir=tmp_path)
+    key = AudioCache.key("Hello world.", "alba", 0.7, 1, -4.0, None, "model")
+    cache.put(key, torch.zeros(2400), 24000)
+    (tmp_path / f"{key}.wav").unlink()
+    (tmp_path / f"{key}.wav").mkdir()
+    assert cache.get(key) is None
+
+
+def test_generate_audio_does_not_modify_voice_state(model, voice_state):
+    """Chunks are generated into a reused buffer, the voice state itself is left untouched."""
+    before = {
+        module_name: {key: value.clone() for key, value in module_state.items()}
+        for module_name, module_state in voice_state.items()
+    }
+
+    for _ in range(2):
+        model.generate_audio(voice_state, "Hello world. This is a test of the speech model.")
+
+    for module_name, module_state in voice_state.items():
+        end = int(module_state["offset"][0])
+        assert torch.equal(module_state["offset"], before[module_name]["offset"])
+        assert torch.equal(
+            module_state["cache"][:, :, :end], before[module_name]["cache"][:, :, :end]
+        )
+
+
+def test_generation_workers_are_bounded_and_stopped_with_the_model():
+    """Concurrent chunks share a bounded pool of workers, which does not keep the model alive."""
+    model = TTSModel.load_model()
+    voice_state = model.get_state_for_audio_prompt("alba")
+    model._worker_pool.max_workers = 2
+
+    threads = [
+        threading.Thread(target=model.generate_audio, args=(voice_state, "Hello world."))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert model._worker_pool._num_workers == 2
+
+    worker_threads = [
+        thread for worker in model._worker_pool._idle_workers.queue for thread in worker.threads
+    ]
+    model_ref = weakref.ref(model)
+    del model, voice_state
+    gc.collect()
+    assert model_ref() is None
+    for thread in worker_threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+
+
+def test_closing_the_worker_pool_wakes_the_callers_waiting_for_a_worker(model):
+    pool = WorkerPool(max_workers=1)
+    busy_worker = pool.acquire(model)
+    errors = []
+
+    def acquire():
+        try:
+            pool.acquire(model)
+        except RuntimeError as e:
+            errors.append(e)
+
+    waiting_callers = [threading.Thread(target=acquire, daemon=True) for _ in range(2)]
+    for thread in waiting_callers:
+        thread.start()
+    # Both callers wait for the busy worker to be given back.
+    waiters = pool._idle_workers.not_empty._waiters
+    deadline = time.monotonic() + 10
+    while len(waiters) < 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    pool.close()
+    for thread in waiting_callers:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    assert len(errors) == 2
+    busy_worker.close()
+
+
+def test_seeded_generation_is_reproducible(model, voice_state):
+    """A seed gives the same audio, whatever the global RNG and the batch."""
+    text = "Hello world. This is a test."
+
+    audio = model.generate_audio(voice_state, text, seed=42)
+    torch.manual_seed(0)
+    assert torch.equal(audio, model.generate_audio(voice_state, text, seed=42))
+
+    batch = model.generate_audio_batch([voice_state, voice_state], [text, "Other."], seeds=[42, 1])
+    assert batch[0].shape == audio.shape
+    torch.testing.assert_close(batch[0], audio, atol=1e-4, rtol=0)
+
+
+def test_closing_the_stream_stops_the_generation(model, voice_state, monkeypatch):
+    """No more steps are generated once the caller stops iterating."""
+    steps = []
+    generations = []
+    generated = threading.Event()
+    run_flow_lm = model._run_flow_lm_and_increment_step
+    autoregressive_generation = model._autoregressive_generation
+
+    def counted_run_flow_lm(*args, **kwargs):
+        steps.append(None)
+        return run_flow_lm(*args, **kwargs)
+
+    def joinable_generation(*args, **kwargs):
+        generations.append(None)
+        try:
+            return autoregressive_generation(*args, **kwargs)
+        finally:
+            generated.set()
+
+    monkeypatch.setattr(model, "_run_flow_lm_and_increment_step", counted_run_flow_lm)
+    monkeypatch.setattr(model, "_autoregressive_generation", joinable_generation)
+    model.generate_audio(voice_state, "This sentence would take a while to say.")
+    num_steps_to_the_end = len(steps)
+    steps.clear()
+    generations.clear()
+    generated.clear()
+
+    stream = model.generate_audio_stream(
+        voice_state, "This sentence would take a while to say. So would this one."
+    )
+    next(stream)
+    stream.close()
+    # The generation thread returns once it sees the cancellation.
+    assert generated.wait(timeout=60)
+    num_steps = len(steps)
+    assert num_steps < num_steps_to_the_end
+    # Nor is the next chunk started, so no step can follow.
+    assert generations == [None]
+    assert stream.gi_frame is None
+    assert len(steps) == num_steps
+
+    cancel_event = threading.Event()
+    cancel_event.set()
+    assert model.generate_audio(voice_state, "Hello world.", cancel_event=cancel_event).numel() == 0
+
+
+def test_text_prompt_cache_gives_the_prompted_state(model, voice_state, monkeypatch):
+    """Applying a cached prompt gives the same state as prompting the FlowLM."""
+    monkeypatch.setattr(model, "text_prompt_cache", TextPromptCache())
+    snapshot = snapshot_states(model.flow_lm, voice_state)
+    states = []
+    for _ in range(2):
+        state = model._acquire_state_buffer(voice_state)
+        restore_states(model.flow_lm, state, snapshot)
+        model._prompt_text(state, "Thank you for calling.")
+        states.append(state)
+    assert len(model.text_prompt_cache._entries) == 1
+
+    for module_name, module_state in states[0].items():
+        end = int(module_state["offset"][0])
+        assert torch.equal(module_state["offset"], states[1][module_name]["offset"])
+        assert torch.equal(
+            module_state["cache"][:, :, :end], states[1][module_name]["cache"][:, :, :end]
+        )
+
+
+def test_text_prompt_cache_skips_chunks_after_generated_audio(model, voice_state, monkeypatch):
+    """When chunks are chained, only the first one is prompted from the voice and cached."""
+    text = (
+        "The old lighthouse keeper climbed the narrow winding stairs every single evening, "
+        "carrying a small oil lamp and a heavy leather bag full of tools and spare wicks. "
+        "Fishing boats passing far out in the night followed its bright beam safely around "
+        "the sharp black rocks that guard the northern cape of the island."
+    )
+    assert len(split_into_best_sentences(model.flow_lm.conditioner.tokenizer, text)) == 2
+    # Only the prompting matters here.
+    monkeypatch.setattr(model, "_generate_audio_stream_short_text", lambda **kwargs: iter([]))
+    snapshot = snapshot_states(model.flow_lm, voice_state)
+    for long_form, copy_state in [(True, True), (False, False)]:
+        monkeypatch.setattr(model, "text_prompt_cache", TextPromptCache())
+        state = voice_state
+        if not copy_state:
+            state = model._acquire_state_buffer(voice_state)
+            restore_states(model.flow_lm, state, snapshot)
+        model.generate_audio(state, text, long_form=long_form, copy_state=copy_state)
+        assert len(model.text_prompt_cache._entries) == 1
+
+
+def test_text_prompt_cache_is_bounded_by_size():
+    cache = TextPromptCache(max_entries=10, max_size_mb=0.001)
+    # 400 bytes each, so two of them fit in 1000 bytes.
+    for key in ["first", "second", "third"]:
+        cache.put(key, {"layer": torch.zeros(100)})
+    assert cache.get("first") is None
+    assert cache.get("second") is not None
+    assert cache.get("third") is not None
+    cache.put("too large", {"layer": torch.zeros(1000)})
+    assert cache.get("too large") is None
+    assert cache.get("second") is not None
+
+
+def test_long_form_single_chunk_matches_default_generation(model, voice_state):
+    """With a single sentence chunk, chaining chunks makes no difference."""
+    outputs = []
+    for long_form in [False, True]:
+        torch.manual_seed(0)
+        outputs.append(model.generate_audio(voice_state, "Hello world.", long_form=long_form))
+    assert torch.equal(outputs[0], outputs[1])
+
+
+def test_long_form_wraps_the_cache_and_continues_each_chunk(model, voice_state, monkeypatch):
+    """Chained chunks overflow a small cache, which keeps its size and the voice prompt.
+
+    Each chunk is prompted after the previous one rather than from the voice prompt again,
+    and the audio of all of them is decoded by a Mimi state that is never reset.
+    """
+    # Sentences too long to be merged into the same chunk.
+    text = (
+        "The old lighthouse keeper climbed the narrow winding stairs every single evening, "
+        "carrying a small oil lamp and a heavy leather bag full of tools and spare wicks. "
+        "Fishing boats passing far out in the night followed its bright beam safely around "
+        "the sharp black rocks that guard the northern cape of the island. "
+        "Every morning he carefully wrote down the weather, the height of the waves and the "
+        "names of all the ships he had seen in a worn notebook."
+    )
+    num_chunks = len(split_into_best_sentences(model.flow_lm.conditioner.tokenizer, text))
+    assert num_chunks == 3
+    prefix_length = int(next(iter(voice_state.values()))["offset"][0])
+    capacity = prefix_length + 256
+    state = init_states(model.flow_lm, batch_size=1, sequence_length=capacity)
+    restore_states(model.flow_lm, state, snapshot_states(model.flow_lm, voice_state))
+    caches = {name: module_state["cache"] for name, module_state in state.items()}
+    prefixes = {name: cache[:, :, :prefix_length].clone() for name, cache in caches.items()}
+
+    generations, mimi_offsets = [], []
+    mimi_attention = "decoder_transformer.transformer.layers.0.self_attn"
+    autoregressive_generation = model._autoregressive_generation
+    decode_latent = model._decode_latent
+
+    def recorded_generation(model_state, *args, **kwargs):
+        start = int(next(iter(model_state.values()))["offset"][0])
+        num_frames = autoregressive_generation(model_state, *args, **kwargs)
+        end = int(next(iter(model_state.values()))["offset"][0])
+        generations.append((start, end, num_frames[0]))
+        return num_frames
+
+    def recorded_decode_latent(latent, mimi_state):
+        mimi_offsets.append(int(mimi_state[mimi_attention]["offset"][0]))
+        return decode_latent(latent, mimi_state)
+
+    monkeypatch.setattr(model, "_autoregressive_generation", recorded_generation)
+    monkeypatch.setattr(model, "_decode_latent", recorded_decode_latent)
+    audio = model.generate_audio(state, text, copy_state=False, long_form=True)
+
+    assert len(generations) == num_chunks
+    # Neither the FlowLM nor the Mimi positions go back between chunks.
+    for (_, previous_end, _), (start, _, _) in zip(generations, generations[1:]):
+        assert start > previous_end
+    assert generations[-1][1] > capacity
+    for name, cache in caches.items():
+        assert state[name]["cache"] is cache
+        assert torch.equal(cache[:, :, :prefix_length], prefixes[name])
+    assert all(offset < next_offset for offset, next_offset in zip(mimi_offsets, mimi_offsets[1:]))
+    num_frames = sum(num_frames for _, _, num_frames in generations)
+    assert audio.shape[-1] == num_frames * model.mimi.frame_size
+    assert audio.isfinite().all()
+
+
+def test_precomputed_time_embeddings_match_flow_net(model):
+    flow_lm = model.flow_lm
+    torch.manual_seed(0)
+    c, x = torch.randn(2, flow_lm.dim), torch.randn(2, flow_lm.ldim)
+    time_embeddings = flow_lm.lsd_time_embeddings(4)
+    with torch.no_grad():
+        c_emb = flow_lm.flow_net.cond_embed(c)
+        for i in range(4):
+            s, t = torch.full((2, 1), i / 4), torch.full((2, 1), (i + 1) / 4)
+            expected = flow_lm.flow_net(c, s, t, x)
+            actual = flow_lm._run_flow_net(c_emb, time_embeddings, i, x)
+            torch.testing.assert_close(actual, expected)
+
+
+def test_typical_candidate_is_the_medoid():
+    """Each row keeps the candidate with the smallest sum of distances to the others."""
+    candidates = torch.tensor(
+        [[[0.0, 0.0], [1.0, 0.0], [10.0, 0.0]], [[5.0, 5.0], [-5.0, -5.0], [4.0, 4.0]]]
+    )
+    expected = torch.tensor([[1.0, 0.0], [4.0, 4.0]])
+    selected = _select_typical_candidates(candidates)
+    assert torch.equal(selected, expected)
+    # The first candidate is not kept just for coming first.
+    assert not torch.equal(selected, candidates[:, 0])
+
+
+def test_generation_with_several_candidates(monkeypatch):
+    """The candidates of a step are decoded by one call of the flow network."""
+    for num_candidates in [0, 2]:
+        with pytest.raises(ValueError):
+            TTSModel.load_model(num_candidates=num_candidates)
+    model = TTSModel.load_model(num_candidates=3)
+    assert model.num_candidates == 3
+    flow_batch_sizes = set()
+    run_flow_net = model.flow_lm._run_flow_net
+
+    def recorded_run_flow_net(c_emb, time_embeddings, step, x):
+        flow_batch_sizes.add(x.shape[0])
+        return run_flow_net(c_emb, time_embeddings, step, x)
+
+    monkeypatch.setattr(model.flow_lm, "_run_flow_net", recorded_run_flow_net)
+    voice_state = model.get_state_for_audio_prompt("alba")
+    audio = model.generate_audio(voice_state, "Hello world.", seed=0)
+    assert flow_batch_sizes == {3}
+    assert audio.dim() == 1
+    assert audio.shape[0] > 0
+    assert audio.isfinite().all()
+    model.close()
+
+
+def test_quantized_model_is_close_to_float32(model):
+    """With teacher forcing, the int8 backbone gives almost the same outputs as the fp32 one."""
+    outputs = []
+    for model in [model, TTSModel.load_model(quantize=True)]:
+        torch.manual_seed(0)
+        latents = torch.randn(1, 20, model.flow_lm.ldim)
+        model_state = model.get_state_for_audio_prompt("alba")
+        prepared = model.flow_lm.conditioner.prepare("Hello world, this is a test.")
+        with torch.no_grad():
+            text_embeddings = model.flow_lm.conditioner(prepared)
+            outputs.append(
+                model.flow_lm.backbone(
+                    model.flow_lm.input_linear(latents), text_embeddings, latents, model_state
+                )
+            )
+    assert model.quantized
+    similarity = torch.nn.functional.cosine_similarity(outputs[0], outputs[1], dim=-1)
+    assert similarity.min() > 0.99
+
+    audio = model.generate_audio(model_state, "Hello world.")
+    assert audio.abs().max() > 0
+
+
+def test_bfloat16_model_is_close_to_float32(model):
+    """With teacher forcing, the bfloat16 backbone gives almost the same outputs as the fp32 one."""
+    outputs = []
+    for model in [model, TTSModel.load_model(dtype="bfloat16")]:
+        torch.manual_seed(0)
+        latents = torch.randn(1, 20, model.flow_lm.ldim)
+        model_state = model.get_state_for_audio_prompt("alba")
+        prepared = model.flow_lm.conditioner.prepare("Hello world, this is a test.")
+        with torch.no_grad():
+            text_embeddings = model.flow_lm.conditioner(prepared)
+            sequence = latents.to(model.flow_lm.dtype)
+            outputs.append(
+                model.flow_lm.backbone(
+                    model.flow_lm.input_linear(sequence), text_embeddings, sequence, model_state
+                )
+            )
+    assert model_state["transformer.layers.0.self_attn"]["cache"].dtype == torch.bfloat16
+    similarity = torch.nn.functional.cosine_similarity(outputs[0], outputs[1], dim=-1)
+    assert similarity.min() > 0.99
+
+    audio = model.generate_audio(model_state, "Hello world.")
+    assert audio.dtype == torch.float32
+    assert audio.abs().max() > 0
+
+
+@torch.no_grad
+def test_compiled_step_matches_eager():
+    model = TTSModel.load_model(compile=True)
+    assert model._compiled_decode_step is not None
+    model_state = model.get_state_for_audio_prompt("alba")
+    latents = torch.randn(1, 1, model.flow_lm.ldim)
+    noise = torch.randn(1, model.flow_lm.ldim)
+
+    snapshot = snapshot_states(model.flow_lm, model_state)
+    expected, expected_eos = model._decode_step(model_state, latents, noise.clone())
+    restore_states(model.flow_lm, model_state, snapshot)
+    actual, actual_eos = model._compiled_decode_step(model_state, latents, noise.clone())
+    restore_states(model.flow_lm, model_state, snapshot)
+    torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
+    assert torch.equal(actual_eos, expected_eos)
+
+    audio = model.generate_audio(model_state, "Hello world.")
+    assert audio.abs().max() > 0
@@ -0,0 +1,131 @@
+import torch
+
+from pocket_tts.modules.rope import RotaryEmbedding, apply_rope
+from pocket_tts.modules.stateful_module import (
+    increment_steps,
+    init_states,
+    restore_states,
+    snapshot_states,
+)
+from pocket_tts.modules.transformer import (
+    StreamingMultiheadAttention,
+    ring_key_positions,
+    ring_slots,
+)
+
+
+def make_attention() -> StreamingMultiheadAttention:
+    torch.manual_seed(0)
+    attention = StreamingMultiheadAttention(
+        embed_dim=32, num_heads=4, rope=RotaryEmbedding(max_period=10000)
+    )
+    attention.eval()
+    return attention
+
+
+def run_steps(attention, model_state, inputs: torch.Tensor) -> torch.Tensor:
+    outputs = []
+    for step in range(inputs.shape[1]):
+        outputs.append(attention(inputs[:, step : step + 1], model_state))
+        increment_steps(attention, model_state)
+    return torch.cat(outputs, dim=1)
+
+
+@torch.no_grad
+def test_offset_is_updated_in_place():
+    attention = make_attention()
+    model_state = init_states(attention, batch_size=1, sequence_length=16)
+    offset = model_state[""]["offset"]
+    run_steps(attention, model_state, torch.randn(1, 5, 32))
+    assert model_state[""]["offset"] is offset
+    assert offset.tolist() == [5]
+
+
+@torch.no_grad
+def test_legacy_current_end_state():
+    """States saved when the position was the length of `current_end` still work."""
+    attention = make_attention()
+    prompt, inputs = torch.randn(1, 3, 32), torch.randn(1, 4, 32)
+
+    model_state = init_states(attention, batch_size=1, sequence_length=16)
+    attention(prompt, model_state)
+    increment_steps(attention, model_state, increment=3)
+    legacy_state = {"": {"current_end": torch.zeros(3), "cache": model_state[""]["cache"].clone()}}
+
+    expected = run_steps(attention, model_state, inputs)
+    assert torch.equal(run_steps(attention, legacy_state, inputs), expected)
+    assert legacy_state[""]["offset"].tolist() == [7]
+
+
+@torch.no_grad
+def test_snapshot_only_keeps_written_positions():
+    attention = make_attention()
+    prompt, inputs = torch.randn(1, 3, 32), torch.randn(1, 4, 32)
+    model_state = init_states(attention, batch_size=1, sequence_length=16)
+    attention(prompt, model_state)
+    increment_steps(attention, model_state, increment=3)
+
+    snapshot = snapshot_states(attention, model_state)
+    assert snapshot[""]["cache"].shape[2] == 3
+
+    expected = run_steps(attention, model_state, inputs)
+    restore_states(attention, model_state, snapshot)
+    assert torch.equal(run_steps(attention, model_state, inputs), expected)
+
+
+def test_rope_tables_match_direct_computation():
+    rope = RotaryEmbedding(max_period=10000)
+    q, k = torch.randn(2, 3, 4, 8), torch.randn(2, 3, 4, 8)
+    for offset in [0, 5, torch.tensor([2, 7])]:
+        expected = apply_rope(q, k, offset, max_period=10000)
+        for actual, expected_tensor in zip(rope(q, k, offset), expected):
+            assert torch.equal(actual, expected_tensor)
+
+
+@torch.no_grad
+def test_whole_cache_attention_matches_forward():
+    """The compilable attention over the whole cache gives the same outputs as `forward`."""
+    attention = make_attention()
+    model_state = init_states(attention, batch_size=2, sequence_length=16)
+    attention(torch.randn(2, 3, 32), model_state)
+    increment_steps(attention, model_state, increment=3)
+    # The rows are at different positions, like in the batch scheduler.
+    model_state[""]["offset"][1] = 1
+    snapshot = snapshot_states(attention, model_state)
+
+    inputs = torch.randn(2, 4, 32)
+    expected = run_steps(attention, model_state, inputs)
+    restore_states(attention, model_state, snapshot)
+    outputs = []
+    for step in range(inputs.shape[1]):
+        state = model_state[""]
+        outputs.append(attention._forward_whole_cache(inputs[:, step : step + 1], state))
+        increment_steps(attention, model_state)
+    torch.testing.assert_close(torch.cat(outputs, dim=1), expected)
+
+
+def test_ring_key_positions_match_written_slots():
+    capacity = 6
+    for pinned in [0, 2]:
+        slots = [-1] * capacity
+        for position in range(20):
+            slot = ring_slots(torch.tensor([[position]]), torch.tensor([pinned]), capacity)
+            slots[int(slot)] = position
+            end = torch.tensor([position + 1])
+            assert ring_key_positions(end, torch.tensor([pinned]), capacity).tolist() == [slots]
+
+
+@torch.no_grad
+def test_cache_wraps_around_after_pinned_prefix():
+    """Past the capacity, the oldest positions are overwritten but not the pinned prefix."""
+    attention = make_attention()
+    model_state = init_states(attention, batch_size=1, sequence_length=8)
+    attention(torch.randn(1, 3, 32), model_state)
+    increment_steps(attention, model_state, increment=3)
+    attention.pin_prefix(model_state[""])
+    prefix = model_state[""]["cache"][:, :, :3].clone()
+
+    outputs = run_steps(attention, model_state, torch.randn(1, 20, 32))
+    assert outputs.isfinite().all()
+    assert model_state[""]["offset"].tolist() == [23]
+    assert torch.equal(model_state[""]["cache"][:, :, :3], prefix)
@@ -0,0 +1,30 @@
+"""Tests for building modules without initializing them and loading their weights."""
+
+import safetensors.torch
+import torch
+from torch import nn
+
+from pocket_tts.utils.weights_loading import empty_weights, load_weights
+
+
+def test_empty_weights_are_assigned_from_the_file(tmp_path):
+    torch.manual_seed(0)
+    reference = nn.Sequential(nn.Embedding(10, 8), nn.Linear(8, 4), nn.LayerNorm(4))
+    path = tmp_path / "weights.safetensors"
+    state_dict = reference.state_dict()
+    # Stored in another dtype than the module, like a checkpoint saved in bfloat16.
+    state_dict["1.bias"] = state_dict["1.bias"].to(torch.float64)
+    safetensors.torch.save_file(state_dict, path)
+
+    with empty_weights():
+        module = nn.Sequential(nn.Embedding(10, 8), nn.Linear(8, 4), nn.LayerNorm(4))
+        bos = torch.randn(8)
+    assert all(parameter.is_meta for parameter in module.parameters())
+    assert bos.is_meta and bos.shape == (8,)
+
+    load_weights(module, safetensors.torch.load_file(path))
+    for name, tensor in module.state_dict().items():
+        assert not tensor.is_meta
+        assert tensor.dtype == reference.state_dict()[name].dtype
+        torch.testing.assert_close(tensor, reference.state_dict()[name])
+    assert all(parameter.requires_grad for parameter in module.parameters())